@@ -1,9 +1,11 @@
-from .index import Lexicon, Documents, CaptionIndex, BinaryFormat
+from .index import (
+    Lexicon, Documents, DocumentSet, Bigrams, CaptionIndex, BinaryFormat)
 
 from .tokenize import default_tokenizer, Tokenizer
 from .lemmatize import default_lemmatizer
 
 __all__ = [
-    'Lexicon', 'Documents', 'CaptionIndex', 'BinaryFormat',
+    'Lexicon', 'Documents', 'DocumentSet', 'Bigrams', 'CaptionIndex',
+    'BinaryFormat',
     'default_tokenizer', 'Tokenizer', 'default_lemmatizer'
 ]
@@ -2,17 +2,27 @@
 Indexes for srt files
 """
 
+import io
 import os
+import re
 import csv
+import mmap
+import bisect
+import numbers
 import struct
+import itertools
+import threading
 from abc import ABC
+import collections
 import collections.abc
-from typing import (Iterable, List, Set, NamedTuple,
-                    Union, Optional, Generator, Sequence)
+import numpy as np
+from typing import (Iterable, List, Set, Dict, NamedTuple,
+                    Union, Optional, Generator, Sequence, Tuple)
 
 from .lemmatize import default_lemmatizer
 from .tokenize import default_tokenizer, Tokenizer
-from .rs_captions import RsCaptionIndex, RsDocumentData  # type: ignore
+from .rs_captions import (  # type: ignore
+    RsCaptionIndex, RsDocumentData, RsDocumentPack, RsDocumentSet)
 
 WordIdOrString = Union[str, int]
 WordIdOrWord = Union[int, 'Lexicon.Word']
@@ -21,6 +31,9 @@ OneOrMoreWords = Union[WordIdOrWord, List[WordIdOrWord]]
 # Arbirtary limit on longest ngram the system will search for
 MAX_NGRAM_LEN = 32
 
+# Number of documents searched at a time when streaming search results
+DEFAULT_SEARCH_BATCH_SIZE = 64
+
 
 class Lexicon:
     """
@@ -49,23 +62,46 @@ class Lexicon:
     class WordDoesNotExist(Exception):
         pass
 
-    def __init__(self, words, lazy_lemmas=True):
-        """List of words, where w.id is the index in the list"""
-        assert isinstance(words, list)
-        self._words = words
-        self._inverse = {}
-        self._word_count = 0
-        for i, w in enumerate(words):
-            assert w.id == i
-            self._inverse[w.token] = w
-            self._word_count += w.count
-        if not lazy_lemmas:
-            self.__init_lemmas()
-            assert self._lemmatizer is not None
-            assert self._lemmas is not None
+    def __init__(self, words, lazy_lemmas=True,
+                 lemmas_path: Optional[str] = None,
+                 case_folds_path: Optional[str] = None,
+                 trigrams_path: Optional[str] = None):
+        """
+        List of words, where w.id is the index in the list. lemmas_path,
+        case_folds_path, and trigrams_path are optional files written by
+        store_lemmas(), store_case_folds(), and store_trigrams().
+        """
+        if isinstance(words, _MappedWords):
+            # Words are decoded from the file as they are looked up
+            self._words = words
+            self._inverse = None
+            self._word_count = words.word_count
         else:
-            self._lemmas = None
-            self._lemmatizer = None
+            assert isinstance(words, list)
+            self._words = words
+            self._inverse = {}
+            self._word_count = 0
+            for i, w in enumerate(words):
+                assert w.id == i
+                self._inverse[w.token] = w
+                self._word_count += w.count
+        self._sorted_tokens = None
+        self._sorted_ids = None
+        self._fuzzy_index = None
+        self._trigrams_path = trigrams_path
+        self._lemmas = None
+        self._lemmatizer = None
+        self._lemmas_path = lemmas_path
+        self._mapped_lemmas = None
+        self._case_folds = None
+        self._case_folds_path = case_folds_path
+        if not lazy_lemmas:
+            if lemmas_path is not None:
+                self._mapped_lemmas = _MappedLemmas(lemmas_path)
+            else:
+                self.__init_lemmas()
+                assert self._lemmatizer is not None
+                assert self._lemmas is not None
 
     def __iter__(self):
         # Iterate lexicon in id order
@@ -85,10 +121,11 @@ class Lexicon:
                 raise Lexicon.WordDoesNotExist('id={}'.format(key))
         elif isinstance(key, str):
             # Get word by token
-            try:
-                return self._inverse[key]
-            except KeyError:
+            w = self._words.find(key) if self._inverse is None else \
+                self._inverse.get(key)
+            if w is None:
                 raise Lexicon.WordDoesNotExist(key)
+            return w
         raise TypeError('Not supported for {}'.format(type(key)))
 
     def __contains__(self, key: WordIdOrString) -> bool:
@@ -109,23 +146,84 @@ class Lexicon:
     def word_count(self) -> int:
         return self._word_count
 
+    def prefix(self, key: str, limit: Optional[int] = None) -> List[int]:
+        """Return words that start with key (in token order)"""
+        return list(itertools.islice(self.__prefix_ids(key), limit))
+
+    def wildcard(self, pattern: str, limit: Optional[int] = None) -> List[int]:
+        """
+        Return words that match a pattern (in token order), where * matches
+        any characters and ? matches one character
+        """
+        prefix = re.match(r'[^*?]*', pattern).group(0)
+        if prefix == pattern:
+            return [self[pattern].id] if pattern in self else []
+        regex = re.compile(''.join(
+            '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+            for c in pattern), re.DOTALL)
+        return list(itertools.islice((
+            i for i in self.__prefix_ids(prefix)
+            if regex.fullmatch(self._words[i].token)), limit))
+
+    def fuzzy(
+            self, key: str, max_dist: int = 1, limit: Optional[int] = None
+    ) -> List[int]:
+        """
+        Return words within max_dist edits (insertions, deletions, and
+        substitutions) of key, closest first
+        """
+        if self._fuzzy_index is None:
+            self.__init_fuzzy_index()
+        return self._fuzzy_index.find(
+            key, max_dist, lambda i: self._words[i].token)[:limit]
+
     def similar(self, key: WordIdOrString) -> Set[int]:
         """Return words that are similar (share the same lemma)"""
-        if self._lemmatizer is None:
-            self.__init_lemmas()
-            assert self._lemmatizer is not None
-            assert self._lemmas is not None
         if isinstance(key, str):
             s = key
         elif isinstance(key, Lexicon.Word):
             s = key.token
         else:
             s = self.__getitem__(key).token
+
+        if self._lemmas_path is not None:
+            if self._mapped_lemmas is None:
+                self._mapped_lemmas = _MappedLemmas(self._lemmas_path)
+            results = self._mapped_lemmas.similar(s.lower())
+            if results is not None:
+                return results
+
+            # Only words that are not in the lexicon need to be lemmatized
+            if self._lemmatizer is None:
+                self._lemmatizer = default_lemmatizer()
+            results = set()
+            for lem in self._lemmatizer.lemma(s.lower()):
+                results.update(self._mapped_lemmas.lemma_words(lem))
+            return results
+
+        if self._lemmatizer is None:
+            self.__init_lemmas()
+            assert self._lemmatizer is not None
+            assert self._lemmas is not None
         results = set()
         for lem in self._lemmatizer.lemma(s.lower()):
             results.update(self._lemmas.get(lem, []))
         return results
 
+    def case_folds(self, key: WordIdOrString) -> Set[int]:
+        """Return words that are the same as key, ignoring case"""
+        if isinstance(key, str):
+            s = key
+        elif isinstance(key, Lexicon.Word):
+            s = key.token
+        else:
+            s = self.__getitem__(key).token
+        if self._case_folds is None:
+            self.__init_case_folds()
+        if isinstance(self._case_folds, _MappedLemmas):
+            return self._case_folds.lemma_words(s.casefold())
+        return set(self._case_folds.get(s.casefold(), []))
+
     def decode(self, key: WordIdOrString,
                default: Optional[str] = None) -> str:
         """Convert words to strings"""
@@ -147,8 +245,42 @@ class Lexicon:
             for w in self._words:
                 tsv_writer.writerow([w.id, w.count, w.token])
 
+    def store_binary(self, path: str) -> None:
+        """Save the lexicon in the binary format read by load_binary()"""
+        _MappedWords.store(list(self._words), path)
+
+    def store_lemmas(self, path: str) -> None:
+        """
+        Lemmatize every word and save the words grouped by lemma, so that
+        similar() can be answered without the lemmatizer
+        """
+        lemmatizer = default_lemmatizer()
+        key_lemmas = {}
+        lemma_words = {}
+        for w in self._words:
+            key = w.token.lower()
+            if key not in key_lemmas:
+                key_lemmas[key] = lemmatizer.lemma(key)
+            for lem in key_lemmas[key]:
+                if lem not in lemma_words:
+                    lemma_words[lem] = set()
+                lemma_words[lem].add(w.id)
+        _MappedLemmas.store(key_lemmas, lemma_words, path)
+
+    def store_case_folds(self, path: str) -> None:
+        """Save the words grouped by their case-folded forms"""
+        _MappedLemmas.store({}, self.__group_case_folds(), path)
+
+    def store_trigrams(self, path: str) -> None:
+        """Save the index of character trigrams used by fuzzy()"""
+        with open(path, 'wb') as f:
+            _FuzzyIndex.store([w.token for w in self._words], f)
+
     @staticmethod
-    def load(path: str, lazy_lemmas=True) -> 'Lexicon':
+    def load(path: str, lazy_lemmas=True,
+             lemmas_path: Optional[str] = None,
+             case_folds_path: Optional[str] = None,
+             trigrams_path: Optional[str] = None) -> 'Lexicon':
         """Load a TSV formatted lexicon"""
         with open(path, 'r') as f:
             tsv_reader = csv.reader(f, delimiter='\t')
@@ -157,9 +289,68 @@ class Lexicon:
                 id_, count, token = row
                 words.append(Lexicon.Word(id=int(id_), count=int(count),
                                           token=token))
-        return Lexicon(words, lazy_lemmas=lazy_lemmas)
+        return Lexicon(words, lazy_lemmas=lazy_lemmas,
+                       lemmas_path=lemmas_path,
+                       case_folds_path=case_folds_path,
+                       trigrams_path=trigrams_path)
+
+    @staticmethod
+    def load_binary(path: str, lazy_lemmas=True,
+                    lemmas_path: Optional[str] = None,
+                    case_folds_path: Optional[str] = None,
+                    trigrams_path: Optional[str] = None) -> 'Lexicon':
+        """
+        Load a binary lexicon. The file is memory mapped (and shared between
+        processes through the page cache) and words are decoded on lookup.
+        """
+        return Lexicon(_MappedWords(path), lazy_lemmas=lazy_lemmas,
+                       lemmas_path=lemmas_path,
+                       case_folds_path=case_folds_path,
+                       trigrams_path=trigrams_path)
 
     # Internal helper methods
+    def __prefix_ids(self, key: str) -> Iterable[int]:
+        """Ids of words that start with key, from a range of sorted tokens"""
+        if self._inverse is None:
+            return self._words.prefix_ids(key)
+        if self._sorted_tokens is None:
+            sorted_words = sorted(self._words, key=lambda w: w.token)
+            self._sorted_ids = [w.id for w in sorted_words]
+            self._sorted_tokens = [w.token for w in sorted_words]
+
+        def prefix_ids():
+            i = bisect.bisect_left(self._sorted_tokens, key)
+            while (i < len(self._sorted_tokens)
+                   and self._sorted_tokens[i].startswith(key)):
+                yield self._sorted_ids[i]
+                i += 1
+        return prefix_ids()
+
+    def __group_case_folds(self) -> Dict[str, Set[int]]:
+        groups = {}
+        for w in self._words:
+            key = w.token.casefold()
+            if key not in groups:
+                groups[key] = set()
+            groups[key].add(w.id)
+        return groups
+
+    def __init_case_folds(self) -> None:
+        """Load the case-fold groups, or compute them if there is no file"""
+        if self._case_folds_path is not None:
+            self._case_folds = _MappedLemmas(self._case_folds_path)
+        else:
+            self._case_folds = self.__group_case_folds()
+
+    def __init_fuzzy_index(self) -> None:
+        """Load the trigram index, or build it if there is no file"""
+        if self._trigrams_path is not None:
+            self._fuzzy_index = _FuzzyIndex.load(self._trigrams_path)
+        else:
+            buf = io.BytesIO()
+            _FuzzyIndex.store([w.token for w in self._words], buf)
+            self._fuzzy_index = _FuzzyIndex(buf.getbuffer())
+
     def __init_lemmas(self) -> None:
         """Compute lemmas for every word"""
         lemmatizer = default_lemmatizer()
@@ -173,6 +364,450 @@ class Lexicon:
         self._lemmas = lemmas
 
 
+class _MappedWords(collections.abc.Sequence):
+    """
+    Words of a binary lexicon file, in id order
+
+    Layout (little endian):
+        header: magic, version, number of words, total word count
+        counts: u64 per word, by id
+        offsets: u64 per word (and one past the end) into the tokens, by id
+        sorted ids: u32 per word, ordered by token
+        tokens: utf-8 encoded tokens, concatenated in id order
+    """
+
+    MAGIC = b'CILX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQ')
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, word_count = _MappedWords.HEADER.unpack_from(
+            self._mmap)
+        if magic != _MappedWords.MAGIC:
+            raise ValueError('Not a binary lexicon: {}'.format(path))
+        if version != _MappedWords.VERSION:
+            raise ValueError('Unsupported lexicon version: {}'.format(version))
+        self._len = n
+        self.word_count = word_count
+        ofs = _MappedWords.HEADER.size
+        self._counts = np.frombuffer(self._mmap, dtype='<u8', count=n,
+                                     offset=ofs)
+        ofs += 8 * n
+        self._offsets = np.frombuffer(self._mmap, dtype='<u8', count=n + 1,
+                                      offset=ofs)
+        ofs += 8 * (n + 1)
+        self._sorted_ids = np.frombuffer(self._mmap, dtype='<u4', count=n,
+                                         offset=ofs)
+        self._tokens_ofs = ofs + 4 * n
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('Word id out of range')
+        return Lexicon.Word(id=i, token=self.__token(i).decode('utf-8'),
+                            count=int(self._counts[i]))
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    def find(self, token: str) -> Optional['Lexicon.Word']:
+        """Binary search the sorted ids for a token"""
+        i = _find_sorted(self._len, self.__sorted_token, token.encode('utf-8'))
+        return None if i is None else self[int(self._sorted_ids[i])]
+
+    def prefix_ids(self, prefix: str) -> Iterable[int]:
+        """Ids of words that start with prefix, in token order"""
+        key = prefix.encode('utf-8')
+        i = _lower_bound(self._len, self.__sorted_token, key)
+        while i < self._len and self.__sorted_token(i).startswith(key):
+            yield int(self._sorted_ids[i])
+            i += 1
+
+    def __sorted_token(self, i: int) -> bytes:
+        return self.__token(int(self._sorted_ids[i]))
+
+    def __token(self, i: int) -> bytes:
+        start = self._tokens_ofs + int(self._offsets[i])
+        end = self._tokens_ofs + int(self._offsets[i + 1])
+        return self._mmap[start:end]
+
+    @staticmethod
+    def store(words: List['Lexicon.Word'], path: str) -> None:
+        tokens = [w.token.encode('utf-8') for w in words]
+        offsets = np.zeros(len(words) + 1, dtype='<u8')
+        offsets[1:] = np.cumsum([len(t) for t in tokens])
+        # UTF-8 byte order is the same as code point order
+        sorted_ids = sorted(range(len(words)), key=lambda i: tokens[i])
+        with open(path, 'wb') as f:
+            f.write(_MappedWords.HEADER.pack(
+                _MappedWords.MAGIC, _MappedWords.VERSION, len(words),
+                sum(w.count for w in words)))
+            f.write(np.array([w.count for w in words], dtype='<u8').tobytes())
+            f.write(offsets.tobytes())
+            f.write(np.array(sorted_ids, dtype='<u4').tobytes())
+            for t in tokens:
+                f.write(t)
+
+
+class _MappedLemmas:
+    """
+    Words grouped by lemma, in a binary file
+
+    Keys are the lowercased tokens of a lexicon, which are what the
+    lemmatizer sees. Case-fold groups use the same format, with a lemma for
+    each case-folded form and no keys.
+
+    Layout (little endian):
+        header: magic, version, number of keys, number of lemmas, number of
+                key lemmas, number of lemma words
+        key offsets: u64 per key (and one past the end) into the strings
+        lemma offsets: u64 per lemma (and one past the end) into the strings
+        key lemma offsets: u64 per key (and one past the end)
+        lemma word offsets: u64 per lemma (and one past the end)
+        key lemmas: u32 lemma indexes of each key
+        lemma words: u32 word ids of each lemma
+        strings: utf-8 encoded keys, then lemmas, each in sorted order
+    """
+
+    MAGIC = b'CILM'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQQQ')
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_keys, n_lemmas, n_key_lemmas, n_lemma_words = \
+            _MappedLemmas.HEADER.unpack_from(self._mmap)
+        if magic != _MappedLemmas.MAGIC:
+            raise ValueError('Not a lemma file: {}'.format(path))
+        if version != _MappedLemmas.VERSION:
+            raise ValueError('Unsupported lemma file version: {}'.format(
+                version))
+        self._n_keys = n_keys
+        self._n_lemmas = n_lemmas
+
+        ofs = _MappedLemmas.HEADER.size
+        arrays = []
+        for dtype, count in [('<u8', n_keys + 1), ('<u8', n_lemmas + 1),
+                             ('<u8', n_keys + 1), ('<u8', n_lemmas + 1),
+                             ('<u4', n_key_lemmas), ('<u4', n_lemma_words)]:
+            arrays.append(np.frombuffer(self._mmap, dtype=dtype, count=count,
+                                        offset=ofs))
+            ofs += arrays[-1].nbytes
+        (self._key_offsets, self._lemma_offsets, self._key_lemma_offsets,
+         self._lemma_word_offsets, self._key_lemmas,
+         self._lemma_words) = arrays
+        self._strings_ofs = ofs
+
+    def similar(self, key: str) -> Optional[Set[int]]:
+        """Ids of words sharing a lemma with key (None if key is unknown)"""
+        i = _find_sorted(self._n_keys, self.__key, key.encode('utf-8'))
+        if i is None:
+            return None
+        results = set()
+        for j in range(int(self._key_lemma_offsets[i]),
+                       int(self._key_lemma_offsets[i + 1])):
+            results.update(self.__words(int(self._key_lemmas[j])))
+        return results
+
+    def lemma_words(self, lemma: str) -> Set[int]:
+        """Ids of words with the lemma"""
+        i = _find_sorted(self._n_lemmas, self.__lemma, lemma.encode('utf-8'))
+        return set() if i is None else set(self.__words(i))
+
+    def __words(self, i: int) -> List[int]:
+        return self._lemma_words[int(self._lemma_word_offsets[i]):
+                                 int(self._lemma_word_offsets[i + 1])].tolist()
+
+    def __key(self, i: int) -> bytes:
+        return self.__string(self._key_offsets, i)
+
+    def __lemma(self, i: int) -> bytes:
+        return self.__string(self._lemma_offsets, i)
+
+    def __string(self, offsets, i: int) -> bytes:
+        return self._mmap[self._strings_ofs + int(offsets[i]):
+                          self._strings_ofs + int(offsets[i + 1])]
+
+    @staticmethod
+    def store(key_lemmas: Dict[str, Set[str]], lemma_words: Dict[str, Set[int]],
+              path: str) -> None:
+        keys = sorted(k.encode('utf-8') for k in key_lemmas)
+        lemmas = sorted(lem.encode('utf-8') for lem in lemma_words)
+        lemma_idxs = {lem.decode('utf-8'): i for i, lem in enumerate(lemmas)}
+
+        def offsets(lens):
+            result = np.zeros(len(lens) + 1, dtype='<u8')
+            result[1:] = np.cumsum(lens)
+            return result
+
+        key_lemma_lists = [
+            sorted(lemma_idxs[lem] for lem in key_lemmas[k.decode('utf-8')])
+            for k in keys]
+        lemma_word_lists = [sorted(lemma_words[lem.decode('utf-8')])
+                            for lem in lemmas]
+        n_keys_bytes = sum(len(k) for k in keys)
+        with open(path, 'wb') as f:
+            f.write(_MappedLemmas.HEADER.pack(
+                _MappedLemmas.MAGIC, _MappedLemmas.VERSION, len(keys),
+                len(lemmas), sum(len(x) for x in key_lemma_lists),
+                sum(len(x) for x in lemma_word_lists)))
+            f.write(offsets([len(k) for k in keys]).tobytes())
+            f.write((offsets([len(lem) for lem in lemmas])
+                     + n_keys_bytes).tobytes())
+            f.write(offsets([len(x) for x in key_lemma_lists]).tobytes())
+            f.write(offsets([len(x) for x in lemma_word_lists]).tobytes())
+            for x in key_lemma_lists + lemma_word_lists:
+                f.write(np.array(x, dtype='<u4').tobytes())
+            for s in keys + lemmas:
+                f.write(s)
+
+
+class _FuzzyIndex:
+    """
+    Words by character trigram, to find words within an edit distance
+
+    An edit changes at most N of a word's ngrams, so a word within k edits of
+    a key shares all but N * k of the key's ngrams. Candidates are counted
+    from the posting lists of the key's ngrams, and only they are compared
+    with the key. Words are ranked by length, so that a word within k edits
+    of a key, which is at most k characters longer or shorter, has a rank in
+    a contiguous range, and only that range of each posting list is read.
+
+    Layout (little endian):
+        header: magic, version, number of words, max word length, number of
+                ngrams, number of postings
+        length offsets: u64 rank of the first word of each length (and one
+                        past the end)
+        rank ids: u32 word id of each rank
+        ngram offsets: u64 per ngram (and one past the end) into the strings
+        posting offsets: u64 per ngram (and one past the end)
+        postings: u32 sorted ranks of the words with each ngram
+        strings: utf-8 encoded ngrams, in sorted order
+    """
+
+    N = 3
+    MAGIC = b'CITG'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQQQ')
+
+    def __init__(self, buf):
+        """Read the index from a buffer in the layout of store()"""
+        self._buf = buf
+        magic, version, n_words, max_len, n_grams, n_postings = \
+            _FuzzyIndex.HEADER.unpack_from(buf)
+        if magic != _FuzzyIndex.MAGIC:
+            raise ValueError('Not a trigram file')
+        if version != _FuzzyIndex.VERSION:
+            raise ValueError('Unsupported trigram file version: {}'.format(
+                version))
+        self._max_len = max_len
+        self._n_grams = n_grams
+
+        ofs = _FuzzyIndex.HEADER.size
+        arrays = []
+        for dtype, count in [('<u8', max_len + 2), ('<u4', n_words),
+                             ('<u8', n_grams + 1), ('<u8', n_grams + 1),
+                             ('<u4', n_postings)]:
+            arrays.append(np.frombuffer(buf, dtype=dtype, count=count,
+                                        offset=ofs))
+            ofs += arrays[-1].nbytes
+        (self._length_offsets, self._rank_ids, self._gram_offsets,
+         self._posting_offsets, self._postings) = arrays
+        self._strings_ofs = ofs
+
+    @staticmethod
+    def load(path: str) -> '_FuzzyIndex':
+        with open(path, 'rb') as f:
+            return _FuzzyIndex(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def find(self, key: str, max_dist: int, token_at) -> List[int]:
+        """
+        Ids of words within max_dist of key, closest first (token_at(i) is
+        the ith word)
+        """
+        lo_len = max(len(key) - max_dist, 0)
+        hi_len = min(len(key) + max_dist, self._max_len)
+        if lo_len > hi_len:
+            return []
+        lo = int(self._length_offsets[lo_len])
+        hi = int(self._length_offsets[hi_len + 1])
+
+        grams = _FuzzyIndex.__ngrams(key)
+        min_shared = len(grams) - _FuzzyIndex.N * max_dist
+        if min_shared > 0:
+            ranks = []
+            for gram in grams:
+                i = _find_sorted(self._n_grams, self.__gram,
+                                 gram.encode('utf-8'))
+                if i is None:
+                    continue
+                postings = self._postings[int(self._posting_offsets[i]):
+                                          int(self._posting_offsets[i + 1])]
+                a, b = np.searchsorted(postings, [lo, hi])
+                if b > a:
+                    ranks.append(postings[a:b])
+            if len(ranks) < min_shared:
+                return []
+            ranks, shared = np.unique(np.concatenate(ranks),
+                                      return_counts=True)
+            candidates = ranks[shared >= min_shared]
+        else:
+            candidates = np.arange(lo, hi)
+
+        results = []
+        for i in self._rank_ids[candidates].tolist():
+            dist = _edit_distance(key, token_at(i), max_dist)
+            if dist <= max_dist:
+                results.append((dist, i))
+        results.sort()
+        return [i for _, i in results]
+
+    def __gram(self, i: int) -> bytes:
+        return bytes(self._buf[
+            self._strings_ofs + int(self._gram_offsets[i]):
+            self._strings_ofs + int(self._gram_offsets[i + 1])])
+
+    @staticmethod
+    def store(tokens: List[str], f) -> None:
+        """Write the index of tokens (where the index is the id) to a file"""
+        max_len = max((len(t) for t in tokens), default=0)
+        rank_ids = sorted(range(len(tokens)), key=lambda i: len(tokens[i]))
+        length_offsets = np.zeros(max_len + 2, dtype='<u8')
+        length_offsets[1:] = np.cumsum(np.bincount(
+            np.array([len(t) for t in tokens], dtype=np.int64),
+            minlength=max_len + 1))
+
+        postings = {}
+        for rank, i in enumerate(rank_ids):
+            for gram in _FuzzyIndex.__ngrams(tokens[i]):
+                gram = gram.encode('utf-8')
+                if gram not in postings:
+                    postings[gram] = []
+                postings[gram].append(rank)
+        grams = sorted(postings)
+
+        def offsets(lens):
+            result = np.zeros(len(lens) + 1, dtype='<u8')
+            result[1:] = np.cumsum(lens)
+            return result
+
+        n_postings = sum(len(x) for x in postings.values())
+        f.write(_FuzzyIndex.HEADER.pack(
+            _FuzzyIndex.MAGIC, _FuzzyIndex.VERSION, len(tokens), max_len,
+            len(grams), n_postings))
+        f.write(length_offsets.tobytes())
+        f.write(np.array(rank_ids, dtype='<u4').tobytes())
+        f.write(offsets([len(g) for g in grams]).tobytes())
+        f.write(offsets([len(postings[g]) for g in grams]).tobytes())
+        for g in grams:
+            f.write(np.array(postings[g], dtype='<u4').tobytes())
+        for g in grams:
+            f.write(g)
+
+    @staticmethod
+    def __ngrams(token: str) -> Set[str]:
+        padded = '\0' * (_FuzzyIndex.N - 1) + token + \
+            '\0' * (_FuzzyIndex.N - 1)
+        return {padded[i:i + _FuzzyIndex.N]
+                for i in range(len(padded) - _FuzzyIndex.N + 1)}
+
+
+def _edit_distance(a: str, b: str, max_dist: int) -> int:
+    """Levenshtein distance of a and b (max_dist + 1 if it is larger)"""
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        curr = [i]
+        for j, cb in enumerate(b, 1):
+            curr.append(min(prev[j] + 1, curr[j - 1] + 1,
+                            prev[j - 1] + (ca != cb)))
+        if min(curr) > max_dist:
+            return max_dist + 1
+        prev = curr
+    return min(prev[-1], max_dist + 1)
+
+
+def _lower_bound(n: int, key_at, key: bytes) -> int:
+    """Index of the first of n sorted keys (key_at(i) is the ith) >= key"""
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _find_sorted(n: int, key_at, key: bytes) -> Optional[int]:
+    """Binary search for key among n sorted keys (key_at(i) is the ith)"""
+    i = _lower_bound(n, key_at, key)
+    return i if i < n and key_at(i) == key else None
+
+
+class Bigrams:
+    """
+    Frequent pairs of adjacent words with their own postings in the index
+
+    A bigram's postings are stored under a token id that is not used by the
+    lexicon, so phrases of common words can be searched without merging the
+    long posting lists of each word.
+
+    Lookup a bigram by word ids:
+        b = bigrams.get(lexicon['OF'].id, lexicon['THE'].id)
+    """
+
+    class Bigram(NamedTuple):
+        id: int         # Token id of the bigram's postings
+        first: int      # Id of the first word
+        second: int     # Id of the second word
+        count: int      # Number of occurrences
+
+    def __init__(self, bigrams: List['Bigrams.Bigram']):
+        self._bigrams = bigrams
+        self._by_words = {(b.first, b.second): b for b in bigrams}
+
+    def __iter__(self) -> Iterable['Bigrams.Bigram']:
+        return self._bigrams.__iter__()
+
+    def __len__(self) -> int:
+        return len(self._bigrams)
+
+    def get(self, first: int, second: int) -> Optional['Bigrams.Bigram']:
+        """Get the bigram of two word ids, if it is indexed"""
+        return self._by_words.get((first, second))
+
+    def store(self, path: str) -> None:
+        """Save the bigrams as a TSV file"""
+        with open(path, 'w') as f:
+            tsv_writer = csv.writer(f, delimiter='\t')
+            for b in self._bigrams:
+                tsv_writer.writerow([b.id, b.first, b.second, b.count])
+
+    @staticmethod
+    def load(path: str) -> 'Bigrams':
+        """Load a TSV formatted list of bigrams"""
+        with open(path, 'r') as f:
+            tsv_reader = csv.reader(f, delimiter='\t')
+            bigrams = []
+            for row in tsv_reader:
+                id_, first, second, count = row
+                bigrams.append(Bigrams.Bigram(
+                    id=int(id_), first=int(first), second=int(second),
+                    count=int(count)))
+        return Bigrams(bigrams)
+
+
 class Documents:
     """
     A mapping from document id to name, and vice versa
@@ -197,13 +832,37 @@ class Documents:
     class DocumentDoesNotExist(Exception):
         pass
 
+    # Statistics of the pool of open document handles
+    class PoolStats(NamedTuple):
+        hits: int           # Opens served from the pool
+        misses: int         # Opens that mapped the document
+        evictions: int      # Handles closed to stay within the bounds
+        entries: int        # Number of open handles
+        bytes: int          # Mapped bytes of the open handles
+
     DocumentIdOrName = Union[int, str]
 
+    # File in the data directory listing the packed segments, one per line
+    PACK_MANIFEST = 'packs.txt'
+
     def __init__(self, docs: List['Documents.Document']):
         """List of Documents, where index is the id"""
         assert all(i == d.id for i, d in enumerate(docs))
         self._docs = docs
         self._data_dir = None
+        self._pool = None
+
+        # Packed data segments: sorted first ids, end ids, and paths, read
+        # lazily from the manifest (see __init_packs), and the opened packs
+        self._pack_starts = None
+        self._pack_ends = None
+        self._pack_paths = None
+        self._packs = {}
+
+        # Name lookups are indexed lazily (see __init_names)
+        self._by_name = None
+        self._sorted_names = None
+        self._sorted_docs = None
 
     def __iter__(self) -> Iterable['Documents.Document']:
         return self._docs.__iter__()
@@ -222,10 +881,11 @@ class Documents:
                 raise Documents.DocumentDoesNotExist('id={}'.format(key))
         elif isinstance(key, str):
             # Get doc id by name (KeyError)
-            for d in self._docs:
-                if d.name == key:
-                    return d
-            else:
+            if self._by_name is None:
+                self.__init_names()
+            try:
+                return self._by_name[key]
+            except KeyError:
                 raise Documents.DocumentDoesNotExist(key)
         raise TypeError('Not supported for {}'.format(type(key)))
 
@@ -244,13 +904,32 @@ class Documents:
         return len(self._docs)
 
     def prefix(self, key: str) -> List['Documents.Document']:
-        """Find documents by prefix"""
+        """Find documents by prefix (in id order)"""
+        if self._sorted_names is None:
+            self.__init_names()
         results = []
-        for d in self._docs:
-            if d.name.startswith(key):
-                results.append(d)
+        i = bisect.bisect_left(self._sorted_names, key)
+        while (i < len(self._sorted_names)
+               and self._sorted_names[i].startswith(key)):
+            results.append(self._sorted_docs[i])
+            i += 1
+        results.sort(key=lambda d: d.id)
         return results
 
+    def name_range(
+            self, start: str, end: Optional[str] = None
+    ) -> List['Documents.Document']:
+        """
+        Find documents with names in [start, end) (in name order). None means
+        no upper bound.
+        """
+        if self._sorted_names is None:
+            self.__init_names()
+        lo = bisect.bisect_left(self._sorted_names, start)
+        hi = len(self._sorted_names) if end is None else \
+            bisect.bisect_left(self._sorted_names, end, lo)
+        return self._sorted_docs[lo:hi]
+
     def store(self, path: str) -> None:
         """Save the document list as TSV formatted file"""
         with open(path, 'w') as f:
@@ -275,14 +954,38 @@ class Documents:
     def configure(
             self, data_dir: str,
             binary_format: Optional['BinaryFormat'] = None,
-            debug: bool = False
+            debug: bool = False,
+            max_open: int = 0,
+            max_open_bytes: Optional[int] = None
     ):
-        """Set up path and binary format"""
+        """
+        Set up path and binary format
+
+        The data of each document is read from <data_dir>/<id>.bin, or from a
+        packed segment <data_dir>/<first id>-<end id>.pack that holds the
+        documents in [first id, end id). Segments are listed in
+        <data_dir>/packs.txt, which is read when a document is first opened.
+
+        max_open: number of document handles to keep open, so that opening
+                  a document again reuses its handle (0 disables the pool)
+        max_open_bytes: bound on the mapped bytes of the open handles
+                        (None means no bound)
+        """
+        if max_open < 0:
+            raise ValueError('max_open must be non-negative')
+        if max_open_bytes is not None and max_open_bytes < 0:
+            raise ValueError('max_open_bytes must be non-negative')
         if binary_format is None:
             binary_format = BinaryFormat()
         self._binary_format = binary_format
         self._data_dir = data_dir
         self._debug = debug
+        self._pool = _DocumentPool(max_open, max_open_bytes) \
+            if max_open > 0 else None
+        self._pack_starts = None
+        self._pack_ends = None
+        self._pack_paths = None
+        self._packs = {}
 
     def open(self, d: Union[int, 'Documents.Document']) -> 'DocumentData':
         """Open a handle to get document data"""
@@ -295,9 +998,194 @@ class Documents:
             doc_id = d
         else:
             raise TypeError('Not supported for {}'.format(type(d)))
-        data_path = os.path.join(self._data_dir, '{}.bin'.format(doc_id))
-        return DocumentData(doc_id, data_path, self._binary_format,
-                            self._debug)
+        if self._pool is not None:
+            handle = self._pool.get(doc_id)
+            if handle is not None:
+                return handle
+        pack = self.__find_pack(doc_id)
+        if pack is not None:
+            handle = DocumentData._from_rs(doc_id, pack.open(
+                doc_id, datum_size=self._binary_format.datum_bytes,
+                start_time_size=self._binary_format.start_time_bytes,
+                end_time_size=self._binary_format.end_time_bytes))
+        else:
+            data_path = os.path.join(self._data_dir, '{}.bin'.format(doc_id))
+            handle = DocumentData(doc_id, data_path, self._binary_format,
+                                  self._debug)
+        if self._pool is not None:
+            self._pool.put(doc_id, handle)
+        return handle
+
+    def close(self) -> None:
+        """Close the pooled document handles and the packed segments"""
+        if self._pool is not None:
+            self._pool.clear()
+        self._packs = {}
+
+    def pool_stats(self) -> Optional['Documents.PoolStats']:
+        """Statistics of the pool of open handles (None if it is disabled)"""
+        return None if self._pool is None else self._pool.stats()
+
+    def warm(
+            self,
+            documents: Optional[Iterable[Union[int, 'Documents.Document']]] = None
+    ) -> int:
+        """
+        Load the data of documents into the page cache (None means all
+        documents). Returns the number of bytes loaded.
+        """
+        if documents is None:
+            # Packed segments are loaded whole
+            if self._pack_paths is None:
+                self.__init_packs()
+            total = sum(self.__open_pack(i).warm(False)
+                        for i in range(len(self._pack_paths)))
+            documents = [d for d in self._docs
+                         if self.__find_pack_index(d.id) is None]
+            return total + sum(self.open(d).warm() for d in documents)
+        return sum(self.open(d).warm() for d in documents)
+
+    # Internal helper methods
+    _PACK_NAME_RE = re.compile(r'(\d+)-(\d+)\.pack')
+
+    def __init_packs(self) -> None:
+        """Read the packed segments from the manifest, if there is one"""
+        segments = []
+        manifest_path = os.path.join(self._data_dir, Documents.PACK_MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as fp:
+                for line in fp:
+                    fname = line.strip()
+                    if not fname:
+                        continue
+                    match = Documents._PACK_NAME_RE.fullmatch(fname)
+                    if match is None:
+                        raise ValueError(
+                            'Invalid document pack name: {}'.format(fname))
+                    segments.append((
+                        int(match.group(1)), int(match.group(2)),
+                        os.path.join(self._data_dir, fname)))
+        segments.sort()
+        for (_, prev_end, _), (start, _, path) in zip(segments, segments[1:]):
+            if start < prev_end:
+                raise ValueError('Overlapping document packs: {}'.format(path))
+        self._pack_starts = [s for s, _, _ in segments]
+        self._pack_ends = [e for _, e, _ in segments]
+        self._pack_paths = [p for _, _, p in segments]
+
+    def __find_pack_index(self, doc_id: int) -> Optional[int]:
+        """Index of the packed segment holding the document, if any"""
+        if self._pack_paths is None:
+            self.__init_packs()
+        i = bisect.bisect_right(self._pack_starts, doc_id) - 1
+        if i >= 0 and doc_id < self._pack_ends[i]:
+            return i
+        return None
+
+    def __open_pack(self, i: int) -> RsDocumentPack:
+        pack = self._packs.get(i)
+        if pack is None:
+            pack = RsDocumentPack(self._pack_paths[i], self._debug)
+            if (pack.first_id() != self._pack_starts[i]
+                    or pack.first_id() + pack.count() != self._pack_ends[i]):
+                raise ValueError('Document pack does not match its name: {}'
+                                 .format(self._pack_paths[i]))
+            self._packs[i] = pack
+        return pack
+
+    def __find_pack(self, doc_id: int) -> Optional[RsDocumentPack]:
+        i = self.__find_pack_index(doc_id)
+        return None if i is None else self.__open_pack(i)
+
+    def __init_names(self) -> None:
+        """Index the documents by name"""
+        by_name = {}
+        for d in reversed(self._docs):
+            # The lowest id wins if names are repeated
+            by_name[d.name] = d
+        sorted_docs = sorted(self._docs, key=lambda d: (d.name, d.id))
+        self._sorted_names = [d.name for d in sorted_docs]
+        self._sorted_docs = sorted_docs
+        self._by_name = by_name
+
+
+class DocumentSet(collections.abc.Set):
+    """
+    An immutable set of document ids, stored as a bitmap (so its size grows
+    with the largest id)
+
+    Pass a DocumentSet as the documents of a search to restrict it without
+    converting a list of ids on every call (unlike an empty list, an empty
+    DocumentSet matches no documents), and contains() then returns one
+    too. Union (|), intersection (&), difference (-), and symmetric
+    difference (^) of DocumentSets are computed on the bitmaps.
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._rs_document_set = RsDocumentSet(list(ids))
+        self._hash_value = None
+
+    @staticmethod
+    def _from_rs(rs_document_set) -> 'DocumentSet':
+        result = DocumentSet.__new__(DocumentSet)
+        result._rs_document_set = rs_document_set
+        result._hash_value = None
+        return result
+
+    def __len__(self) -> int:
+        return self._rs_document_set.len()
+
+    def __contains__(self, doc_id) -> bool:
+        return (isinstance(doc_id, numbers.Integral)
+                and 0 <= doc_id < 2 ** 32
+                and self._rs_document_set.contains(int(doc_id)))
+
+    def __iter__(self) -> Iterable[int]:
+        return iter(self._rs_document_set.ids())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DocumentSet):
+            return self._rs_document_set.equals(other._rs_document_set)
+        return super().__eq__(other)
+
+    def __hash__(self) -> int:
+        # Equal to the hash of a frozenset of the same ids, since the sets
+        # compare equal
+        if self._hash_value is None:
+            self._hash_value = self._hash()
+        return self._hash_value
+
+    def __or__(self, other):
+        if isinstance(other, DocumentSet):
+            return DocumentSet._from_rs(
+                self._rs_document_set.union(other._rs_document_set))
+        return super().__or__(other)
+
+    def __and__(self, other):
+        if isinstance(other, DocumentSet):
+            return DocumentSet._from_rs(
+                self._rs_document_set.intersection(other._rs_document_set))
+        return super().__and__(other)
+
+    def __sub__(self, other):
+        if isinstance(other, DocumentSet):
+            return DocumentSet._from_rs(
+                self._rs_document_set.difference(other._rs_document_set))
+        return super().__sub__(other)
+
+    def __xor__(self, other):
+        if isinstance(other, DocumentSet):
+            return DocumentSet._from_rs(
+                self._rs_document_set.symmetric_difference(
+                    other._rs_document_set))
+        return super().__xor__(other)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    def __repr__(self) -> str:
+        return 'DocumentSet({})'.format(list(self))
 
 
 class DocumentData:
@@ -326,6 +1214,13 @@ class DocumentData:
             debug=debug)
         self._id = id
 
+    @staticmethod
+    def _from_rs(id: int, rs_document_data) -> 'DocumentData':
+        result = DocumentData.__new__(DocumentData)
+        result._rs_document_data = rs_document_data
+        result._id = id
+        return result
+
     @property
     def id(self) -> int:
         return self._id
@@ -355,6 +1250,41 @@ class DocumentData:
         """Find next token position containing or near the time offset"""
         return self._rs_document_data.position(time_offset)
 
+    def warm(self, lock: bool = False) -> int:
+        """
+        Load the document into memory, optionally locking it there. Returns
+        the number of bytes loaded.
+
+        Locks belong to the segment's map rather than to this handle: they
+        last until unlock() is called or every handle to the segment is
+        closed.
+        """
+        return self._rs_document_data.warm(lock)
+
+    def unlock(self) -> None:
+        """
+        Release pages locked by warm(lock=True). In a packed segment, pages
+        shared with neighbouring documents stay locked.
+        """
+        self._rs_document_data.unlock()
+
+    def advise(self, access: str) -> None:
+        """
+        Hint the expected access pattern of the document to the OS
+
+        access: 'normal', 'random', 'sequential', or 'willneed'
+        """
+        self._rs_document_data.advise(access)
+
+    def resident_bytes(self) -> Tuple[int, int]:
+        """Bytes of the document that are in memory, and the total bytes"""
+        return self._rs_document_data.resident_bytes()
+
+    @property
+    def size(self) -> int:
+        """Get the number of mapped bytes"""
+        return self._rs_document_data.size()
+
 
 class _BaseIndex(ABC):
     """
@@ -375,12 +1305,20 @@ class _BaseIndex(ABC):
         else:
             return self._documents[doc].id
 
-    def _to_document_ids(
+    def _to_document_set(
             self,
             docs: Optional[Iterable['_BaseIndex.DocIdOrDocument']]
-    ) -> List['CaptionIndex.DocIdOrDocument']:
-        return [] if docs is None else [
-            self._to_document_id(d) for d in docs]
+    ) -> Optional[DocumentSet]:
+        """None (all documents) if docs is None or an empty list"""
+        if docs is None or isinstance(docs, DocumentSet):
+            return docs
+        doc_ids = [self._to_document_id(d) for d in docs]
+        if len(doc_ids) == 0:
+            return None
+        # Ids past the last document match nothing, and would only grow the
+        # bitmap
+        num_docs = len(self._documents)
+        return DocumentSet(i for i in doc_ids if i < num_docs)
 
     def _to_words(
             self, word: OneOrMoreWords
@@ -397,6 +1335,9 @@ class _BaseIndex(ABC):
 class CaptionIndex(_BaseIndex):
     """
     Interface to a binary encoded inverted index.
+
+    Searches release the GIL while reading the index, so one CaptionIndex
+    can be shared by multiple threads.
     """
 
     # A "posting" is an occurance of a token or n-gram
@@ -406,11 +1347,29 @@ class CaptionIndex(_BaseIndex):
         idx: int            # Start position in document
         len: int            # Number of tokens
 
+    # NumPy dtype of a posting. Matches the encoding of postings returned by
+    # the Rust index.
+    POSTING_DTYPE = np.dtype([
+        ('start', '<f4'), ('end', '<f4'), ('idx', '<u4'), ('len', 'u1')])
+
     # Document object with postings
     class Document(NamedTuple):
         id: int                                     # Document id
         postings: Sequence['CaptionIndex.Posting']  # Sequence of locations
 
+    # Occurrence counts of a token or n-gram
+    class Count(NamedTuple):
+        total: int                  # Number of occurrences in all documents
+        documents: Dict[int, int]   # Document id to number of occurrences
+
+    # Statistics of the result cache
+    class CacheStats(NamedTuple):
+        hits: int           # Lookups served from the cache
+        misses: int         # Lookups that searched the index
+        evictions: int      # Results evicted to stay within the budget
+        entries: int        # Number of cached results
+        bytes: int          # Approximate size of the cached results
+
     def __init__(
             self,
             path: str,
@@ -418,10 +1377,25 @@ class CaptionIndex(_BaseIndex):
             documents: Documents,
             binary_format: Optional['BinaryFormat'] = None,
             tokenizer: Optional[Tokenizer] = None,
+            num_threads: Optional[int] = None,
+            bigrams: Optional[Bigrams] = None,
+            cache_bytes: int = 0,
             debug: bool = False
     ):
+        """
+        num_threads: number of threads used to search documents in parallel
+                     (None means one per CPU)
+        bigrams: bigrams that were indexed with the documents, used to
+                 search phrases of common words
+        cache_bytes: size budget of an LRU cache of search results
+                     (0 disables the cache)
+        """
         super().__init__(lexicon, documents)
         self._tokenizer = tokenizer
+        self._bigrams = bigrams
+        if cache_bytes < 0:
+            raise ValueError('cache_bytes must be non-negative')
+        self._cache = _ResultCache(cache_bytes) if cache_bytes > 0 else None
 
         if binary_format is None:
             binary_format = BinaryFormat()
@@ -430,6 +1404,7 @@ class CaptionIndex(_BaseIndex):
             path, datum_size=binary_format.datum_bytes,
             start_time_size=binary_format.start_time_bytes,
             end_time_size=binary_format.end_time_bytes,
+            num_threads=num_threads if num_threads is not None else 0,
             debug=debug)
 
     def __require_open_index(f):
@@ -447,85 +1422,344 @@ class CaptionIndex(_BaseIndex):
     def search(
             self,
             text: Union[str, List[WordIdOrWord]],
-            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            batch_size: int = DEFAULT_SEARCH_BATCH_SIZE,
+            limit: Optional[int] = None,
+            after_doc_id: Optional[int] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf'),
+            ignore_case: bool = False
     ) -> Iterable['CaptionIndex.Document']:
         """
         Search for instances of text
 
         Usage:
             text: string, list of words, or list of word ids
-            documents: list of documents or ids to search in
-                       ([] or None means all documents)
+            documents: list of documents or ids, or a DocumentSet, to search
+                       in ([] or None means all documents)
+            batch_size: number of documents to search at a time
+            limit: maximum number of documents to return
+            after_doc_id: only return documents with larger ids (for paging)
+            start_time, end_time: only return instances that lie within this
+                                  time window, in seconds
+            ignore_case: also match words that differ only in case
+
+        Results are streamed in document id order as they are found.
         """
         if isinstance(text, str):
             tokens = self.__tokenize_text(text)
         else:
             tokens = text
-        return self.ngram_search(*tokens, documents=documents)
+        if ignore_case:
+            tokens = self.__case_fold_tokens(tokens)
+        return self.ngram_search(*tokens, documents=documents,
+                                 batch_size=batch_size, limit=limit,
+                                 after_doc_id=after_doc_id,
+                                 start_time=start_time, end_time=end_time)
 
     @__require_open_index
     def ngram_search(
             self,
             first_word: OneOrMoreWords,
             *other_words,
-            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            batch_size: int = DEFAULT_SEARCH_BATCH_SIZE,
+            limit: Optional[int] = None,
+            after_doc_id: Optional[int] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf')
     ) -> Iterable['CaptionIndex.Document']:
         """Search for ngram instances"""
-        doc_ids = self._to_document_ids(documents)
+        if batch_size <= 0:
+            raise ValueError('batch_size must be positive')
+        _check_limit(limit, after_doc_id)
+        _check_time_window(start_time, end_time)
+        if len(other_words) > MAX_NGRAM_LEN - 1:
+            raise RuntimeError('Ngram too long')
+        doc_set = self._to_document_set(documents)
+        window = (start_time, end_time)
+        cached = self.__get_cached([first_word, *other_words], doc_set, window,
+                                   (_ResultCache.SEARCH,))
+        if cached is not None:
+            return self.__unpack_results(
+                _page_results(cached[1], limit, after_doc_id))
+
         if len(other_words) == 0:
             result = self._rs_index.unigram_search(
-                [w.id for w in self._to_words(first_word)], doc_ids)
-        elif len(other_words) > MAX_NGRAM_LEN - 1:
-            raise RuntimeError('Ngram too long')
+                [w.id for w in self._to_words(first_word)],
+                _rs_document_set(doc_set), batch_size, limit, after_doc_id,
+                start_time, end_time)
         else:
-            ngram_word_ids, query_plan = self.__get_ngram_ids_and_query_plan(
-                [first_word, *other_words])
+            ngram_ids, offsets, query_plan = \
+                self.__get_ngram_ids_and_query_plan([first_word, *other_words])
             result = self._rs_index.ngram_search(
-                ngram_word_ids, doc_ids, query_plan)
+                ngram_ids, offsets, len(other_words) + 1,
+                _rs_document_set(doc_set), query_plan, batch_size, limit,
+                after_doc_id, start_time, end_time)
+
+        # Only complete results are cached
+        if self._cache is not None and limit is None and after_doc_id is None:
+            return self.__unpack_rs_search_into_cache(
+                result, self.__cache_key([first_word, *other_words], window),
+                doc_set)
         return self.__unpack_rs_search(result)
 
     def contains(
             self,
             text: Union[str, List[WordIdOrWord]],
-            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None
-    ) -> Set[int]:
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            limit: Optional[int] = None,
+            after_doc_id: Optional[int] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf'),
+            ignore_case: bool = False
+    ) -> Union[Set[int], DocumentSet]:
         """
-        Find documents (ids) containing the text
+        Find documents (ids) containing the text. Returns a set, or a
+        DocumentSet if documents is a DocumentSet.
 
         Usage:
             text: string, list of words, or list of word ids
-            documents: list of documents or ids to search in
-                       ([] or None means all documents)
+            documents: list of documents or ids, or a DocumentSet, to search
+                       in ([] or None means all documents)
+            limit: maximum number of documents to return (the lowest ids)
+            after_doc_id: only return documents with larger ids (for paging)
+            start_time, end_time: only consider instances that lie within
+                                  this time window, in seconds
+            ignore_case: also match words that differ only in case
         """
         if isinstance(text, str):
             tokens = self.__tokenize_text(text)
         else:
             tokens = text
-        return self.ngram_contains(*tokens, documents=documents)
+        if ignore_case:
+            tokens = self.__case_fold_tokens(tokens)
+        return self.ngram_contains(*tokens, documents=documents, limit=limit,
+                                   after_doc_id=after_doc_id,
+                                   start_time=start_time, end_time=end_time)
 
     @__require_open_index
     def ngram_contains(
             self, first_word: OneOrMoreWords,
             *other_words,
-            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None
-    ) -> Set[int]:
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            limit: Optional[int] = None,
+            after_doc_id: Optional[int] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf')
+    ) -> Union[Set[int], DocumentSet]:
         """Find documents (ids) containing the ngram"""
-        doc_ids = self._to_document_ids(documents)
+        _check_limit(limit, after_doc_id)
+        _check_time_window(start_time, end_time)
+        doc_set = self._to_document_set(documents)
+        cached = self.__get_cached(
+            [first_word, *other_words], doc_set, (start_time, end_time),
+            (_ResultCache.SEARCH, _ResultCache.CONTAINS))
+        if cached is not None:
+            kind, cached_result = cached
+            if kind == _ResultCache.SEARCH:
+                cached_result = [doc_id for doc_id, _ in cached_result]
+            elif limit is None and after_doc_id is None:
+                return _contains_result(cached_result, documents)
+            return _contains_result(DocumentSet(
+                _page_ids(cached_result, limit, after_doc_id)), documents)
+
         if len(other_words) == 0:
             result = self._rs_index.unigram_contains(
-                [w.id for w in self._to_words(first_word)], doc_ids)
+                [w.id for w in self._to_words(first_word)],
+                _rs_document_set(doc_set), limit, after_doc_id, start_time,
+                end_time)
         elif len(other_words) > MAX_NGRAM_LEN - 1:
             raise RuntimeError('Ngram too long')
         else:
-            ngram_word_ids, query_plan = self.__get_ngram_ids_and_query_plan(
-                [first_word, *other_words])
+            ngram_ids, offsets, query_plan = \
+                self.__get_ngram_ids_and_query_plan([first_word, *other_words])
             result = self._rs_index.ngram_contains(
-                ngram_word_ids, doc_ids, query_plan)
-        assert isinstance(result, set)
+                ngram_ids, offsets, len(other_words) + 1,
+                _rs_document_set(doc_set), query_plan, limit, after_doc_id,
+                start_time, end_time)
+        result = DocumentSet._from_rs(result)
+
+        # Only complete results are cached
+        if self._cache is not None and limit is None and after_doc_id is None:
+            self._cache.put(
+                self.__cache_key([first_word, *other_words],
+                                 (start_time, end_time)),
+                doc_set, result, _ResultCache.CONTAINS)
+        return _contains_result(result, documents)
+
+    def count(
+            self,
+            text: Union[str, List[WordIdOrWord]],
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf'),
+            ignore_case: bool = False
+    ) -> 'CaptionIndex.Count':
+        """
+        Count instances of text in each document, without reading postings
+        (unless they are restricted to a time window)
+
+        Usage:
+            text: string, list of words, or list of word ids
+            documents: list of documents or ids, or a DocumentSet, to search
+                       in ([] or None means all documents)
+            start_time, end_time: only count instances that lie within this
+                                  time window, in seconds
+            ignore_case: also match words that differ only in case
+        """
+        if isinstance(text, str):
+            tokens = self.__tokenize_text(text)
+        else:
+            tokens = text
+        if ignore_case:
+            tokens = self.__case_fold_tokens(tokens)
+        return self.ngram_count(*tokens, documents=documents,
+                                start_time=start_time, end_time=end_time)
+
+    @__require_open_index
+    def ngram_count(
+            self, first_word: OneOrMoreWords,
+            *other_words,
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf')
+    ) -> 'CaptionIndex.Count':
+        """Count ngram instances in documents that contain the ngram"""
+        _check_time_window(start_time, end_time)
+        doc_set = self._to_document_set(documents)
+        cached = self.__get_cached(
+            [first_word, *other_words], doc_set, (start_time, end_time),
+            (_ResultCache.SEARCH, _ResultCache.COUNT))
+        if cached is not None:
+            kind, cached_result = cached
+            if kind == _ResultCache.COUNT:
+                # Copy, so that callers cannot change the cached counts
+                return CaptionIndex.Count(
+                    total=cached_result.total,
+                    documents=dict(cached_result.documents))
+            counts = {
+                doc_id: len(bin_data) // CaptionIndex.POSTING_DTYPE.itemsize
+                for doc_id, bin_data in cached_result}
+            return CaptionIndex.Count(
+                total=sum(counts.values()), documents=counts)
+
+        if len(other_words) == 0:
+            result = self._rs_index.unigram_count(
+                [w.id for w in self._to_words(first_word)],
+                _rs_document_set(doc_set), start_time, end_time)
+        elif len(other_words) > MAX_NGRAM_LEN - 1:
+            raise RuntimeError('Ngram too long')
+        else:
+            ngram_ids, offsets, query_plan = \
+                self.__get_ngram_ids_and_query_plan([first_word, *other_words])
+            result = self._rs_index.ngram_count(
+                ngram_ids, offsets, len(other_words) + 1,
+                _rs_document_set(doc_set), query_plan, start_time, end_time)
+        counts = dict(result)
+        result = CaptionIndex.Count(total=sum(counts.values()), documents=counts)
+        if self._cache is not None:
+            self._cache.put(
+                self.__cache_key([first_word, *other_words],
+                                 (start_time, end_time)),
+                doc_set, CaptionIndex.Count(
+                    total=result.total, documents=dict(counts)),
+                _ResultCache.COUNT)
         return result
 
+    @__require_open_index
+    def search_many(
+            self,
+            queries: List[Union[str, List[WordIdOrWord]]],
+            documents: Optional[Iterable['CaptionIndex.DocIdOrDocument']] = None,
+            start_time: float = 0.,
+            end_time: float = float('inf')
+    ) -> List[List['CaptionIndex.Document']]:
+        """
+        Search for instances of many texts in one pass over the documents
+
+        Usage:
+            queries: list of strings, lists of words, or lists of word ids
+            documents: list of documents or ids, or a DocumentSet, to search
+                       in ([] or None means all documents)
+            start_time, end_time: only return instances that lie within this
+                                  time window, in seconds
+
+        Returns the documents found for each query, in the order of the
+        queries. Each list of documents is in document id order.
+        """
+        _check_time_window(start_time, end_time)
+        rs_queries = []
+        for text in queries:
+            if isinstance(text, str):
+                tokens = self.__tokenize_text(text)
+            else:
+                tokens = text
+            if len(tokens) == 0:
+                raise ValueError('No tokens in query')
+            elif len(tokens) == 1:
+                rs_queries.append((
+                    [[w.id for w in self._to_words(tokens[0])]], [0], 1, [0]))
+            elif len(tokens) > MAX_NGRAM_LEN:
+                raise RuntimeError('Ngram too long')
+            else:
+                ngram_ids, offsets, query_plan = \
+                    self.__get_ngram_ids_and_query_plan(tokens)
+                rs_queries.append((ngram_ids, offsets, len(tokens), query_plan))
+        doc_set = self._to_document_set(documents)
+        return [
+            [CaptionIndex.Document(
+                id=doc_id, postings=CaptionIndex._PostingList(bin_data))
+             for doc_id, bin_data in result]
+            for result in self._rs_index.search_many(
+                rs_queries, _rs_document_set(doc_set), start_time, end_time)]
+
+    def cache_stats(self) -> Optional['CaptionIndex.CacheStats']:
+        """Statistics of the result cache (None if it is disabled)"""
+        return None if self._cache is None else self._cache.stats()
+
+    def clear_cache(self) -> None:
+        """Drop all cached results (e.g., after the index is updated)"""
+        if self._cache is not None:
+            self._cache.clear()
+
+    @__require_open_index
+    def warm(self, lexicons_only: bool = False, lock: bool = False) -> int:
+        """
+        Load the index into memory ahead of the first searches
+
+        Usage:
+            lexicons_only: only load the document lexicons and tables, which
+                           every search reads, and leave the postings on disk
+            lock: lock the loaded pages in memory (mlock), which may be
+                  limited by RLIMIT_MEMLOCK
+
+        Returns the number of bytes loaded.
+        """
+        return self._rs_index.warm(lexicons_only, lock)
+
+    @__require_open_index
+    def unlock(self) -> None:
+        """Release pages locked by warm(lock=True)"""
+        self._rs_index.unlock()
+
+    @__require_open_index
+    def advise(self, access: str) -> None:
+        """
+        Hint the expected access pattern of the index files to the OS
+
+        access: 'normal', 'random', 'sequential', or 'willneed'
+        """
+        self._rs_index.advise(access)
+
+    @__require_open_index
+    def resident_bytes(self) -> Tuple[int, int]:
+        """Bytes of the index that are in memory, and the total bytes"""
+        return self._rs_index.resident_bytes()
+
     def close(self) -> None:
         self._rs_index = None
+        self._cache = None
 
     # Internal helper methods
 
@@ -536,13 +1770,65 @@ class CaptionIndex(_BaseIndex):
         self.close()
 
     def __get_ngram_ids_and_query_plan(self, words):
-        ngram_word_ids = []
-        word_costs = []
-        for i, word in enumerate(words):
-            word = self._to_words(word)
-            ngram_word_ids.append([w.id for w in word])
-            word_costs.append((sum(w.count for w in word), i))
-        return ngram_word_ids, [w[1] for w in sorted(word_costs)]
+        # Each element of the ngram is a list of token ids at a word offset,
+        # with the number of postings as its cost
+        words = [self._to_words(w) for w in words]
+        elements = [([w.id for w in word], i, sum(w.count for w in word))
+                    for i, word in enumerate(words)]
+        if self._bigrams is not None:
+            elements = self.__cover_with_bigrams(words, elements)
+        ngram_ids = [e[0] for e in elements]
+        offsets = [e[1] for e in elements]
+        costs = sorted((e[2], i) for i, e in enumerate(elements))
+        return ngram_ids, offsets, [c[1] for c in costs]
+
+    def __cover_with_bigrams(self, words, elements):
+        def get_bigram(i):
+            if i < 0 or i + 1 >= len(words):
+                return None
+            if len(words[i]) != 1 or len(words[i + 1]) != 1:
+                return None
+            return self._bigrams.get(words[i][0].id, words[i + 1][0].id)
+
+        # Greedily replace pairs of adjacent words with indexed bigrams
+        result = []
+        i = 0
+        while i < len(elements):
+            bigram = get_bigram(i)
+            if bigram is not None:
+                result.append(([bigram.id], i, bigram.count))
+                i += 2
+            else:
+                # A leftover word may still be covered by a cheaper bigram
+                # that overlaps the previous word
+                bigram = get_bigram(i - 1)
+                if bigram is not None and bigram.count < elements[i][2]:
+                    result.append(([bigram.id], i - 1, bigram.count))
+                else:
+                    result.append(elements[i])
+                i += 1
+        return result
+
+    def __cache_key(self, words, window):
+        return (tuple(tuple(w.id for w in self._to_words(word))
+                      for word in words), window)
+
+    def __get_cached(self, words, doc_set, window, kinds):
+        if self._cache is None:
+            return None
+        return self._cache.get(self.__cache_key(words, window), doc_set, kinds)
+
+    def __case_fold_tokens(self, tokens):
+        """Replace each token with the words that match it ignoring case"""
+        result = []
+        for t in tokens:
+            ids = set()
+            for w in (t if isinstance(t, list) else [t]):
+                ids.update(self._lexicon.case_folds(w))
+            if len(ids) == 0:
+                raise Lexicon.WordDoesNotExist(t)
+            result.append(sorted(ids))
+        return result
 
     def __tokenize_text(self, text: str) -> List[str]:
         tokens = list(self.tokenizer().tokens(text.strip()))
@@ -551,6 +1837,26 @@ class CaptionIndex(_BaseIndex):
         return tokens
 
     def __unpack_rs_search(self, result) -> Generator:
+        # The Rust iterator yields a batch of documents at a time
+        for batch in result:
+            yield from self.__unpack_results(batch)
+
+    def __unpack_rs_search_into_cache(self, result, key, doc_set) -> Generator:
+        # Results are cached once they have all been consumed (and only if
+        # they fit in the cache)
+        cached = []
+        size = 0
+        for batch in result:
+            if cached is not None:
+                cached.extend(batch)
+                size += _ResultCache.search_size(batch)
+                if size > self._cache.max_bytes:
+                    cached = None
+            yield from self.__unpack_results(batch)
+        if cached is not None:
+            self._cache.put(key, doc_set, cached, _ResultCache.SEARCH)
+
+    def __unpack_results(self, result) -> Generator:
         for doc_id, bin_data in result:
             yield CaptionIndex.Document(
                 id=doc_id, postings=CaptionIndex._PostingList(bin_data))
@@ -564,6 +1870,15 @@ class CaptionIndex(_BaseIndex):
         def __len__(self):
             return int(len(self._bin_data) / 13)
 
+        @property
+        def array(self) -> np.ndarray:
+            """
+            Postings as a read-only structured array with fields start, end,
+            idx, and len. The array shares memory with the search result.
+            """
+            return np.frombuffer(self._bin_data,
+                                 dtype=CaptionIndex.POSTING_DTYPE)
+
         def __getitem__(self, i: int) -> 'CaptionIndex.Posting':
             if self._data is None:
                 self._data = self.__load()
@@ -586,6 +1901,202 @@ class CaptionIndex(_BaseIndex):
                     for p in struct.iter_unpack('<ffIB', self._bin_data)]
 
 
+def _check_limit(limit: Optional[int], after_doc_id: Optional[int]) -> None:
+    if limit is not None and limit < 0:
+        raise ValueError('limit must be non-negative')
+    if after_doc_id is not None and after_doc_id < 0:
+        raise ValueError('after_doc_id must be non-negative')
+
+
+def _rs_document_set(doc_set: Optional[DocumentSet]):
+    return None if doc_set is None else doc_set._rs_document_set
+
+
+def _check_time_window(start_time: float, end_time: float) -> None:
+    if start_time > end_time:
+        raise ValueError('start_time must not be after end_time')
+
+
+def _page_results(result, limit, after_doc_id):
+    """Apply a limit and after_doc_id to complete results"""
+    if after_doc_id is not None:
+        result = [x for x in result if x[0] > after_doc_id]
+    return result if limit is None else result[:limit]
+
+
+def _contains_result(
+        result: DocumentSet, documents
+) -> Union[Set[int], DocumentSet]:
+    """contains() returns a DocumentSet only if it was given one"""
+    return result if isinstance(documents, DocumentSet) else set(result)
+
+
+def _page_ids(ids, limit, after_doc_id):
+    """Apply a limit and after_doc_id to complete document ids"""
+    if after_doc_id is not None:
+        ids = (i for i in ids if i > after_doc_id)
+    return ids if limit is None else itertools.islice(ids, limit)
+
+
+class _ResultCache:
+    """
+    LRU cache of results, keyed by the kind of result, token ids, time
+    window, and the documents searched. Search results are lists of
+    (document id, encoded postings), and also answer contains() and count().
+    contains() and count() cache their own results too. A lookup for some
+    documents can also be served from the cached results for all documents.
+    """
+
+    # Kinds of results
+    SEARCH = 'search'
+    CONTAINS = 'contains'
+    COUNT = 'count'
+
+    # Approximate memory used by a cached document, besides its postings
+    DOCUMENT_OVERHEAD = 64
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @staticmethod
+    def search_size(result) -> int:
+        return sum(len(bin_data) + _ResultCache.DOCUMENT_OVERHEAD
+                   for _, bin_data in result)
+
+    def get(self, ngram, doc_set: Optional[DocumentSet], kinds):
+        """Returns the first cached (kind, result) of the kinds, if any"""
+        with self._lock:
+            for kind in kinds:
+                result = self.__lookup((kind, ngram, doc_set))
+                if result is None and doc_set is not None:
+                    all_result = self.__lookup((kind, ngram, None))
+                    if all_result is not None:
+                        result = _ResultCache.__restrict(
+                            kind, all_result, doc_set)
+                if result is not None:
+                    self._hits += 1
+                    return kind, result
+            self._misses += 1
+            return None
+
+    def put(self, ngram, doc_set: Optional[DocumentSet], result,
+            kind: str) -> None:
+        if kind == _ResultCache.SEARCH:
+            size = _ResultCache.search_size(result)
+        elif kind == _ResultCache.CONTAINS:
+            size = _ResultCache.DOCUMENT_OVERHEAD + 8 * len(result)
+        else:
+            size = _ResultCache.DOCUMENT_OVERHEAD * (1 + len(result.documents))
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            key = (kind, ngram, doc_set)
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> 'CaptionIndex.CacheStats':
+        with self._lock:
+            return CaptionIndex.CacheStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions, entries=len(self._entries),
+                bytes=self._bytes)
+
+    def __lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    @staticmethod
+    def __restrict(kind: str, result, doc_set: DocumentSet):
+        """Restrict a result for all documents to some documents"""
+        if kind == _ResultCache.SEARCH:
+            return [x for x in result if x[0] in doc_set]
+        elif kind == _ResultCache.CONTAINS:
+            return result & doc_set
+        counts = {doc_id: n for doc_id, n in result.documents.items()
+                  if doc_id in doc_set}
+        return CaptionIndex.Count(total=sum(counts.values()), documents=counts)
+
+
+class _DocumentPool:
+    """
+    LRU pool of open document handles, bounded by the number of handles and
+    their mapped bytes. Handles are dropped (and unmapped once unused) when
+    they are evicted.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int]):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, doc_id: int) -> Optional[DocumentData]:
+        with self._lock:
+            handle = self._entries.get(doc_id)
+            if handle is None:
+                self._misses += 1
+            else:
+                self._entries.move_to_end(doc_id)
+                self._hits += 1
+            return handle
+
+    def put(self, doc_id: int, handle: DocumentData) -> None:
+        size = handle.size
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+        with self._lock:
+            if doc_id in self._entries:
+                self._bytes -= self._entries.pop(doc_id).size
+            self._entries[doc_id] = handle
+            self._bytes += size
+            while len(self._entries) > self._max_entries or (
+                    self._max_bytes is not None
+                    and self._bytes > self._max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> 'Documents.PoolStats':
+        with self._lock:
+            return Documents.PoolStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions, entries=len(self._entries),
+                bytes=self._bytes)
+
+
 class BinaryFormat(NamedTuple):
     """
     Defines the number of bytes to use when encoding data
@@ -10,6 +10,22 @@ Query Expansion: [] brackets
   [the ducks]           "the ducks" or "the duck".
                         Equivalent to ("the duck" | "the ducks").
 
+Wildcards: * and ?
+  immigr*               any word starting with "immigr"
+  wom?n                 "woman", "women", ...
+                        * matches any characters and ? matches one. A
+                        wildcard may expand to at most max_expansions words
+                        (a Query option). A ? that is not followed by a
+                        letter or digit (e.g., "sure?"), and a * or ? on
+                        its own, are punctuation and not wildcards.
+
+Fuzzy words: ~
+  imigrant~             words within one edit of "imigrant"
+  imigrant~2            words within two edits of "imigrant"
+                        An edit inserts, deletes, or substitutes a
+                        character. Fuzzy words are also limited to
+                        max_expansions words.
+
 Expressions:
   An expression can be:
     - a phrase  (e.g., "the ducks")
@@ -72,12 +88,13 @@ Groups: ()
 """
 
 import heapq
+import itertools
 from abc import ABC, abstractmethod, abstractproperty
 from collections import deque
 from typing import Dict, List, Iterable, NamedTuple, Optional
 from parsimonious.grammar import Grammar, NodeVisitor
 
-from .index import Lexicon, CaptionIndex
+from .index import Lexicon, CaptionIndex, DocumentSet
 from .tokenize import default_tokenizer
 from .util import PostingUtil, group_results_by_document
 
@@ -110,7 +127,10 @@ GRAMMAR = Grammar(r"""
     tokens = token more_tokens
     more_tokens = (sp token)*
 
-    token = ~r"[^\s()&|\\\[\]:/]+"
+    token = fuzzy / wildcard / word
+    fuzzy = ~r"[^\s()&|\\\[\]:/~*?]+~\d?(?![^\s()&|\\\[\]:/])"
+    wildcard = ~r"(?=[^\s()&|\\\[\]:/]*(?:\w\*|\*\w|\?\w))[^\s()&|\\\[\]:/]+"
+    word = ~r"[^\s()&|\\\[\]:/]+"
 
     sp = ~r"\s+"
 """)
@@ -123,6 +143,11 @@ class _Expr(ABC):
         index: CaptionIndex
         documents: Optional[Iterable[CaptionIndex.DocIdOrDocument]]
         ignore_word_not_found: bool
+        limit: Optional[int] = None           # Max number of documents
+        after_doc_id: Optional[int] = None    # Only documents after this id
+        start_time: float = 0.                # Only phrases in this window
+        end_time: float = float('inf')
+        ignore_case: bool = False             # Match words in any case
 
     @abstractmethod
     def eval(self, context: '_Expr.Context') -> Iterable[CaptionIndex.Document]:
@@ -140,6 +165,31 @@ class _Expr(ABC):
         return repr(self._pprint_data)
 
 
+def _limit_results(results, limit):
+    return results if limit is None else itertools.islice(results, limit)
+
+
+def _batch_results(results, limit):
+    """
+    Split results into lists of documents. With a limit, the batches start at
+    the limit and double in size, so that expressions which filter documents
+    only evaluate their other children on as many documents as needed.
+    """
+    if limit is None:
+        batch = list(results)
+        if len(batch) > 0:
+            yield batch
+        return
+    results = iter(results)
+    batch_size = max(limit, 1)
+    while True:
+        batch = list(itertools.islice(results, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+        batch_size *= 2
+
+
 class _JoinExpr(_Expr):
 
     def __init__(self, children, threshold, threshold_type):
@@ -157,33 +207,48 @@ class _Phrase(_Expr):
     class Token(NamedTuple):
         text: str
         expand: bool
+        wildcard: bool = False
+        fuzzy: int = 0          # Max edit distance
 
-    def __init__(self, tokens):
+    def __init__(self, tokens, max_expansions):
         assert all(isinstance(t, _Phrase.Token) for t in tokens)
         self.tokens = tokens
+        self.max_expansions = max_expansions
 
     @property
     def _pprint_data(self):
         return {
             '1. op': 'Phrase',
             '2. tokens': ' '.join([
-                '[{}]'.format(t.text) if t.expand else t.text
+                '[{}]'.format(t.text) if t.expand else
+                '{}~{}'.format(t.text, t.fuzzy) if t.fuzzy > 0 else t.text
                 for t in self.tokens])
         }
 
     def eval(self, context):
-        kwargs = {}
+        kwargs = {'limit': context.limit,
+                  'after_doc_id': context.after_doc_id,
+                  'start_time': context.start_time,
+                  'end_time': context.end_time}
         if context.documents is not None:
             kwargs['documents'] = context.documents
 
         ngram_tokens = []
         for t in self.tokens:
-            if t.expand:
-                tokens = [context.lexicon[x] for x in
-                          context.lexicon.similar(t.text)]
+            if t.expand or t.wildcard or t.fuzzy > 0:
+                tokens = self.__expand(context.lexicon, t)
                 if len(tokens) == 0:
                     return
                 ngram_tokens.append(tokens)
+            elif context.ignore_case:
+                tokens = [context.lexicon[x] for x in
+                          context.lexicon.case_folds(t.text)]
+                if len(tokens) == 0:
+                    if context.ignore_word_not_found:
+                        return
+                    else:
+                        raise Lexicon.WordDoesNotExist(t.text)
+                ngram_tokens.append(tokens)
             else:
                 try:
                     token = context.lexicon[t.text]
@@ -204,9 +269,8 @@ class _Phrase(_Expr):
         min_token_count = lexicon.word_count
         for t in self.tokens:
             token_count = 0
-            if t.expand:
-                tokens = [lexicon[x] for x in
-                          lexicon.similar(t.text)]
+            if t.expand or t.wildcard or t.fuzzy > 0:
+                tokens = self.__expand(lexicon, t)
                 token_count += sum(x.count for x in tokens)
             else:
                 try:
@@ -217,6 +281,20 @@ class _Phrase(_Expr):
             min_token_count = min(token_count, min_token_count)
         return min_token_count / lexicon.word_count
 
+    def __expand(self, lexicon, t):
+        # Wildcards and fuzzy words are not lemmatized, even in brackets
+        if t.wildcard or t.fuzzy > 0:
+            if t.wildcard:
+                ids = lexicon.wildcard(t.text, self.max_expansions + 1)
+            else:
+                ids = lexicon.fuzzy(t.text, t.fuzzy, self.max_expansions + 1)
+            if len(ids) > self.max_expansions:
+                raise ValueError('{} matches more than {} words'.format(
+                    t.text, self.max_expansions))
+        else:
+            ids = lexicon.similar(t.text)
+        return [lexicon[x] for x in ids]
+
 
 def _dist_time_posting(p1, p2):
     return (
@@ -243,14 +321,25 @@ class _And(_JoinExpr):
         }
 
     def eval(self, context):
-        results = []
-        for c in self.children:
+        # Documents without a match are dropped, so the limit is applied to
+        # the merged results rather than to the children
+        child_context = context._replace(limit=None)
+        child0_results = self.children[0].eval(child_context)
+        return _limit_results(
+            (d for batch in _batch_results(child0_results, context.limit)
+             for d in self.__eval_batch(child_context, batch)),
+            context.limit)
+
+    def __eval_batch(self, context, child0_results):
+        doc_ids = DocumentSet(d.id for d in child0_results)
+        results = [{d.id: d.postings for d in child0_results}]
+        for c in self.children[1:]:
+            context = context._replace(documents=doc_ids)
             child_results = deque(c.eval(context))
             if len(child_results) == 0:
                 return
 
-            doc_ids = [d.id for d in child_results]
-            context = context._replace(documents=doc_ids)
+            doc_ids = DocumentSet(d.id for d in child_results)
             results.append({d.id: d.postings for d in child_results})
 
         dist_fn = (
@@ -258,7 +347,7 @@ class _And(_JoinExpr):
             _dist_idx_posting)
 
         n = len(results)
-        for doc_id in sorted(doc_ids):
+        for doc_id in doc_ids:
             pq = []
             for i, r in enumerate(results):
                 assert doc_id in r
@@ -317,12 +406,14 @@ class _Or(_JoinExpr):
         }
 
     def eval(self, context):
+        # The first n documents of the union are among the first n documents
+        # of the children, so the limit can be passed down
         results = [c.eval(context) for c in self.children]
-        for doc_id, grouped_postings in group_results_by_document(results):
-            yield CaptionIndex.Document(
-                id=doc_id,
-                postings=PostingUtil.union(grouped_postings)
-            )
+        return _limit_results((
+            CaptionIndex.Document(
+                id=doc_id, postings=PostingUtil.union(grouped_postings))
+            for doc_id, grouped_postings in group_results_by_document(results)
+        ), context.limit)
 
 
 class _Not(_JoinExpr):
@@ -338,10 +429,20 @@ class _Not(_JoinExpr):
         }
 
     def eval(self, context):
-        child0_results = list(self.children[0].eval(context))
-
+        # Documents without a match are dropped, so the limit is applied to
+        # the filtered results rather than to the children
+        child_context = context._replace(limit=None)
+        child0_results = self.children[0].eval(child_context)
+        return _limit_results(
+            (d for batch in _batch_results(child0_results, context.limit)
+             for d in self.__eval_batch(child_context, batch)),
+            context.limit)
+
+    def __eval_batch(self, context, child0_results):
+        # Phrases outside of the time window still exclude nearby results
         other_context = context._replace(
-            documents=[d.id for d in child0_results])
+            documents=DocumentSet(d.id for d in child0_results),
+            start_time=0., end_time=float('inf'))
         other_results = [c.eval(other_context) for c in self.children[1:]]
         other_postings = {
             doc_id: PostingUtil.union(ps_lists)
@@ -385,6 +486,7 @@ class _Not(_JoinExpr):
 
 DEFAULT_AND_THRESH = 15
 DEFAULT_NOT_THRESH = 15
+DEFAULT_MAX_EXPANSIONS = 1000
 
 
 class _QueryParser(NodeVisitor):
@@ -457,7 +559,8 @@ class _QueryParser(NodeVisitor):
 
     def visit_tokens_root(self, node, children):
         assert len(children) == 2
-        return _Phrase([*children[0], *children[1]])
+        return _Phrase([*children[0], *children[1]], self._constants.get(
+            'max_expansions', DEFAULT_MAX_EXPANSIONS))
 
     def visit_more_tokens_root(self, node, children):
         return [l for c in children for l in c]
@@ -475,6 +578,17 @@ class _QueryParser(NodeVisitor):
         return [*children[0], *[t for c in children[1] for t in c]]
 
     def visit_token(self, node, children):
+        assert len(children) == 1
+        return children[0]
+
+    def visit_fuzzy(self, node, children):
+        text, dist = node.text.rsplit('~', 1)
+        return [_Phrase.Token(text, False, fuzzy=int(dist) if dist else 1)]
+
+    def visit_wildcard(self, node, children):
+        return [_Phrase.Token(node.text, False, True)]
+
+    def visit_word(self, node, children):
         tokenizer = default_tokenizer()
         tokens = tokenizer.tokens(node.text)
         return [_Phrase.Token(t, False) for t in tokens]
@@ -491,10 +605,22 @@ class Query:
 
     def execute(
         self, lexicon: Lexicon, index: CaptionIndex, documents=None,
-        ignore_word_not_found=True
+        ignore_word_not_found=True, limit: Optional[int] = None,
+        after_doc_id: Optional[int] = None, start_time: float = 0.,
+        end_time: float = float('inf'), ignore_case: bool = False
     ) -> Iterable[CaptionIndex.Document]:
+        """
+        Evaluate the query. Results are in document id order, so the next
+        page of at most limit documents starts after the last id returned.
+        Only phrases that lie between start_time and end_time (in seconds)
+        are matched. With ignore_case, words match words that differ only in
+        case (wildcards and fuzzy words are still matched as written).
+        """
+        # Convert the documents once rather than in every phrase search
+        documents = index._to_document_set(documents)
         return self._tree.eval(_Expr.Context(
-            lexicon, index, documents, ignore_word_not_found))
+            lexicon, index, documents, ignore_word_not_found, limit,
+            after_doc_id, start_time, end_time, ignore_case))
 
     def estimate_cost(self, lexicon: Lexicon) -> float:
         return self._tree.estimate_cost(lexicon)
@@ -130,6 +130,17 @@ class PostingUtil(object):
 
         return [r[1] for r in heapq.merge(*postings_lists_with_priority)]
 
+    @staticmethod
+    def to_array(postings: Iterable[CaptionIndex.Posting]) -> np.ndarray:
+        """
+        Convert postings to a structured array with CaptionIndex.POSTING_DTYPE.
+        Postings from CaptionIndex searches are not copied.
+        """
+        if isinstance(postings, CaptionIndex._PostingList):
+            return postings.array
+        return np.array([tuple(p) for p in postings],
+                        dtype=CaptionIndex.POSTING_DTYPE)
+
 
 def group_results_by_document(
         results: List[Iterable[CaptionIndex.Document]]
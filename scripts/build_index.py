@@ -6,6 +6,7 @@ Index a directory of transcript files.
 This will produce:
  - document list
  - a lexicon
+ - bigrams with their own postings (if --bigrams is passed)
  - index (one or more files depending on chunk size)
  - intervals and tokens (in binary format)
 """
@@ -16,11 +17,12 @@ import shutil
 from collections import defaultdict
 from typing import List, Optional
 
-from captions import Lexicon, Documents
+from captions import Lexicon, Documents, Bigrams
 
 from lib.common import (
     DocumentToIndex, read_docs_from_stdin, list_docs,
-    get_word_counts, index_documents)
+    get_word_counts, get_bigrams, index_documents, index_sidecar_paths,
+    pack_document_data)
 
 DEFAULT_OUT_DIR = 'out'
 
@@ -33,6 +35,17 @@ def get_args():
                    help='Output directory. Default: {}'.format(DEFAULT_OUT_DIR))
     p.add_argument('--chunk-size', dest='chunk_size', type=int,
                    help='Break the index into chunks of n documents')
+    p.add_argument('--compress', action='store_true',
+                   help='Delta encode the postings as varints')
+    p.add_argument('--bigrams', dest='num_bigrams', type=int, default=0,
+                   help='Index postings for the n most frequent bigrams of '
+                        'common words. Default: 0')
+    p.add_argument('--hash-lexicons', action='store_true',
+                   help='Write hash tables of the document lexicons for '
+                        'faster token lookups')
+    p.add_argument('--pack', action='store_true',
+                   help='Store the document data in a single packed file '
+                        'instead of one file per document')
     return p.parse_args()
 
 
@@ -43,6 +56,9 @@ def index_all_docs(
         index_out_path: str,
         data_out_dir: str,
         chunk_size: Optional[int],
+        compress: bool = False,
+        bigrams: Optional[Bigrams] = None,
+        hash_lexicons: bool = False
 ):
     """Builds inverted indexes and reencode documents in binary"""
     assert len(docs_to_index) == len(documents)
@@ -68,7 +84,9 @@ def index_all_docs(
         index_and_doc_paths[doc_index_out_path].append(
             (doc.id, doc_to_index.path, doc_data_out_path))
 
-    index_documents(list(index_and_doc_paths.items()), lexicon)
+    index_documents(list(index_and_doc_paths.items()), lexicon,
+                    compressed=compress, bigrams=bigrams,
+                    hash_lexicons=hash_lexicons)
 
 
 def build_lexicon(
@@ -95,9 +113,14 @@ def remove_if_exists(fpath):
 
 def main(
         out_dir: str, doc_dir: Optional[str],
-        chunk_size: Optional[int] = None
+        chunk_size: Optional[int] = None,
+        compress: bool = False,
+        num_bigrams: int = 0,
+        hash_lexicons: bool = False,
+        pack: bool = False
 ):
     assert chunk_size is None or chunk_size > 0
+    assert num_bigrams >= 0
 
     # Load document names
     if doc_dir:
@@ -114,6 +137,28 @@ def main(
         assert os.path.exists(lex_path), 'Missing: {}'.format(lex_path)
     else:
         lexicon = Lexicon.load(lex_path)
+    lex_bin_path = os.path.join(out_dir, 'lexicon.bin')
+    print('Storing binary lexicon: {}'.format(lex_bin_path))
+    lexicon.store_binary(lex_bin_path)
+    lemmas_path = os.path.join(out_dir, 'lemmas.bin')
+    print('Storing lemmas: {}'.format(lemmas_path))
+    lexicon.store_lemmas(lemmas_path)
+    case_folds_path = os.path.join(out_dir, 'casefolds.bin')
+    print('Storing case folds: {}'.format(case_folds_path))
+    lexicon.store_case_folds(case_folds_path)
+    trigrams_path = os.path.join(out_dir, 'trigrams.bin')
+    print('Storing trigrams: {}'.format(trigrams_path))
+    lexicon.store_trigrams(trigrams_path)
+
+    # Select the bigrams to index
+    bigrams_path = os.path.join(out_dir, 'bigrams.txt')
+    remove_if_exists(bigrams_path)
+    if num_bigrams > 0:
+        bigrams = get_bigrams(docs_to_index, lexicon, num_bigrams)
+        print('Storing bigrams: {}'.format(bigrams_path))
+        bigrams.store(bigrams_path)
+    else:
+        bigrams = None
 
     # Build and store the document list
     docs_path = os.path.join(out_dir, 'documents.txt')
@@ -129,11 +174,16 @@ def main(
     index_path = os.path.join(out_dir, 'index.bin')
     data_dir = os.path.join(out_dir, 'data')
     remove_if_exists(index_path)
+    for sidecar_path in index_sidecar_paths(index_path):
+        remove_if_exists(sidecar_path)
     remove_if_exists(data_dir)
 
     os.makedirs(data_dir)
     index_all_docs(docs_to_index, documents, lexicon, index_path, data_dir,
-                   chunk_size)
+                   chunk_size, compress, bigrams, hash_lexicons)
+    if pack and len(documents) > 0:
+        pack_path = pack_document_data(data_dir, 0, len(documents))
+        print('Packed document data: {}'.format(pack_path))
 
     assert os.path.exists(index_path), 'Missing: {}'.format(index_path)
     print('Done!')
@@ -3,12 +3,18 @@ import sys
 from subprocess import check_call
 from typing import List, Dict, NamedTuple, Optional
 
-from captions import BinaryFormat, Lexicon, Documents
+from captions import BinaryFormat, Lexicon, Documents, Bigrams
 from captions.rs_captions import indexer
 
 BINARY_FORMAT = BinaryFormat()
 MAX_WORD_LEN = 20
 
+# Number of most frequent words considered when selecting bigrams to index
+MAX_BIGRAM_WORDS = 1000
+
+# Files written by the indexer alongside each index file
+INDEX_SIDECAR_EXTS = ['.df', '.docs', '.hash']
+
 STDIN_DELIM = '\t'
 
 
@@ -33,6 +39,10 @@ def read_docs_from_stdin() -> List[DocumentToIndex]:
     return result
 
 
+def index_sidecar_paths(index_path: str) -> List[str]:
+    return [index_path + ext for ext in INDEX_SIDECAR_EXTS]
+
+
 def merge_files(
         paths: List[str], out_path: str,
         batch_size: int = 1000, keep_tmp_files: bool = False
@@ -60,11 +70,63 @@ def get_word_counts(
     return words
 
 
+def get_bigrams(
+        docs_to_index: List[DocumentToIndex],
+        lexicon: Lexicon,
+        num_bigrams: int,
+        binary_format: BinaryFormat = BINARY_FORMAT,
+        batch_size: Optional[int] = None
+) -> Bigrams:
+    if batch_size is None:
+        batch_size = int(len(docs_to_index) / 10 / os.cpu_count())
+        batch_size = min(max(batch_size, 1), 1000)
+    assert batch_size > 0
+    frequent_words = sorted(lexicon, key=lambda w: -w.count)[:MAX_BIGRAM_WORDS]
+    doc_paths = [d.path for d in docs_to_index]
+    counts = indexer.count_bigrams(
+        doc_paths, {w.token: w.id for w in frequent_words}, batch_size, True)
+    top_bigrams = sorted(counts.items(), key=lambda x: -x[1])[:num_bigrams]
+
+    # Bigram ids count down from the largest datum value, which is reserved
+    # for unknown tokens
+    max_bigram_id = 2 ** (8 * binary_format.datum_bytes) - 2
+    assert len(lexicon) <= max_bigram_id - len(top_bigrams), \
+        'Not enough token ids for bigrams'
+    bigrams = Bigrams([
+        Bigrams.Bigram(id=max_bigram_id - i, first=first, second=second,
+                       count=count)
+        for i, ((first, second), count) in enumerate(top_bigrams)
+    ])
+    print('Bigrams: {}'.format(len(bigrams)))
+    return bigrams
+
+
 def index_documents(
         index_and_doc_paths, lexicon: Lexicon,
-        binary_format: BinaryFormat = BINARY_FORMAT
+        binary_format: BinaryFormat = BINARY_FORMAT,
+        compressed: bool = False,
+        bigrams: Optional[Bigrams] = None,
+        hash_lexicons: bool = False
 ):
     indexer.index_documents(
-        index_and_doc_paths, {w.token: w.id for w in lexicon}, True,
-        binary_format.datum_bytes, binary_format.start_time_bytes,
-        binary_format.end_time_bytes)
+        index_and_doc_paths, {w.token: w.id for w in lexicon},
+        {} if bigrams is None else {
+            (b.first, b.second): b.id for b in bigrams},
+        True, binary_format.datum_bytes, binary_format.start_time_bytes,
+        binary_format.end_time_bytes, compressed, hash_lexicons)
+
+
+def pack_document_data(data_dir: str, first_id: int, end_id: int) -> str:
+    """
+    Pack the data of documents [first_id, end_id) into a single segment
+    file, removing the per-document files, and add it to the manifest
+    """
+    pack_path = os.path.join(
+        data_dir, '{:07d}-{:07d}.pack'.format(first_id, end_id))
+    indexer.pack_documents(
+        [os.path.join(data_dir, '{}.bin'.format(i))
+         for i in range(first_id, end_id)],
+        first_id, pack_path, True)
+    with open(os.path.join(data_dir, Documents.PACK_MANIFEST), 'a') as fp:
+        fp.write(os.path.basename(pack_path) + '\n')
+    return pack_path
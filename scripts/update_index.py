@@ -15,11 +15,12 @@ from collections import defaultdict
 import shutil
 from typing import List, Optional
 
-from captions import Lexicon, Documents
+from captions import Lexicon, Documents, Bigrams
 
 from lib.common import (
     DocumentToIndex, read_docs_from_stdin, list_docs,
-    merge_files, get_word_counts, index_documents)
+    merge_files, get_word_counts, index_documents, index_sidecar_paths,
+    pack_document_data)
 
 
 def get_args():
@@ -32,6 +33,14 @@ def get_args():
                    help='Break the index into chunks of n documents')
     p.add_argument('--skip-existing-names', action='store_true',
                    help='Skip documents that are already indexed')
+    p.add_argument('--compress', action='store_true',
+                   help='Delta encode the postings of the new documents as varints')
+    p.add_argument('--hash-lexicons', action='store_true',
+                   help='Write hash tables of the new document lexicons for '
+                        'faster token lookups')
+    p.add_argument('--pack', action='store_true',
+                   help='Store the data of the new documents in a single '
+                        'packed file instead of one file per document')
     return p.parse_args()
 
 
@@ -41,7 +50,10 @@ def index_new_docs(
         lexicon: Lexicon,
         index_dir: str,
         data_dir: str,
-        chunk_size: Optional[int]
+        chunk_size: Optional[int],
+        compress: bool = False,
+        bigrams: Optional[Bigrams] = None,
+        hash_lexicons: bool = False
 ):
     """Builds inverted indexes and reencode documents in binary"""
     assert len(new_docs_to_index) == len(new_documents)
@@ -70,22 +82,32 @@ def index_new_docs(
         index_and_doc_paths[doc_index_out_path].append(
             (doc.id, doc_to_index.path, doc_data_out_path))
 
-    index_documents(list(index_and_doc_paths.items()), lexicon)
+    index_documents(list(index_and_doc_paths.items()), lexicon,
+                    compressed=compress, bigrams=bigrams,
+                    hash_lexicons=hash_lexicons)
 
 
 def main(
         index_dir: str,
         new_doc_dir: Optional[str],
         chunk_size: Optional[int] = None,
-        skip_existing_names: bool = False
+        skip_existing_names: bool = False,
+        compress: bool = False,
+        hash_lexicons: bool = False,
+        pack: bool = False
 ):
     assert chunk_size is None or chunk_size > 0
     doc_path = os.path.join(index_dir, 'documents.txt')
     lex_path = os.path.join(index_dir, 'lexicon.txt')
+    bigrams_path = os.path.join(index_dir, 'bigrams.txt')
     index_path = os.path.join(index_dir, 'index.bin')
 
     old_lexicon = Lexicon.load(lex_path)
 
+    # The new documents must index the same bigrams as the old ones
+    bigrams = Bigrams.load(bigrams_path) \
+        if os.path.isfile(bigrams_path) else None
+
     documents = Documents.load(doc_path)
 
     if new_doc_dir:
@@ -121,6 +143,9 @@ def main(
             lexicon_words.append(
                 Lexicon.Word(len(lexicon_words), w, new_word_counts[w]))
     lexicon = Lexicon(lexicon_words)
+    if bigrams is not None and len(bigrams) > 0:
+        assert len(lexicon) <= min(b.id for b in bigrams), \
+            'New words collide with bigram ids'
 
     base_doc_id = len(documents)
     new_documents = [Documents.Document(id=i + base_doc_id, name=d.name)
@@ -131,15 +156,25 @@ def main(
         tmp_index_path = index_path + '.tmp'
         shutil.move(index_path, tmp_index_path)
         os.makedirs(index_path)
-        shutil.move(
-            tmp_index_path,
-            os.path.join(index_path, '{:07d}-{:07d}.bin'.format(
-                0, base_doc_id)))
+        chunk_path = os.path.join(index_path, '{:07d}-{:07d}.bin'.format(
+            0, base_doc_id))
+        shutil.move(tmp_index_path, chunk_path)
+        for sidecar_path, chunk_sidecar_path in zip(
+                index_sidecar_paths(index_path),
+                index_sidecar_paths(chunk_path)
+        ):
+            if os.path.isfile(sidecar_path):
+                shutil.move(sidecar_path, chunk_sidecar_path)
     assert os.path.isdir(index_path)
 
     # Index the new documents
+    data_dir = os.path.join(index_dir, 'data')
     index_new_docs(new_docs_to_index, new_documents, lexicon, index_path,
-                   os.path.join(index_dir, 'data'), chunk_size)
+                   data_dir, chunk_size, compress, bigrams, hash_lexicons)
+    if pack:
+        pack_path = pack_document_data(
+            data_dir, base_doc_id, base_doc_id + len(new_documents))
+        print('Packed document data: {}'.format(pack_path))
 
     # Write out the new documents file
     shutil.move(doc_path, doc_path + '.old')
@@ -149,6 +184,10 @@ def main(
 
     # Update to the new lexicon
     lexicon.store(lex_path)
+    lexicon.store_binary(os.path.join(index_dir, 'lexicon.bin'))
+    lexicon.store_lemmas(os.path.join(index_dir, 'lemmas.bin'))
+    lexicon.store_case_folds(os.path.join(index_dir, 'casefolds.bin'))
+    lexicon.store_trigrams(os.path.join(index_dir, 'trigrams.bin'))
 
     print('Done!')
 
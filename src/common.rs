@@ -1,8 +1,12 @@
 
+use std::cmp;
 use std::mem;
+use std::io;
 use std::io::Cursor;
+use std::ptr;
 use byteorder::{ReadBytesExt, LittleEndian};
 use memmap::Mmap;
+use libc;
 
 pub type DocumentId = u32;
 pub type TokenId = u32;
@@ -11,6 +15,119 @@ pub type Seconds = f32;
 pub type Millis = u32;
 pub type Position = u32;
 
+// Files written alongside each index file, named <index file><ext>
+pub const DOC_FREQ_INDEX_EXT: &'static str = ".df";
+pub const DOC_TABLE_EXT: &'static str = ".docs";
+pub const LEXICON_HASH_EXT: &'static str = ".hash";
+pub const INDEX_SIDECAR_EXTS: &'static [&'static str] = &[
+    DOC_FREQ_INDEX_EXT, DOC_TABLE_EXT, LEXICON_HASH_EXT];
+
+// Document frequency index format: magic, version, and token count, followed
+// by (token, index of its first document id) sorted by token, and then the
+// sorted document ids of each token. Older files start at the token count.
+pub const DOC_FREQ_MAGIC: u32 = 0x46444943;  // "CIDF"
+pub const DOC_FREQ_VERSION: u32 = 1;
+pub const DOC_FREQ_HEADER_SIZE: usize = 12;
+pub const DOC_FREQ_HEADER_SIZE_NO_MAGIC: usize = 4;
+
+// Document table format: magic, version, and document count, followed by
+// (doc id, byte offset, unique token count, posting count) sorted by id
+pub const DOC_TABLE_MAGIC: u32 = 0x58444943;  // "CIDX"
+pub const DOC_TABLE_VERSION: u32 = 1;
+pub const DOC_TABLE_HEADER_SIZE: usize = 12;
+pub const DOC_TABLE_ENTRY_SIZE: usize = 20;
+
+// Lexicon hash format: magic, version, and document count, followed by
+// (doc id, byte offset, slot count) sorted by id, and then the hash table of
+// each document. A slot holds a token and its index in the document lexicon,
+// and empty slots hold EMPTY_HASH_SLOT as the token.
+pub const LEXICON_HASH_MAGIC: u32 = 0x48584943;  // "CIXH"
+pub const LEXICON_HASH_VERSION: u32 = 1;
+pub const LEXICON_HASH_HEADER_SIZE: usize = 12;
+pub const LEXICON_HASH_ENTRY_SIZE: usize = 16;
+pub const LEXICON_HASH_SLOT_SIZE: usize = 8;
+pub const EMPTY_HASH_SLOT: u32 = 0xFFFFFFFF;
+
+// Packed document data format: magic, version, first document id, and
+// document count, followed by the byte offset of each document (and of the
+// end) from the start of the documents, and then the documents in id order
+pub const DOC_PACK_MAGIC: u32 = 0x50444943;  // "CIDP"
+pub const DOC_PACK_VERSION: u32 = 1;
+pub const DOC_PACK_HEADER_SIZE: usize = 16;
+
+// Compressed index files start with a magic number, format version, and skip
+// interval. Uncompressed index files have no header and start with a document.
+pub const INDEX_MAGIC: u32 = 0x5A584943;  // "CIXZ"
+pub const INDEX_VERSION_COMPRESSED: u32 = 3;
+pub const INDEX_HEADER_SIZE: usize = 12;
+
+// Version 2 compressed index files have no skip interval or skip pointers
+pub const INDEX_VERSION_COMPRESSED_NO_SKIPS: u32 = 2;
+pub const INDEX_HEADER_SIZE_NO_SKIPS: usize = 8;
+
+// Number of postings between skip pointers in compressed posting lists
+pub const POSTING_SKIP_INTERVAL: usize = 64;
+
+// Skip pointer: position and start time of the posting before the block, and
+// byte offset of the block from the first posting in the list
+pub const SKIP_ENTRY_SIZE: usize = 12;
+
+// Encoding of the document lexicons and postings in an index file
+#[derive(Copy, Clone, PartialEq, Debug)]
+pub enum PostingFormat {
+    // Header: doc id, unique token count, posting count
+    // Lexicon: (token, posting index)
+    // Postings: (start, end - start, position), fixed width
+    Fixed,
+
+    // Header: doc id, unique token count, posting count, posting byte count
+    // Lexicon: (token, posting index, posting byte offset as u32)
+    // Postings: varints of (position delta, zigzag start delta, end - start),
+    // with deltas taken within each token's posting list. Lists longer than
+    // skip_interval are preceded by a skip pointer for every later block of
+    // skip_interval postings (0 means no skip pointers).
+    Varint { skip_interval: usize }
+}
+
+impl PostingFormat {
+
+    pub fn lexicon_offset(&self) -> usize {
+        match self {
+            PostingFormat::Fixed => 3 * mem::size_of::<u32>(),
+            PostingFormat::Varint { .. } => 4 * mem::size_of::<u32>()
+        }
+    }
+
+    pub fn lexicon_entry_size(&self, datum_size: usize) -> usize {
+        match self {
+            PostingFormat::Fixed => 2 * datum_size,
+            PostingFormat::Varint { .. } => 2 * datum_size + mem::size_of::<u32>()
+        }
+    }
+
+    // Number of skip pointers before a posting list of length n
+    pub fn skip_count(&self, n: usize) -> usize {
+        match self {
+            PostingFormat::Varint { skip_interval } if *skip_interval > 0 && n > *skip_interval => {
+                (n - 1) / skip_interval
+            },
+            _ => 0
+        }
+    }
+}
+
+// Number of hash table slots for a lexicon of n tokens, keeping the table at
+// most 2/3 full
+pub fn lexicon_hash_slot_count(n: usize) -> usize {
+    n + n / 2 + 1
+}
+
+// First slot to probe for a token (Fibonacci hashing, scaled to slot_count)
+#[inline]
+pub fn lexicon_hash_slot(token: TokenId, slot_count: usize) -> usize {
+    let h = token.wrapping_mul(0x9E3779B9) as u64;
+    ((h * slot_count as u64) >> 32) as usize
+}
 
 #[inline]
 pub fn ms_to_s(ms: Millis) -> Seconds {
@@ -28,6 +145,37 @@ pub fn read_mmap_u32(m: &Mmap, i: usize) -> u32 {
     rdr.read_u32::<LittleEndian>().unwrap()
 }
 
+#[inline]
+pub fn read_mmap_u64(m: &Mmap, i: usize) -> u64 {
+    let mut rdr = Cursor::new(&m[i..i + mem::size_of::<u64>()]);
+    rdr.read_u64::<LittleEndian>().unwrap()
+}
+
+// Returns the value and the number of bytes read
+#[inline]
+pub fn read_mmap_varint(m: &Mmap, i: usize) -> (u64, usize) {
+    let mut result = 0u64;
+    let mut j = 0;
+    loop {
+        let b = m[i + j];
+        result |= ((b & 0x7f) as u64) << (7 * j);
+        j += 1;
+        if b & 0x80 == 0 {
+            return (result, j);
+        }
+    }
+}
+
+#[inline]
+pub fn zigzag_encode(v: i64) -> u64 {
+    ((v << 1) ^ (v >> 63)) as u64
+}
+
+#[inline]
+pub fn zigzag_decode(v: u64) -> i64 {
+    ((v >> 1) as i64) ^ -((v & 1) as i64)
+}
+
 #[inline]
 pub fn read_mmap(m: &Mmap, i: usize, n: usize) -> u32 {
     assert!(n <= mem::size_of::<u32>(), "Cannot read more than u32");
@@ -37,3 +185,142 @@ pub fn read_mmap(m: &Mmap, i: usize, n: usize) -> u32 {
     }
     result
 }
+
+// Access pattern hints for memory mapped files
+#[derive(Copy, Clone, PartialEq, Debug)]
+pub enum MmapAdvice {
+    Normal,
+    Random,
+    Sequential,
+    WillNeed
+}
+
+impl MmapAdvice {
+
+    pub fn parse(s: &str) -> Result<MmapAdvice, String> {
+        match s {
+            "normal" => Ok(MmapAdvice::Normal),
+            "random" => Ok(MmapAdvice::Random),
+            "sequential" => Ok(MmapAdvice::Sequential),
+            "willneed" => Ok(MmapAdvice::WillNeed),
+            _ => Err(format!("Unknown access advice: {}", s))
+        }
+    }
+
+    fn flag(&self) -> libc::c_int {
+        match self {
+            MmapAdvice::Normal => libc::MADV_NORMAL,
+            MmapAdvice::Random => libc::MADV_RANDOM,
+            MmapAdvice::Sequential => libc::MADV_SEQUENTIAL,
+            MmapAdvice::WillNeed => libc::MADV_WILLNEED
+        }
+    }
+}
+
+pub fn page_size() -> usize {
+    unsafe { libc::sysconf(libc::_SC_PAGESIZE) as usize }
+}
+
+// Page aligned address and length covering [offset, offset + len) of the map
+fn page_range(m: &Mmap, offset: usize, len: usize) -> (*mut libc::c_void, usize) {
+    let start = offset - offset % page_size();
+    let end = cmp::min(offset + len, m.len());
+    (unsafe { m.as_ptr().add(start) } as *mut libc::c_void, end - start)
+}
+
+// Page aligned address and length of the pages lying wholly inside
+// [offset, offset + len) of the map, if any. The partial page at the end of
+// the map counts as inside since no other range can share it.
+fn inner_page_range(m: &Mmap, offset: usize, len: usize) -> Option<(*mut libc::c_void, usize)> {
+    let page = page_size();
+    let start = (offset + page - 1) / page * page;
+    let end = if offset + len >= m.len() { m.len() } else { (offset + len) / page * page };
+    if start >= end {
+        return None;
+    }
+    Some((unsafe { m.as_ptr().add(start) } as *mut libc::c_void, end - start))
+}
+
+fn check_os_result(ret: libc::c_int) -> io::Result<()> {
+    if ret == 0 { Ok(()) } else { Err(io::Error::last_os_error()) }
+}
+
+pub fn advise_mmap(m: &Mmap, offset: usize, len: usize, advice: MmapAdvice) -> io::Result<()> {
+    if len == 0 || offset >= m.len() {
+        return Ok(());
+    }
+    let (addr, n) = page_range(m, offset, len);
+    check_os_result(unsafe { libc::madvise(addr, n, advice.flag()) })
+}
+
+pub fn lock_mmap(m: &Mmap, offset: usize, len: usize) -> io::Result<()> {
+    if len == 0 || offset >= m.len() {
+        return Ok(());
+    }
+    let (addr, n) = page_range(m, offset, len);
+    check_os_result(unsafe { libc::mlock(addr, n) })
+}
+
+pub fn unlock_mmap(m: &Mmap) -> io::Result<()> {
+    unlock_mmap_range(m, 0, m.len())
+}
+
+// Unlock the pages lying wholly inside [offset, offset + len). Locks are per
+// page and per map, so pages shared with a neighbouring range (e.g., another
+// document in the same pack) stay locked until the map is unmapped.
+pub fn unlock_mmap_range(m: &Mmap, offset: usize, len: usize) -> io::Result<()> {
+    if len == 0 || offset >= m.len() {
+        return Ok(());
+    }
+    match inner_page_range(m, offset, len) {
+        Some((addr, n)) => check_os_result(unsafe { libc::munlock(addr, n) }),
+        None => Ok(())
+    }
+}
+
+// Read a byte of every page in [offset, offset + len) so that the pages are
+// loaded. Returns the number of bytes covered.
+pub fn populate_mmap(m: &Mmap, offset: usize, len: usize) -> usize {
+    if len == 0 || offset >= m.len() {
+        return 0;
+    }
+    let end = cmp::min(offset + len, m.len());
+    let page = page_size();
+    let mut i = offset;
+    while i < end {
+        unsafe { ptr::read_volatile(m.as_ptr().add(i)) };
+        i = (i / page + 1) * page;
+    }
+    end - offset
+}
+
+// Hint, load and optionally lock [offset, offset + len) of the map. Returns
+// the number of bytes loaded.
+pub fn warm_mmap(m: &Mmap, offset: usize, len: usize, lock: bool) -> io::Result<usize> {
+    advise_mmap(m, offset, len, MmapAdvice::WillNeed)?;
+    let n = populate_mmap(m, offset, len);
+    if lock {
+        lock_mmap(m, offset, len)?;
+    }
+    Ok(n)
+}
+
+// Number of bytes of the map that are in memory
+pub fn resident_mmap_bytes(m: &Mmap) -> io::Result<usize> {
+    resident_mmap_range_bytes(m, 0, m.len())
+}
+
+// Number of bytes of the pages covering [offset, offset + len) that are in
+// memory
+pub fn resident_mmap_range_bytes(m: &Mmap, offset: usize, len: usize) -> io::Result<usize> {
+    if len == 0 || offset >= m.len() {
+        return Ok(0);
+    }
+    let page = page_size();
+    let (addr, n) = page_range(m, offset, len);
+    let mut pages = vec![0u8; (n + page - 1) / page];
+    check_os_result(unsafe { libc::mincore(addr, n, pages.as_mut_ptr()) })?;
+    Ok(pages.iter().enumerate().filter(|(_, p)| **p & 1 != 0).map(
+        |(i, _)| cmp::min(page, n - i * page)
+    ).sum())
+}
@@ -5,6 +5,7 @@ use pyo3::exceptions;
 use std::cmp;
 use std::mem;
 use std::fs::File;
+use std::sync::Arc;
 use memmap::{MmapOptions, Mmap};
 
 use common::*;
@@ -16,6 +17,11 @@ struct _RsDocumentDataImpl {
     // Length in milliseconds
     duration: Millis,
 
+    // Offset and size of the document in the map (a packed file may hold
+    // many documents)
+    base: usize,
+    size: usize,
+
     // Offset of the time inteval index
     time_index_offset: usize,
     time_int_count: usize,
@@ -29,7 +35,7 @@ struct _RsDocumentDataImpl {
     start_time_size: usize,
     end_time_size: usize,
 
-    m: Mmap
+    m: Arc<Mmap>
 }
 
 // Start, End, Position, Length
@@ -79,76 +85,44 @@ impl _RsDocumentDataImpl {
             Some(min_idx)
         }
     }
-}
-
-#[pyclass]
-pub struct RsDocumentData {
-    _impl: _RsDocumentDataImpl,
-    debug: bool
-}
-
-#[pymethods]
-impl RsDocumentData {
-
-    fn id(&self) -> usize {
-        self._impl.id
-    }
-
-    fn length(&self) -> usize {
-        self._impl.length
-    }
-
-    fn duration(&self) -> f32 {
-        ms_to_s(self._impl.duration)
-    }
 
     fn tokens(&self, position: usize, n: usize) -> Vec<TokenId> {
-        if self.debug {
-            eprintln!("tokens: {}+{}", position, n);
-        }
-        let min_pos = cmp::min(position, self._impl.length);
-        let max_pos = cmp::min(position + n, self._impl.length);
+        let min_pos = cmp::min(position, self.length);
+        let max_pos = cmp::min(position + n, self.length);
         let mut tokens = Vec::with_capacity(max_pos - min_pos);
         for pos in min_pos..max_pos {
-            let ofs = pos * self._impl.datum_size + self._impl.tokens_offset;
-            tokens.push(self._impl.read_datum(ofs));
+            let ofs = pos * self.datum_size + self.tokens_offset;
+            tokens.push(self.read_datum(ofs));
         }
         tokens
     }
 
-    fn intervals(&self, start: Seconds, end: Seconds) ->  PyResult<Vec<Line>> {
-        if self.debug {
-            eprintln!("intervals: {}s to {}s", start, end);
-        }
+    fn intervals(&self, start_ms: Millis, end: Seconds) -> Vec<Line> {
         // Get document locations that overlap start and end
-        if start > ms_to_s(u32::max_value()) {
-            return Err(exceptions::ValueError::py_err("Start time exceeds maximum allowed"))
-        }
-        let start_ms = if start > 0. { s_to_ms(start) } else { 0 };
-        let posting_size = self._impl.posting_size();
-        let time_int_size = self._impl.time_int_size();
+        let posting_size = self.posting_size();
+        let time_int_size = self.time_int_size();
 
         let mut locations = vec![];
-        match self._impl.lookup_time_int(start_ms) {
+        match self.lookup_time_int(start_ms) {
             Some(start_idx_immut) => {
                 let mut start_idx = start_idx_immut;
                 if start_idx > 0 {
                     start_idx -= 1;
                 }
-                let duration = self._impl.duration;
+                let duration = self.duration;
                 let end_ms = if ms_to_s(duration) < end {duration} else {s_to_ms(end)};
 
-                let time_int_count = self._impl.time_int_count;
-                let base_index_ofs = self._impl.time_index_offset;
-                let length = self._impl.length;
+                let time_int_count = self.time_int_count;
+                let base_index_ofs = self.time_index_offset;
+                let length = self.length;
                 for i in start_idx..(time_int_count as usize) {
                     let ofs = i * posting_size + base_index_ofs;
-                    let time_int = self._impl.read_time_int(ofs);
+                    let time_int = self.read_time_int(ofs);
                     if cmp::min(end_ms, time_int.1) >= cmp::max(start_ms, time_int.0) {
                         // Non-zero overlap
-                        let pos = self._impl.read_datum(ofs + time_int_size);
+                        let pos = self.read_datum(ofs + time_int_size);
                         let next_pos = if i + 1 < (time_int_count as usize) {
-                            self._impl.read_datum(ofs + posting_size + time_int_size)
+                            self.read_datum(ofs + posting_size + time_int_size)
                         } else {length as u32};
                         assert!(next_pos >= pos, "postions are not non-decreasing");
                         locations.push(
@@ -161,20 +135,102 @@ impl RsDocumentData {
             },
             None => ()
         };
-        Ok(locations)
+        locations
     }
 
     fn position(&self, time: Seconds) -> Position {
+        match self.lookup_time_int(s_to_ms(time)) {
+            Some(idx) => {
+                let ofs = self.time_index_offset +
+                    idx * self.posting_size() + self.time_int_size();
+                self.read_datum(ofs) as Position
+            },
+            None => self.length as Position
+        }
+    }
+}
+
+#[pyclass]
+pub struct RsDocumentData {
+    _impl: _RsDocumentDataImpl,
+    debug: bool
+}
+
+#[pymethods]
+impl RsDocumentData {
+
+    fn id(&self) -> usize {
+        self._impl.id
+    }
+
+    fn length(&self) -> usize {
+        self._impl.length
+    }
+
+    fn duration(&self) -> f32 {
+        ms_to_s(self._impl.duration)
+    }
+
+    fn tokens(&self, py: Python, position: usize, n: usize) -> Vec<TokenId> {
+        if self.debug {
+            eprintln!("tokens: {}+{}", position, n);
+        }
+        py.allow_threads(|| self._impl.tokens(position, n))
+    }
+
+    fn intervals(&self, py: Python, start: Seconds, end: Seconds) ->  PyResult<Vec<Line>> {
+        if self.debug {
+            eprintln!("intervals: {}s to {}s", start, end);
+        }
+        if start > ms_to_s(u32::max_value()) {
+            return Err(exceptions::ValueError::py_err("Start time exceeds maximum allowed"))
+        }
+        let start_ms = if start > 0. { s_to_ms(start) } else { 0 };
+        Ok(py.allow_threads(|| self._impl.intervals(start_ms, end)))
+    }
+
+    fn position(&self, py: Python, time: Seconds) -> Position {
         if self.debug {
             eprintln!("position: {}s", time);
         }
-        match self._impl.lookup_time_int(s_to_ms(time)) {
-            Some(idx) => {
-                let ofs = self._impl.time_index_offset +
-                    idx * self._impl.posting_size() + self._impl.time_int_size();
-                self._impl.read_datum(ofs) as Position
-            },
-            None => self._impl.length as Position
+        py.allow_threads(|| self._impl.position(time))
+    }
+
+    fn warm(&self, py: Python, lock: bool) -> PyResult<usize> {
+        let (m, base, size) = (&self._impl.m, self._impl.base, self._impl.size);
+        match py.allow_threads(|| warm_mmap(m, base, size, lock)) {
+            Ok(n) => Ok(n),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to warm document: {}", e)))
+        }
+    }
+
+    fn unlock(&self) -> PyResult<()> {
+        match unlock_mmap_range(&self._impl.m, self._impl.base, self._impl.size) {
+            Ok(()) => Ok(()),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to unlock document: {}", e)))
+        }
+    }
+
+    fn advise(&self, advice: String) -> PyResult<()> {
+        let advice = match MmapAdvice::parse(&advice) {
+            Ok(advice) => advice,
+            Err(e) => return Err(exceptions::ValueError::py_err(e))
+        };
+        match advise_mmap(&self._impl.m, self._impl.base, self._impl.size, advice) {
+            Ok(()) => Ok(()),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to advise document: {}", e)))
+        }
+    }
+
+    fn size(&self) -> usize {
+        self._impl.size
+    }
+
+    fn resident_bytes(&self) -> PyResult<(usize, usize)> {
+        let size = self._impl.size;
+        match resident_mmap_range_bytes(&self._impl.m, self._impl.base, size) {
+            Ok(n) => Ok((n, size)),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to check residency: {}", e)))
         }
     }
 
@@ -183,32 +239,43 @@ impl RsDocumentData {
                   start_time_size: usize, end_time_size: usize, debug: bool
     ) -> PyResult<Self> {
         let m: Mmap = MmapOptions::new().map(&File::open(&data_path).unwrap()).unwrap();
+        let size = m.len();
+        RsDocumentData::open(id, Arc::new(m), 0, size, datum_size, start_time_size,
+                             end_time_size, debug)
+    }
+}
+
+impl RsDocumentData {
 
+    // Parse the header of the document at [base, base + size) of the map
+    fn open(id: usize, m: Arc<Mmap>, base: usize, size: usize, datum_size: usize,
+            start_time_size: usize, end_time_size: usize, debug: bool
+    ) -> PyResult<Self> {
         let u32_size = mem::size_of::<u32>();
         let time_int_entry_size = datum_size + start_time_size + end_time_size;
 
-        let doc_id = read_mmap_u32(&m, 0) as usize;
+        let doc_id = read_mmap_u32(&m, base) as usize;
         if doc_id != id {
             return Err(exceptions::IOError::py_err("Document id does not match expected id"));
         }
 
-        let duration: Millis = read_mmap_u32(&m, u32_size);
-        let time_int_count = read_mmap_u32(&m, 2 * u32_size) as usize;
-        let length = read_mmap_u32(&m, 3 * u32_size) as usize;
-        let time_index_offset = 4 * u32_size;
+        let duration: Millis = read_mmap_u32(&m, base + u32_size);
+        let time_int_count = read_mmap_u32(&m, base + 2 * u32_size) as usize;
+        let length = read_mmap_u32(&m, base + 3 * u32_size) as usize;
+        let time_index_offset = base + 4 * u32_size;
         let tokens_offset = time_index_offset + time_int_count * time_int_entry_size;
-        let total_len = tokens_offset + length * datum_size;
+        let total_len = tokens_offset + length * datum_size - base;
 
         if debug {
             eprintln!("Document: id={} duration={} intervals={} length={}",
                       doc_id, duration, time_int_count, length);
         }
 
-        assert!(total_len == m.len(), "Incorrect byte offsets");
+        assert!(total_len == size, "Incorrect byte offsets");
 
         Ok(RsDocumentData {
             _impl: _RsDocumentDataImpl {
-                id: doc_id, duration: duration,
+                id: doc_id, duration: duration, base: base, size: size,
                 time_index_offset: time_index_offset, time_int_count: time_int_count,
                 tokens_offset: tokens_offset, length: length,
                 datum_size: datum_size, start_time_size: start_time_size,
@@ -218,3 +285,90 @@ impl RsDocumentData {
         })
     }
 }
+
+// A packed file of the data of consecutive documents, mapped once and shared
+// by the documents opened from it
+#[pyclass]
+pub struct RsDocumentPack {
+    m: Arc<Mmap>,
+    first_id: usize,
+    count: usize,
+    debug: bool
+}
+
+impl RsDocumentPack {
+
+    fn data_offset(&self) -> usize {
+        DOC_PACK_HEADER_SIZE + (self.count + 1) * mem::size_of::<u64>()
+    }
+
+    // Offset of the ith document's data from the start of the documents
+    fn document_offset(&self, i: usize) -> usize {
+        read_mmap_u64(&self.m, DOC_PACK_HEADER_SIZE + i * mem::size_of::<u64>()) as usize
+    }
+}
+
+#[pymethods]
+impl RsDocumentPack {
+
+    fn first_id(&self) -> usize {
+        self.first_id
+    }
+
+    fn count(&self) -> usize {
+        self.count
+    }
+
+    fn open(&self, id: usize, datum_size: usize, start_time_size: usize,
+            end_time_size: usize
+    ) -> PyResult<RsDocumentData> {
+        if id < self.first_id || id >= self.first_id + self.count {
+            return Err(exceptions::IndexError::py_err("Document is not in the pack"));
+        }
+        let i = id - self.first_id;
+        let start = self.document_offset(i);
+        let end = self.document_offset(i + 1);
+        if start == end {
+            return Err(exceptions::IOError::py_err(format!("No data for document: {}", id)));
+        }
+        RsDocumentData::open(id, self.m.clone(), self.data_offset() + start, end - start,
+                             datum_size, start_time_size, end_time_size, self.debug)
+    }
+
+    fn warm(&self, py: Python, lock: bool) -> PyResult<usize> {
+        let m = &self.m;
+        match py.allow_threads(|| warm_mmap(m, 0, m.len(), lock)) {
+            Ok(n) => Ok(n),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to warm documents: {}", e)))
+        }
+    }
+
+    fn resident_bytes(&self) -> PyResult<(usize, usize)> {
+        match resident_mmap_bytes(&self.m) {
+            Ok(n) => Ok((n, self.m.len())),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to check residency: {}", e)))
+        }
+    }
+
+    #[new]
+    unsafe fn new(path: String, debug: bool) -> PyResult<Self> {
+        let m: Mmap = match File::open(&path).and_then(|f| MmapOptions::new().map(&f)) {
+            Ok(m) => m,
+            Err(e) => return Err(exceptions::IOError::py_err(format!("Unable to open {}: {}", path, e)))
+        };
+        if m.len() < DOC_PACK_HEADER_SIZE || read_mmap_u32(&m, 0) != DOC_PACK_MAGIC {
+            return Err(exceptions::IOError::py_err(format!("Not a document pack: {}", path)));
+        }
+        let version = read_mmap_u32(&m, 4);
+        if version != DOC_PACK_VERSION {
+            return Err(exceptions::IOError::py_err(
+                format!("Unsupported document pack version: {}", version)));
+        }
+        let first_id = read_mmap_u32(&m, 8) as usize;
+        let count = read_mmap_u32(&m, 12) as usize;
+        if debug {
+            eprintln!("Document pack: {} documents from id={}", count, first_id);
+        }
+        Ok(RsDocumentPack { m: Arc::new(m), first_id: first_id, count: count, debug: debug })
+    }
+}
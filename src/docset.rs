@@ -0,0 +1,108 @@
+/* Sets of document ids, stored as bitmaps */
+
+use pyo3::prelude::*;
+use std::cmp;
+
+use common::*;
+
+const WORD_BITS: usize = 64;
+
+#[pyclass]
+#[derive(Clone, PartialEq, Eq)]
+pub struct RsDocumentSet {
+    // Bit i % 64 of word i / 64 is set if document i is in the set. Trailing
+    // zero words are removed, so equal sets have equal words.
+    words: Vec<u64>,
+    len: usize
+}
+
+impl RsDocumentSet {
+
+    fn from_words(mut words: Vec<u64>) -> RsDocumentSet {
+        while words.last() == Some(&0) {
+            words.pop();
+        }
+        let len = words.iter().map(|w| w.count_ones() as usize).sum();
+        RsDocumentSet { words: words, len: len }
+    }
+
+    pub fn from_ids(ids: &[DocumentId]) -> RsDocumentSet {
+        let mut words = match ids.iter().max() {
+            None => vec![],
+            Some(max_id) => vec![0u64; *max_id as usize / WORD_BITS + 1]
+        };
+        for id in ids {
+            let i = *id as usize;
+            words[i / WORD_BITS] |= 1u64 << (i % WORD_BITS);
+        }
+        RsDocumentSet::from_words(words)
+    }
+
+    pub fn contains_id(&self, id: DocumentId) -> bool {
+        let i = id as usize;
+        i / WORD_BITS < self.words.len() && self.words[i / WORD_BITS] & (1u64 << (i % WORD_BITS)) != 0
+    }
+
+    // Document ids in the set, in increasing order
+    pub fn document_ids(&self) -> Vec<DocumentId> {
+        let mut ids = Vec::with_capacity(self.len);
+        for (i, word) in self.words.iter().enumerate() {
+            let mut w = *word;
+            while w != 0 {
+                ids.push((i * WORD_BITS + w.trailing_zeros() as usize) as DocumentId);
+                w &= w - 1;
+            }
+        }
+        ids
+    }
+
+    fn combine<F>(&self, other: &RsDocumentSet, f: F) -> RsDocumentSet
+        where F: Fn(u64, u64) -> u64
+    {
+        let n = cmp::max(self.words.len(), other.words.len());
+        let word_at = |s: &RsDocumentSet, i: usize| if i < s.words.len() { s.words[i] } else { 0 };
+        RsDocumentSet::from_words(
+            (0..n).map(|i| f(word_at(self, i), word_at(other, i))).collect())
+    }
+}
+
+#[pymethods]
+impl RsDocumentSet {
+
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    fn contains(&self, id: DocumentId) -> bool {
+        self.contains_id(id)
+    }
+
+    fn ids(&self) -> Vec<DocumentId> {
+        self.document_ids()
+    }
+
+    fn union(&self, other: PyRef<RsDocumentSet>) -> RsDocumentSet {
+        self.combine(&other, |a, b| a | b)
+    }
+
+    fn intersection(&self, other: PyRef<RsDocumentSet>) -> RsDocumentSet {
+        self.combine(&other, |a, b| a & b)
+    }
+
+    fn difference(&self, other: PyRef<RsDocumentSet>) -> RsDocumentSet {
+        self.combine(&other, |a, b| a & !b)
+    }
+
+    fn symmetric_difference(&self, other: PyRef<RsDocumentSet>) -> RsDocumentSet {
+        self.combine(&other, |a, b| a ^ b)
+    }
+
+    fn equals(&self, other: PyRef<RsDocumentSet>) -> bool {
+        *self == *other
+    }
+
+    #[new]
+    fn new(ids: Vec<DocumentId>) -> Self {
+        RsDocumentSet::from_ids(&ids)
+    }
+}
@@ -3,16 +3,24 @@
 use pyo3::prelude::*;
 use pyo3::exceptions;
 use pyo3::types::PyBytes;
+use pyo3::PyIterProtocol;
 use byteorder::{ByteOrder, LittleEndian};
-use std::collections::{BTreeMap, BinaryHeap, HashSet};
+use std::collections::{BTreeMap, BinaryHeap, HashMap};
 use std::cmp;
 use std::cmp::Ordering;
 use std::mem;
+use std::io;
 use std::fs::{File, metadata, read_dir};
+use std::path::Path;
+use std::sync::Arc;
 use memmap::{MmapOptions, Mmap};
+use rayon::prelude::*;
+use rayon::{ThreadPool, ThreadPoolBuilder};
 
 use common::*;
+use docset::RsDocumentSet;
 
+#[derive(Copy, Clone)]
 struct Document {
     // The file containing the document index
     file_num: usize,
@@ -27,23 +35,47 @@ struct Document {
     // Offset of the inverted index
     inv_index_offset: usize,
     posting_count: u32,
+
+    format: PostingFormat,
+
+    // Byte offset and slot count of the lexicon hash table, if there is one
+    lexicon_hash: Option<(usize, usize)>
 }
 
 // Start, End, Position, Length
 type Posting = (Millis, Millis, Position, u32);
 
-fn parse_index(m: &Mmap, file_num: usize, datum_size: usize,
-               start_time_size: usize, end_time_size: usize, debug: bool
+// Returns the posting format and the offset of the first document
+fn read_index_header(m: &Mmap) -> Result<(PostingFormat, usize), String> {
+    if m.len() < INDEX_HEADER_SIZE || read_mmap_u32(m, 0) != INDEX_MAGIC {
+        return Ok((PostingFormat::Fixed, 0));
+    }
+    match read_mmap_u32(m, 4) {
+        INDEX_VERSION_COMPRESSED => {
+            if m.len() < INDEX_HEADER_SIZE {
+                return Err("Truncated index header".to_string());
+            }
+            let skip_interval = read_mmap_u32(m, 8) as usize;
+            Ok((PostingFormat::Varint { skip_interval: skip_interval }, INDEX_HEADER_SIZE))
+        },
+        INDEX_VERSION_COMPRESSED_NO_SKIPS => Ok(
+            (PostingFormat::Varint { skip_interval: 0 }, INDEX_HEADER_SIZE_NO_SKIPS)),
+        version => Err(format!("Unsupported index version: {}", version))
+    }
+}
+
+fn parse_index(m: &Mmap, file_num: usize, format: PostingFormat, header_size: usize,
+               datum_size: usize, start_time_size: usize, end_time_size: usize, debug: bool
 ) -> BTreeMap<DocumentId, Document> {
     let mut docs = BTreeMap::new();
 
     let u32_size = mem::size_of::<u32>();
-    let lexicon_entry_size = 2 * datum_size;
+    let lexicon_entry_size = format.lexicon_entry_size(datum_size);
     let posting_size = datum_size + start_time_size + end_time_size;
-    let lexicon_offset = 3 * u32_size;
+    let lexicon_offset = format.lexicon_offset();
 
     let index_size: usize = m.len();
-    let mut curr_offset: usize = 0;
+    let mut curr_offset: usize = header_size;
     while curr_offset < index_size {
         let base_offset = curr_offset;
         let doc_id: u32 = read_mmap_u32(m, base_offset);
@@ -51,7 +83,10 @@ fn parse_index(m: &Mmap, file_num: usize, datum_size: usize,
         let posting_count: u32 = read_mmap_u32(m, base_offset + 2 * u32_size);
 
         let inv_index_offset = lexicon_offset + (unique_token_count as usize) * lexicon_entry_size;
-        let doc_index_len = inv_index_offset + (posting_count as usize) * posting_size;
+        let doc_index_len = inv_index_offset + match format {
+            PostingFormat::Fixed => (posting_count as usize) * posting_size,
+            PostingFormat::Varint { .. } => read_mmap_u32(m, base_offset + 3 * u32_size) as usize
+        };
 
         if debug {
             eprintln!("Document: id={} offset={} words={} postings={}",
@@ -61,7 +96,8 @@ fn parse_index(m: &Mmap, file_num: usize, datum_size: usize,
         docs.insert(doc_id, Document {
             file_num: file_num, base_offset: base_offset,
             lexicon_offset: lexicon_offset, unique_token_count: unique_token_count,
-            inv_index_offset: inv_index_offset, posting_count: posting_count
+            inv_index_offset: inv_index_offset, posting_count: posting_count,
+            format: format, lexicon_hash: None
         });
         curr_offset += doc_index_len;
     }
@@ -72,6 +108,335 @@ fn parse_index(m: &Mmap, file_num: usize, datum_size: usize,
     docs
 }
 
+// Locations of the documents in an index file
+enum DocumentTable {
+    // Parsed from the index file itself (older indexes)
+    Parsed(BTreeMap<DocumentId, Document>),
+
+    // Document table written alongside the index file by the indexer
+    Mapped {
+        m: Mmap,
+        file_num: usize,
+        doc_count: usize,
+        format: PostingFormat,
+        lexicon_entry_size: usize
+    }
+}
+
+impl DocumentTable {
+
+    fn load(
+        m: Mmap, file_num: usize, format: PostingFormat, datum_size: usize
+    ) -> Result<DocumentTable, String> {
+        if m.len() < DOC_TABLE_HEADER_SIZE || read_mmap_u32(&m, 0) != DOC_TABLE_MAGIC {
+            return Err("Not a document table".to_string());
+        }
+        let version = read_mmap_u32(&m, 4);
+        if version != DOC_TABLE_VERSION {
+            return Err(format!("Unsupported document table version: {}", version));
+        }
+        let doc_count = read_mmap_u32(&m, 8) as usize;
+        if m.len() != DOC_TABLE_HEADER_SIZE + doc_count * DOC_TABLE_ENTRY_SIZE {
+            return Err("Incorrect byte offsets".to_string());
+        }
+        Ok(DocumentTable::Mapped {
+            m: m, file_num: file_num, doc_count: doc_count, format: format,
+            lexicon_entry_size: format.lexicon_entry_size(datum_size)
+        })
+    }
+
+    fn len(&self) -> usize {
+        match self {
+            DocumentTable::Parsed(docs) => docs.len(),
+            DocumentTable::Mapped { doc_count, .. } => *doc_count
+        }
+    }
+
+    fn id_at(m: &Mmap, i: usize) -> DocumentId {
+        read_mmap_u32(m, DOC_TABLE_HEADER_SIZE + i * DOC_TABLE_ENTRY_SIZE)
+    }
+
+    fn first_id(&self) -> DocumentId {
+        match self {
+            DocumentTable::Parsed(docs) => *docs.keys().next().unwrap(),
+            DocumentTable::Mapped { m, .. } => DocumentTable::id_at(m, 0)
+        }
+    }
+
+    fn last_id(&self) -> DocumentId {
+        match self {
+            DocumentTable::Parsed(docs) => *docs.keys().next_back().unwrap(),
+            DocumentTable::Mapped { m, doc_count, .. } => DocumentTable::id_at(m, doc_count - 1)
+        }
+    }
+
+    fn ids(&self) -> Vec<DocumentId> {
+        match self {
+            DocumentTable::Parsed(docs) => docs.keys().cloned().collect(),
+            DocumentTable::Mapped { m, doc_count, .. } => {
+                (0..*doc_count).map(|i| DocumentTable::id_at(m, i)).collect()
+            }
+        }
+    }
+
+    fn get(&self, id: DocumentId) -> Option<Document> {
+        match self {
+            DocumentTable::Parsed(docs) => docs.get(&id).cloned(),
+            DocumentTable::Mapped { m, file_num, doc_count, format, lexicon_entry_size } => {
+                let u32_size = mem::size_of::<u32>();
+                let mut min_idx = 0;
+                let mut max_idx = *doc_count;
+                while min_idx < max_idx {
+                    let pivot = (min_idx + max_idx) / 2;
+                    let pivot_id = DocumentTable::id_at(m, pivot);
+                    if pivot_id == id {
+                        let ofs = DOC_TABLE_HEADER_SIZE + pivot * DOC_TABLE_ENTRY_SIZE + u32_size;
+                        let unique_token_count = read_mmap_u32(m, ofs + 2 * u32_size);
+                        let lexicon_offset = format.lexicon_offset();
+                        return Some(Document {
+                            file_num: *file_num,
+                            base_offset: read_mmap_u64(m, ofs) as usize,
+                            lexicon_offset: lexicon_offset,
+                            unique_token_count: unique_token_count,
+                            inv_index_offset: lexicon_offset +
+                                (unique_token_count as usize) * lexicon_entry_size,
+                            posting_count: read_mmap_u32(m, ofs + 3 * u32_size),
+                            format: *format,
+                            lexicon_hash: None
+                        });
+                    } else if pivot_id < id {
+                        min_idx = pivot + 1;
+                    } else {
+                        max_idx = pivot;
+                    }
+                }
+                None
+            }
+        }
+    }
+}
+
+// Hash tables of the tokens in each document lexicon (optionally written
+// alongside each index file by the indexer)
+struct LexiconHashIndex {
+    m: Mmap,
+    doc_count: usize
+}
+
+impl LexiconHashIndex {
+
+    fn load(m: Mmap) -> Result<LexiconHashIndex, String> {
+        if m.len() < LEXICON_HASH_HEADER_SIZE || read_mmap_u32(&m, 0) != LEXICON_HASH_MAGIC {
+            return Err("Not a lexicon hash index".to_string());
+        }
+        let version = read_mmap_u32(&m, 4);
+        if version != LEXICON_HASH_VERSION {
+            return Err(format!("Unsupported lexicon hash version: {}", version));
+        }
+        let doc_count = read_mmap_u32(&m, 8) as usize;
+        if m.len() < LEXICON_HASH_HEADER_SIZE + doc_count * LEXICON_HASH_ENTRY_SIZE {
+            return Err("Incorrect byte offsets".to_string());
+        }
+        // Each table must be in bounds and have an empty slot to stop probing
+        let u32_size = mem::size_of::<u32>();
+        for i in 0..doc_count {
+            let ofs = LEXICON_HASH_HEADER_SIZE + i * LEXICON_HASH_ENTRY_SIZE;
+            let table_ofs = read_mmap_u64(&m, ofs + u32_size) as usize;
+            let slot_count = read_mmap_u32(&m, ofs + 3 * u32_size) as usize;
+            if slot_count == 0 || table_ofs.checked_add(slot_count * LEXICON_HASH_SLOT_SIZE)
+                    .map_or(true, |end| end > m.len()) {
+                return Err("Incorrect byte offsets".to_string());
+            }
+        }
+        Ok(LexiconHashIndex { m: m, doc_count: doc_count })
+    }
+
+    // Byte offset and slot count of a document's hash table
+    fn table(&self, doc_id: DocumentId) -> Option<(usize, usize)> {
+        let u32_size = mem::size_of::<u32>();
+        let mut min_idx = 0;
+        let mut max_idx = self.doc_count;
+        while min_idx < max_idx {
+            let pivot = (min_idx + max_idx) / 2;
+            let ofs = LEXICON_HASH_HEADER_SIZE + pivot * LEXICON_HASH_ENTRY_SIZE;
+            let pivot_id = read_mmap_u32(&self.m, ofs);
+            if pivot_id == doc_id {
+                return Some((read_mmap_u64(&self.m, ofs + u32_size) as usize,
+                             read_mmap_u32(&self.m, ofs + 3 * u32_size) as usize));
+            } else if pivot_id < doc_id {
+                min_idx = pivot + 1;
+            } else {
+                max_idx = pivot;
+            }
+        }
+        None
+    }
+
+    // Index of the token in the document lexicon
+    fn find(&self, table: (usize, usize), token: TokenId) -> Option<usize> {
+        let (base_ofs, slot_count) = table;
+        let mut slot = lexicon_hash_slot(token, slot_count);
+        // The table is never full, so probing stops at an empty slot
+        loop {
+            let ofs = base_ofs + slot * LEXICON_HASH_SLOT_SIZE;
+            let slot_token = read_mmap_u32(&self.m, ofs);
+            if slot_token == token {
+                return Some(read_mmap_u32(&self.m, ofs + mem::size_of::<u32>()) as usize);
+            } else if slot_token == EMPTY_HASH_SLOT {
+                return None;
+            }
+            slot += 1;
+            if slot == slot_count {
+                slot = 0;
+            }
+        }
+    }
+}
+
+// Sorted list of documents containing each token (written alongside each
+// index file by the indexer)
+struct DocumentFrequencyIndex {
+    m: Mmap,
+    entries_offset: usize,
+    token_count: usize,
+    doc_count: usize
+}
+
+impl DocumentFrequencyIndex {
+
+    fn load(m: Mmap) -> Result<DocumentFrequencyIndex, String> {
+        let u32_size = mem::size_of::<u32>();
+        let header_size = if m.len() >= DOC_FREQ_HEADER_SIZE && read_mmap_u32(&m, 0) == DOC_FREQ_MAGIC {
+            let version = read_mmap_u32(&m, 4);
+            if version != DOC_FREQ_VERSION {
+                return Err(format!("Unsupported document frequency index version: {}", version));
+            }
+            DOC_FREQ_HEADER_SIZE
+        } else if m.len() >= DOC_FREQ_HEADER_SIZE_NO_MAGIC {
+            DOC_FREQ_HEADER_SIZE_NO_MAGIC
+        } else {
+            return Err("Not a document frequency index".to_string());
+        };
+        let token_count = read_mmap_u32(&m, header_size - u32_size) as usize;
+        let ids_offset = header_size + 2 * token_count * u32_size;
+        if m.len() < ids_offset || (m.len() - ids_offset) % u32_size != 0 {
+            return Err("Incorrect byte offsets".to_string());
+        }
+        let doc_count = (m.len() - ids_offset) / u32_size;
+
+        // Tokens must be sorted and their document ranges in bounds
+        let mut prev: Option<(TokenId, usize)> = None;
+        for i in 0..token_count {
+            let ofs = header_size + 2 * i * u32_size;
+            let token = read_mmap_u32(&m, ofs);
+            let start = read_mmap_u32(&m, ofs + u32_size) as usize;
+            if start > doc_count || prev.map_or(false, |(t, s)| token <= t || start < s) {
+                return Err("Incorrect byte offsets".to_string());
+            }
+            prev = Some((token, start));
+        }
+        Ok(DocumentFrequencyIndex {
+            m: m, entries_offset: header_size, token_count: token_count, doc_count: doc_count
+        })
+    }
+
+    // Range of the token's documents in the sorted document ids
+    fn document_range(&self, token: TokenId) -> (usize, usize) {
+        let u32_size = mem::size_of::<u32>();
+        let entry_size = 2 * u32_size;
+        let mut min_idx = 0;
+        let mut max_idx = self.token_count;
+        while min_idx < max_idx {
+            let pivot = (min_idx + max_idx) / 2;
+            let ofs = self.entries_offset + pivot * entry_size;
+            let pivot_token = read_mmap_u32(&self.m, ofs);
+            if pivot_token == token {
+                let start = read_mmap_u32(&self.m, ofs + u32_size) as usize;
+                let end = if pivot + 1 < self.token_count {
+                    read_mmap_u32(&self.m, ofs + entry_size + u32_size) as usize
+                } else {
+                    self.doc_count
+                };
+                return (start, end);
+            } else if pivot_token < token {
+                min_idx = pivot + 1;
+            } else {
+                max_idx = pivot;
+            }
+        }
+        (0, 0)
+    }
+
+    // Documents that contain the token, restricted to docs if given. When
+    // there are fewer docs than documents containing the token, each of the
+    // docs is looked up in the list rather than reading the whole list.
+    fn documents(&self, token: TokenId, docs: Option<&RsDocumentSet>) -> Vec<DocumentId> {
+        let u32_size = mem::size_of::<u32>();
+        let (start, end) = self.document_range(token);
+        let ids_offset = self.entries_offset + self.token_count * 2 * u32_size;
+        let id_at = |i: usize| read_mmap_u32(&self.m, ids_offset + i * u32_size);
+        match docs {
+            Some(docs) if docs.len() < end - start => {
+                docs.document_ids().into_iter().filter(|id| {
+                    let (mut lo, mut hi) = (start, end);
+                    while lo < hi {
+                        let mid = (lo + hi) / 2;
+                        let mid_id = id_at(mid);
+                        if mid_id == *id {
+                            return true;
+                        } else if mid_id < *id {
+                            lo = mid + 1;
+                        } else {
+                            hi = mid;
+                        }
+                    }
+                    false
+                }).collect()
+            },
+            Some(docs) => (start..end).map(id_at).filter(|id| docs.contains_id(*id)).collect(),
+            None => (start..end).map(id_at).collect()
+        }
+    }
+}
+
+// Map a file written alongside an index file. Returns None if there is no
+// such file, or if it cannot be read or loaded (in which case searches fall
+// back to what they do without it).
+unsafe fn load_sidecar<T, F>(path: &str, load: F) -> Option<T>
+    where F: FnOnce(Mmap) -> Result<T, String>
+{
+    if !Path::new(path).is_file() {
+        return None;
+    }
+    let result = File::open(path).and_then(|f| MmapOptions::new().map(&f))
+        .map_err(|e| e.to_string()).and_then(load);
+    match result {
+        Ok(x) => Some(x),
+        Err(e) => {
+            eprintln!("Warning: ignoring {}: {}", path, e);
+            None
+        }
+    }
+}
+
+fn intersect_sorted(a: &Vec<DocumentId>, b: &Vec<DocumentId>) -> Vec<DocumentId> {
+    let mut result = Vec::with_capacity(cmp::min(a.len(), b.len()));
+    let mut i = 0;
+    let mut j = 0;
+    while i < a.len() && j < b.len() {
+        if a[i] < b[j] {
+            i += 1;
+        } else if a[i] > b[j] {
+            j += 1;
+        } else {
+            result.push(a[i]);
+            i += 1;
+            j += 1;
+        }
+    }
+    result
+}
+
 #[derive(Copy, Clone, Eq, PartialEq)]
 struct HeapPosting {
     posting: Posting,
@@ -90,9 +455,180 @@ impl PartialOrd for HeapPosting {
     }
 }
 
+// Index of the first element in [lo, hi) whose position is at least target,
+// or hi. Probes at exponentially increasing distances from lo and then binary
+// searches, so skipping k elements costs O(log k) probes.
+fn gallop<F>(mut lo: usize, hi: usize, target: Position, pos_at: F) -> usize
+    where F: Fn(usize) -> Position
+{
+    let mut step = 1;
+    let mut bound = lo;
+    while bound < hi && pos_at(bound) < target {
+        lo = bound + 1;
+        bound = lo + step;
+        step *= 2;
+    }
+    let mut hi = cmp::min(bound, hi);
+    while lo < hi {
+        let mid = (lo + hi) / 2;
+        if pos_at(mid) < target {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    lo
+}
+
+// Time interval that postings must lie within
+#[derive(Copy, Clone)]
+struct TimeWindow {
+    start: Millis,
+    end: Millis
+}
+
+impl TimeWindow {
+
+    // Conversion to milliseconds saturates, so a negative start or an infinite
+    // end leaves that side of the window open
+    fn new(start: Seconds, end: Seconds) -> TimeWindow {
+        TimeWindow { start: s_to_ms(start), end: s_to_ms(end) }
+    }
+
+    fn all() -> TimeWindow {
+        TimeWindow { start: 0, end: Millis::max_value() }
+    }
+
+    fn is_all(&self) -> bool {
+        self.start == 0 && self.end == Millis::max_value()
+    }
+
+    fn contains(&self, start: Millis, end: Millis) -> bool {
+        start >= self.start && end <= self.end
+    }
+}
+
+// Reads a posting list in position order, skipping ahead to requested positions.
+// Postings outside of the time window are skipped.
+enum PostingCursor<'a> {
+    // Postings that were read up front (e.g., merged from several tokens)
+    Decoded { postings: Vec<Posting>, idx: usize },
+
+    // Fixed width postings, read directly from the index file
+    Fixed {
+        index: &'a _RsCaptionIndexImpl, m: &'a Mmap, base_ofs: usize, n: usize, idx: usize,
+        window: TimeWindow
+    },
+
+    // Varint postings, decoded one block of skip_interval postings at a time
+    Varint {
+        index: &'a _RsCaptionIndexImpl, m: &'a Mmap, skips_ofs: usize, postings_ofs: usize,
+        n: usize, skip_interval: usize, skip_count: usize,
+        block: Vec<Posting>, block_num: Option<usize>, idx: usize, window: TimeWindow
+    }
+}
+
+impl<'a> PostingCursor<'a> {
+
+    // First posting at or after the target position. Targets must not decrease
+    // between calls.
+    fn seek(&mut self, target: Position) -> Option<Posting> {
+        match self {
+            PostingCursor::Decoded { postings, idx } => {
+                *idx = gallop(*idx, postings.len(), target, |i| postings[i].2);
+                postings.get(*idx).cloned()
+            },
+            PostingCursor::Fixed { index, m, base_ofs, n, idx, window } => {
+                let posting_size = index.posting_size();
+                let pos_ofs = *base_ofs + index.time_int_size();
+                *idx = gallop(*idx, *n, target,
+                              |i| index.read_datum(m, pos_ofs + i * posting_size));
+                while *idx < *n {
+                    let ofs = *base_ofs + *idx * posting_size;
+                    let time_int = index.read_time_int(m, ofs);
+                    if window.contains(time_int.0, time_int.1) {
+                        return Some((time_int.0, time_int.1,
+                                     index.read_datum(m, pos_ofs + *idx * posting_size), 1));
+                    }
+                    *idx += 1;
+                }
+                None
+            },
+            PostingCursor::Varint {
+                index, m, skips_ofs, postings_ofs, n, skip_interval, skip_count, block,
+                block_num, idx, window
+            } => {
+                let in_block = match block_num {
+                    Some(_) => block.last().map_or(false, |p| p.2 >= target),
+                    None => false
+                };
+                if !in_block {
+                    // Block k > 0 starts after the posting recorded in skip pointer k - 1.
+                    // Find the last block that starts after a posting before target.
+                    let skip_pos = |k: usize| read_mmap_u32(m, *skips_ofs + (k - 1) * SKIP_ENTRY_SIZE);
+                    let first_block = block_num.map_or(1, |b| b + 2);
+                    if first_block > *skip_count + 1 {
+                        return None;
+                    }
+                    let k = gallop(first_block, *skip_count + 1, target, skip_pos) - 1;
+                    let (ofs, prev_pos, prev_start) = if k == 0 {
+                        (*postings_ofs, 0, 0)
+                    } else {
+                        let skip_ofs = *skips_ofs + (k - 1) * SKIP_ENTRY_SIZE;
+                        (*postings_ofs + read_mmap_u32(m, skip_ofs + 8) as usize,
+                         read_mmap_u32(m, skip_ofs), read_mmap_u32(m, skip_ofs + 4))
+                    };
+                    let count = if *skip_count == 0 { *n } else {
+                        cmp::min(*skip_interval, *n - k * *skip_interval)
+                    };
+                    *block = index.decode_postings_from(
+                        m, ofs, count, prev_pos, prev_start, *window);
+                    *block_num = Some(k);
+                    *idx = 0;
+                }
+                *idx = gallop(*idx, block.len(), target, |i| block[i].2);
+                block.get(*idx).cloned()
+            }
+        }
+    }
+}
+
+struct Ngram {
+    // Tokens of the elements of the phrase. An element is a single word or an
+    // indexed bigram.
+    tokens: Vec<Token>,
+    // Word offset of each element from the start of the phrase
+    offsets: Vec<usize>,
+    // Number of words in the phrase
+    len: usize,
+    // Order in which to merge the postings of the elements
+    query_plan: Vec<usize>
+}
+
+enum SearchQuery {
+    Unigram(Token),
+    Ngram(Ngram)
+}
+
+impl SearchQuery {
+
+    fn tokens(&self) -> Vec<Token> {
+        match self {
+            SearchQuery::Unigram(unigram) => vec![unigram.clone()],
+            SearchQuery::Ngram(ngram) => ngram.tokens.clone()
+        }
+    }
+}
+
+// Smallest number of documents to search at a time when results are limited
+const MIN_LIMIT_BATCH_SIZE: usize = 256;
+
 struct _RsCaptionIndexImpl {
-    docs: BTreeMap<DocumentId, Document>,
+    // Sorted by first document id, with non-overlapping id ranges
+    tables: Vec<DocumentTable>,
     data: Vec<Mmap>,
+    doc_freqs: Vec<Option<DocumentFrequencyIndex>>,
+    lexicon_hashes: Vec<Option<LexiconHashIndex>>,
     datum_size: usize,
     start_time_size: usize,
     end_time_size: usize,
@@ -118,35 +654,282 @@ impl _RsCaptionIndexImpl {
         (start, start + diff)
     }
 
+    fn get_document(&self, doc_id: DocumentId) -> Option<Document> {
+        // Find the last table that starts at or before doc_id
+        let idx = match self.tables.binary_search_by_key(&doc_id, |t| t.first_id()) {
+            Ok(i) => i,
+            Err(0) => return None,
+            Err(i) => i - 1
+        };
+        self.tables[idx].get(doc_id).map(|mut d| {
+            if let Some(ref hashes) = self.lexicon_hashes[d.file_num] {
+                d.lexicon_hash = hashes.table(doc_id);
+            }
+            d
+        })
+    }
+
+    fn document_ids(&self) -> Vec<DocumentId> {
+        self.tables.iter().flat_map(|t| t.ids()).collect()
+    }
+
+    // Memory maps of the document tables, document frequency indexes and
+    // lexicon hash indexes
+    fn sidecar_mmaps(&self) -> Vec<&Mmap> {
+        let mut mmaps = vec![];
+        for table in self.tables.iter() {
+            if let DocumentTable::Mapped { m, .. } = table {
+                mmaps.push(m);
+            }
+        }
+        mmaps.extend(self.doc_freqs.iter().filter_map(|df| df.as_ref().map(|df| &df.m)));
+        mmaps.extend(self.lexicon_hashes.iter().filter_map(|h| h.as_ref().map(|h| &h.m)));
+        mmaps
+    }
+
+    // Load the index into memory, optionally locking it there. With
+    // lexicons_only, only the sidecar files and the document headers and
+    // lexicons are loaded, which are read by every search. Returns the number
+    // of bytes loaded.
+    fn warm(&self, lexicons_only: bool, lock: bool) -> io::Result<usize> {
+        let mut n = 0;
+        for m in self.sidecar_mmaps() {
+            n += warm_mmap(m, 0, m.len(), lock)?;
+        }
+        if lexicons_only {
+            for doc_id in self.document_ids() {
+                let d = self.get_document(doc_id).unwrap();
+                n += warm_mmap(&self.data[d.file_num], d.base_offset, d.inv_index_offset, lock)?;
+            }
+        } else {
+            for m in self.data.iter() {
+                n += warm_mmap(m, 0, m.len(), lock)?;
+            }
+        }
+        Ok(n)
+    }
+
+    // Documents (of docs, if given) that contain every token position of the
+    // ngram, or None if some index file has no document frequency index
+    fn candidate_documents(
+        &self, ngram: &Vec<Token>, docs: Option<&RsDocumentSet>
+    ) -> Option<Vec<DocumentId>> {
+        let mut candidates = vec![];
+        for df in self.doc_freqs.iter() {
+            let df = match df {
+                Some(df) => df,
+                None => return None
+            };
+            let mut file_candidates: Option<Vec<DocumentId>> = None;
+            for token in ngram {
+                let mut token_docs: Vec<DocumentId> = token.iter().flat_map(
+                    |t| df.documents(*t, docs)
+                ).collect();
+                if token.len() > 1 {
+                    token_docs.sort();
+                    token_docs.dedup();
+                }
+                let new_candidates = match file_candidates {
+                    None => token_docs,
+                    Some(c) => intersect_sorted(&c, &token_docs)
+                };
+                let done = new_candidates.len() == 0;
+                file_candidates = Some(new_candidates);
+                if done {
+                    break;
+                }
+            }
+            candidates.extend(file_candidates.unwrap_or(vec![]));
+        }
+        candidates.sort();
+        Some(candidates)
+    }
+
+    // Restrict the requested documents (None means all) to ones that may
+    // contain the ngram and that come after after_doc_id, in id order
+    fn select_documents(
+        &self, ngram: &Vec<Token>, docs: Option<&RsDocumentSet>,
+        after_doc_id: Option<DocumentId>
+    ) -> Vec<DocumentId> {
+        let mut selected = match (docs, self.candidate_documents(ngram, docs)) {
+            (_, Some(c)) => c,
+            (Some(docs), None) => docs.document_ids(),
+            (None, None) => self.document_ids()
+        };
+        if let Some(after_id) = after_doc_id {
+            let start = match selected.binary_search(&after_id) {
+                Ok(i) => i + 1,
+                Err(i) => i
+            };
+            selected.drain(..start);
+        }
+        selected
+    }
+
+    // Apply f to the documents in parallel, returning the results in order
+    fn map_documents<T, F>(&self, pool: &ThreadPool, doc_ids: &[DocumentId], f: F) -> Vec<T>
+        where T: Send, F: Fn(DocumentId, &Document) -> Option<T> + Sync + Send
+    {
+        pool.install(|| {
+            doc_ids.par_iter().filter_map(
+                |id| match self.get_document(*id) {
+                    None => None,
+                    Some(d) => f(*id, &d)
+                }
+            ).collect()
+        })
+    }
+
+    // Apply f to the documents in id order, stopping once limit results are
+    // found. Documents are visited in batches so that only about as many
+    // documents as needed are searched.
+    fn find_documents<T, F>(
+        &self, pool: &ThreadPool, doc_ids: &[DocumentId], limit: Option<usize>, f: F
+    ) -> Vec<T>
+        where T: Send, F: Fn(DocumentId, &Document) -> Option<T> + Sync + Send
+    {
+        let limit = match limit {
+            None => return self.map_documents(pool, doc_ids, f),
+            Some(n) => n
+        };
+        let mut results = vec![];
+        let mut start_idx = 0;
+        let mut batch_size = cmp::max(limit, MIN_LIMIT_BATCH_SIZE);
+        while results.len() < limit && start_idx < doc_ids.len() {
+            let end_idx = cmp::min(start_idx + batch_size, doc_ids.len());
+            results.extend(self.map_documents(pool, &doc_ids[start_idx..end_idx], &f));
+            start_idx = end_idx;
+            batch_size *= 2;
+        }
+        results.truncate(limit);
+        results
+    }
+
+    // Number of occurrences of the query, read from the lexicon for unigrams
+    // that are not restricted to a time window
+    fn count_document(&self, query: &SearchQuery, d: &Document, window: TimeWindow) -> usize {
+        match query {
+            SearchQuery::Unigram(unigram) if window.is_all() => unigram.iter().filter_map(
+                |t| self.lookup_posting_offsets_one(d, *t)
+            ).map(|(_, n)| n as usize).sum(),
+            SearchQuery::Unigram(unigram) => match self.lookup_posting_offsets_many(d, unigram) {
+                None => 0,
+                Some(pofs) => self.read_postings_many(d, &pofs, window).len()
+            },
+            SearchQuery::Ngram(ngram) => self.count_ngram(ngram, d, window)
+        }
+    }
+
+    fn contains_document(&self, query: &SearchQuery, d: &Document, window: TimeWindow) -> bool {
+        match query {
+            SearchQuery::Unigram(unigram) if window.is_all() => unigram.iter().any(
+                |t| self.lookup_posting_offsets_one(d, *t).is_some()),
+            SearchQuery::Unigram(_) => self.count_document(query, d, window) > 0,
+            SearchQuery::Ngram(ngram) => self.check_contains_ngram(ngram, d, window)
+        }
+    }
+
+    fn search_document(
+        &self, query: &SearchQuery, d: &Document, window: TimeWindow
+    ) -> Option<Vec<Posting>> {
+        let posting_offsets = query.tokens().iter().map(
+            |token| self.lookup_posting_offsets_many(d, token)
+        ).collect();
+        self.search_document_with(query, d, posting_offsets, window)
+    }
+
+    // Search a document given the posting offsets of each of the query's tokens
+    fn search_document_with(
+        &self, query: &SearchQuery, d: &Document, posting_offsets: Vec<Option<Vec<(usize, u32)>>>,
+        window: TimeWindow
+    ) -> Option<Vec<Posting>> {
+        match query {
+            SearchQuery::Unigram(_) => {
+                match posting_offsets[0] {
+                    None => None,
+                    Some(ref pofs) => {
+                        let postings = self.read_postings_many(d, pofs, window);
+                        if postings.len() > 0 { Some(postings) } else { None }
+                    }
+                }
+            },
+            SearchQuery::Ngram(ngram) => self.find_ngram_postings(ngram, d, posting_offsets, window)
+        }
+    }
+
+    // Search a document for several queries, looking up each token in the
+    // document lexicon only once. Returns the postings of each query found.
+    fn search_document_many(
+        &self, queries: &Vec<SearchQuery>, query_idxs: &Vec<usize>, d: &Document,
+        window: TimeWindow
+    ) -> Vec<(usize, Vec<Posting>)> {
+        let mut lookups: HashMap<TokenId, Option<(usize, u32)>> = HashMap::new();
+        let mut results = vec![];
+        for &i in query_idxs {
+            let posting_offsets = queries[i].tokens().iter().map(|token| {
+                let pofs: Vec<(usize, u32)> = token.iter().filter_map(
+                    |t| *lookups.entry(*t).or_insert_with(
+                        || self.lookup_posting_offsets_one(d, *t))
+                ).collect();
+                if pofs.len() == 0 { None } else { Some(pofs) }
+            }).collect();
+            if let Some(postings) = self.search_document_with(
+                    &queries[i], d, posting_offsets, window) {
+                results.push((i, postings));
+            }
+        }
+        results
+    }
+
     fn lookup_posting_offsets_one(&self, d: &Document, token: TokenId) -> Option<(usize, u32)> {
+        let lexicon_idx = match d.lexicon_hash {
+            Some(table) => self.lexicon_hashes[d.file_num].as_ref().unwrap().find(table, token),
+            None => self.search_lexicon(d, token)
+        };
+        lexicon_idx.map(|i| self.read_lexicon_entry(d, i))
+    }
+
+    // Binary search for the index of the token in the document lexicon
+    fn search_lexicon(&self, d: &Document, token: TokenId) -> Option<usize> {
         let m = &self.data[d.file_num];
         let mut min_idx = 0;
         let mut max_idx = d.unique_token_count as usize;
-        let token_entry_size = 2 * self.datum_size;
+        let token_entry_size = d.format.lexicon_entry_size(self.datum_size);
         let base_lexicon_offset =  d.base_offset + d.lexicon_offset;
-        loop {
-            if min_idx == max_idx {
-                return None;
-            }
+        while min_idx < max_idx {
             let pivot = (min_idx + max_idx) / 2;
-            let ofs = pivot * token_entry_size + base_lexicon_offset;
-            let pivot_token = self.read_datum(m, ofs);
+            let pivot_token = self.read_datum(m, pivot * token_entry_size + base_lexicon_offset);
             if pivot_token == token {
-                let posting_idx = self.read_datum(m, ofs + self.datum_size);
-                let posting_idx_plus_n = if pivot < (d.unique_token_count as usize) - 1 {
-                    // Get start of next entry
-                    self.read_datum(m, ofs + token_entry_size + self.datum_size)
-                } else {
-                    d.posting_count
-                };
-                assert!(posting_idx_plus_n > posting_idx, "Invalid next token posting index");
-                return Some((posting_idx as usize, posting_idx_plus_n - posting_idx))
+                return Some(pivot);
             } else if pivot_token < token {
                 min_idx = pivot + 1;
             } else {
                 max_idx = pivot;
             }
         }
+        None
+    }
+
+    // Location and length of the posting list of the i-th token in the document lexicon
+    fn read_lexicon_entry(&self, d: &Document, i: usize) -> (usize, u32) {
+        let m = &self.data[d.file_num];
+        let token_entry_size = d.format.lexicon_entry_size(self.datum_size);
+        let ofs = i * token_entry_size + d.base_offset + d.lexicon_offset;
+        let posting_idx = self.read_datum(m, ofs + self.datum_size);
+        let posting_idx_plus_n = if i < (d.unique_token_count as usize) - 1 {
+            // Get start of next entry
+            self.read_datum(m, ofs + token_entry_size + self.datum_size)
+        } else {
+            d.posting_count
+        };
+        assert!(posting_idx_plus_n > posting_idx, "Invalid next token posting index");
+        let n = posting_idx_plus_n - posting_idx;
+        match d.format {
+            PostingFormat::Fixed => (posting_idx as usize, n),
+            // Varint postings are located by byte offset
+            PostingFormat::Varint { .. } => (
+                read_mmap_u32(m, ofs + 2 * self.datum_size) as usize, n)
+        }
     }
 
     fn lookup_posting_offsets_many(&self, document: &Document, token: &Token) -> Option<Vec<(usize, u32)>> {
@@ -157,7 +940,49 @@ impl _RsCaptionIndexImpl {
         if posting_offsets.len() == 0 { None } else { Some(posting_offsets) }
     }
 
-    fn read_postings_one(&self, d: &Document, idx: usize, n: u32) -> Vec<Posting> {
+    // Decode n varint postings in the list starting at a byte offset, keeping
+    // those in the time window
+    fn decode_postings(
+        &self, d: &Document, byte_ofs: usize, n: u32, window: TimeWindow
+    ) -> Vec<Posting> {
+        let list_ofs = d.base_offset + d.inv_index_offset + byte_ofs;
+        let ofs = list_ofs + d.format.skip_count(n as usize) * SKIP_ENTRY_SIZE;
+        self.decode_postings_from(&self.data[d.file_num], ofs, n as usize, 0, 0, window)
+    }
+
+    // Decode n varint postings at a file offset, given the position and start
+    // time of the preceding posting in the list, keeping those in the time
+    // window
+    fn decode_postings_from(
+        &self, m: &Mmap, mut ofs: usize, n: usize, prev_pos: Position, prev_start: Millis,
+        window: TimeWindow
+    ) -> Vec<Posting> {
+        let mut pos = prev_pos as u64;
+        let mut start = prev_start as i64;
+        let mut postings = Vec::with_capacity(n);
+        for _ in 0..n {
+            let (pos_delta, k) = read_mmap_varint(m, ofs);
+            ofs += k;
+            let (start_delta, k) = read_mmap_varint(m, ofs);
+            ofs += k;
+            let (duration, k) = read_mmap_varint(m, ofs);
+            ofs += k;
+            pos += pos_delta;
+            start += zigzag_decode(start_delta);
+            let end = (start as u64 + duration) as Millis;
+            if window.contains(start as Millis, end) {
+                postings.push((start as Millis, end, pos as Position, 1));
+            }
+        }
+        postings
+    }
+
+    fn read_postings_one(
+        &self, d: &Document, idx: usize, n: u32, window: TimeWindow
+    ) -> Vec<Posting> {
+        if let PostingFormat::Varint { .. } = d.format {
+            return self.decode_postings(d, idx, n, window);
+        }
         assert!((idx as u32) + n <= d.posting_count, "Index + n exceeds total postings");
         let m = &self.data[d.file_num];
         let time_int_size = self.time_int_size();
@@ -168,18 +993,41 @@ impl _RsCaptionIndexImpl {
         for i in 0..(n as usize) {
             let ofs = (idx + i) * posting_size + base_ofs;
             let time_int = self.read_time_int(m, ofs);
-            let pos = self.read_datum(m, ofs + time_int_size);
-            postings.push((time_int.0, time_int.1, pos, 1))
+            if window.contains(time_int.0, time_int.1) {
+                let pos = self.read_datum(m, ofs + time_int_size);
+                postings.push((time_int.0, time_int.1, pos, 1))
+            }
         }
         postings
     }
 
     fn read_postings_many(
-        &self, document: &Document, posting_offsets: &Vec<(usize, u32)>
+        &self, document: &Document, posting_offsets: &Vec<(usize, u32)>, window: TimeWindow
     ) -> Vec<Posting> {
         assert!(posting_offsets.len() > 0, "Must contain offsets");
         if posting_offsets.len() == 1 {
-            self.read_postings_one(document, posting_offsets[0].0, posting_offsets[0].1)
+            self.read_postings_one(document, posting_offsets[0].0, posting_offsets[0].1, window)
+        } else if let PostingFormat::Varint { .. } = document.format {
+            // Varint postings can only be read sequentially, so decode each
+            // list before merging
+            let lists: Vec<Vec<Posting>> = posting_offsets.iter().map(
+                |(ofs, n)| self.decode_postings(document, *ofs, *n, window)
+            ).collect();
+            let mut iter_idxs = vec![1usize; lists.len()];
+            let mut heap: BinaryHeap<HeapPosting> = lists.iter().enumerate().filter(
+                |(_, l)| l.len() > 0
+            ).map(
+                |(i, l)| HeapPosting { origin: i, posting: l[0] }
+            ).collect();
+            let mut postings = Vec::with_capacity(lists.iter().map(|l| l.len()).sum());
+            while let Some(HeapPosting { posting, origin }) = heap.pop() {
+                postings.push(posting);
+                if iter_idxs[origin] < lists[origin].len() {
+                    heap.push(HeapPosting { origin: origin, posting: lists[origin][iter_idxs[origin]] });
+                    iter_idxs[origin] += 1;
+                }
+            }
+            postings
         } else {
             let m = &self.data[document.file_num];
             let time_int_size = self.time_int_size();
@@ -206,7 +1054,9 @@ impl _RsCaptionIndexImpl {
             }
 
             while let Some(HeapPosting { posting, origin }) = heap.pop() {
-                postings.push(posting);
+                if window.contains(posting.0, posting.1) {
+                    postings.push(posting);
+                }
                 if iter_idxs[origin] < posting_offsets[origin].1 as usize {
                     heap.push(HeapPosting {
                         origin: origin,
@@ -219,109 +1069,146 @@ impl _RsCaptionIndexImpl {
         }
     }
 
-    fn check_contains_ngram(
-        &self, ngram: &Vec<Token>, query_plan: &Vec<usize>, document: &Document
-    ) -> bool {
-        let ngram_len = ngram.len();
-        assert!(ngram_len > 1, "Ngram must have > 1 tokens");
+    fn posting_cursor(
+        &self, d: &Document, posting_offsets: &Vec<(usize, u32)>, window: TimeWindow
+    ) -> PostingCursor {
+        if posting_offsets.len() > 1 {
+            return PostingCursor::Decoded {
+                postings: self.read_postings_many(d, posting_offsets, window), idx: 0
+            };
+        }
+        let (list_idx, n) = posting_offsets[0];
+        let m = &self.data[d.file_num];
+        let base_ofs = d.base_offset + d.inv_index_offset;
+        match d.format {
+            PostingFormat::Fixed => PostingCursor::Fixed {
+                index: self, m: m, base_ofs: base_ofs + list_idx * self.posting_size(),
+                n: n as usize, idx: 0, window: window
+            },
+            PostingFormat::Varint { skip_interval } => {
+                let skip_count = d.format.skip_count(n as usize);
+                PostingCursor::Varint {
+                    index: self, m: m, skips_ofs: base_ofs + list_idx,
+                    postings_ofs: base_ofs + list_idx + skip_count * SKIP_ENTRY_SIZE,
+                    n: n as usize, skip_interval: skip_interval, skip_count: skip_count,
+                    block: vec![], block_num: None, idx: 0, window: window
+                }
+            }
+        }
+    }
+
+    fn check_contains_ngram(&self, ngram: &Ngram, document: &Document, window: TimeWindow) -> bool {
+        self.find_ngram_positions(ngram, document, true, window).len() > 0
+    }
+
+    fn count_ngram(&self, ngram: &Ngram, document: &Document, window: TimeWindow) -> usize {
+        self.find_ngram_positions(ngram, document, false, window).len()
+    }
+
+    // Start positions of the ngram, without merging times. If first_only, stop
+    // after one is found.
+    fn find_ngram_positions(
+        &self, ngram: &Ngram, document: &Document, first_only: bool, window: TimeWindow
+    ) -> Vec<Position> {
+        let num_elements = ngram.tokens.len();
+        let query_plan = &ngram.query_plan;
 
-        let posting_offsets: Vec<Option<Vec<(usize, u32)>>> = ngram.iter().map(
+        let posting_offsets: Vec<Option<Vec<(usize, u32)>>> = ngram.tokens.iter().map(
             |token| self.lookup_posting_offsets_many(document, token)
         ).collect();
 
         // One of the tokens is not present in the document
         if posting_offsets.iter().any(|v| v.is_none()) {
-            return false;
+            return vec![];
         }
 
-        let init_pos = query_plan[0];
+        let init_elem = query_plan[0];
+        let init_pos = ngram.offsets[init_elem] as u32;
         let mut cand_idxs: Vec<Position> = self.read_postings_many(
-            document, posting_offsets[init_pos].as_ref().unwrap()
+            document, posting_offsets[init_elem].as_ref().unwrap(), window
         ).iter().filter_map(|p| {
-            if p.2 < init_pos as u32 { None } else { Some(p.2 - init_pos as u32) }
+            if p.2 < init_pos { None } else { Some(p.2 - init_pos) }
         }).collect();
+        if first_only && num_elements == 1 {
+            cand_idxs.truncate(1);
+        }
 
         // Check candidate indices with postings at each position in the order of the query plan
-        for i in 1..ngram_len {
-            let pos = query_plan[i];
-            let postings = self.read_postings_many(document, posting_offsets[pos].as_ref().unwrap());
-            let postings_len = postings.len();
-            let mut postings_iter_idx = 0;
+        for i in 1..num_elements {
+            let elem = query_plan[i];
+            let pos = ngram.offsets[elem] as u32;
+            let mut cursor = self.posting_cursor(
+                document, posting_offsets[elem].as_ref().unwrap(), window);
 
             let mut new_cand_idxs = vec![];
             for cand_iter_idx in 0..cand_idxs.len() {
                 let cand_idx = cand_idxs[cand_iter_idx];
-                let exp_idx = cand_idx + pos as u32;
-                while postings_iter_idx < postings_len && postings[postings_iter_idx].2 < exp_idx {
-                    postings_iter_idx += 1;
-                }
-                if postings_iter_idx == postings_len {
-                    break;
-                }
-
-                let p2 = postings[postings_iter_idx];
+                let exp_idx = cand_idx + pos;
+                let p2 = match cursor.seek(exp_idx) {
+                    Some(p) => p,
+                    None => break
+                };
                 if p2.2 == exp_idx {
-                    if i == ngram_len - 1 {
-                        return true;    // Short circuit as soon as one is found
-                    } else {
-                        new_cand_idxs.push(cand_idx);
+                    new_cand_idxs.push(cand_idx);
+                    if first_only && i == num_elements - 1 {
+                        return new_cand_idxs;    // Short circuit as soon as one is found
                     }
                 }
             }
-            if new_cand_idxs.len() == 0 {
+            cand_idxs = new_cand_idxs;
+            if cand_idxs.len() == 0 {
                 break;
             }
-            cand_idxs = new_cand_idxs;
         }
-        false
+        cand_idxs
     }
 
+    // Postings of the ngram. A phrase lies within the time window only if each
+    // of its elements does, so the window is applied as each list is read.
     fn find_ngram_postings(
-        &self, ngram: &Vec<Token>, query_plan: &Vec<usize>, document: &Document
+        &self, ngram: &Ngram, document: &Document,
+        posting_offsets: Vec<Option<Vec<(usize, u32)>>>, window: TimeWindow
     ) -> Option<Vec<Posting>> {
-        let ngram_len = ngram.len();
-
-        let posting_offsets: Vec<Option<Vec<(usize, u32)>>> = ngram.iter().map(
-            |token| self.lookup_posting_offsets_many(document, token)
-        ).collect();
+        let num_elements = ngram.tokens.len();
+        let ngram_len = ngram.len as u32;
+        let query_plan = &ngram.query_plan;
 
         // One of the tokens is not present in the document
         if posting_offsets.iter().any(|v| v.is_none()) {
             return None;
         }
 
-        let init_pos = query_plan[0];
+        let init_elem = query_plan[0];
+        let init_pos = ngram.offsets[init_elem] as u32;
         let mut postings1: Vec<Posting> = self.read_postings_many(
-            document, posting_offsets[init_pos].as_ref().unwrap()
+            document, posting_offsets[init_elem].as_ref().unwrap(), window
         ).iter().filter_map(|p| {
-            if p.2 < init_pos as u32 { None } else {
-                Some((p.0, p.1, p.2 - init_pos as u32, ngram_len as u32))
+            if p.2 < init_pos { None } else {
+                Some((p.0, p.1, p.2 - init_pos, ngram_len))
             }
         }).collect();
+        if postings1.len() == 0 {
+            return None;
+        }
 
         // Merge lists of postings in a pairwise manner according to the query plan
-        for i in 1..ngram_len {
-            let pos = query_plan[i];
-            let postings2 = self.read_postings_many(
-                document, posting_offsets[pos].as_ref().unwrap());
-            let postings2_len = postings2.len();
-            let mut posting2_iter_idx = 0;
+        for i in 1..num_elements {
+            let elem = query_plan[i];
+            let pos = ngram.offsets[elem] as u32;
+            let mut cursor2 = self.posting_cursor(
+                document, posting_offsets[elem].as_ref().unwrap(), window);
 
             let mut new_postings = vec![];
             for postings1_iter_idx in 0..postings1.len() {
                 let p1 = postings1[postings1_iter_idx];
-                let exp_p2_idx = p1.2 + pos as u32;
-                while posting2_iter_idx < postings2_len && postings2[posting2_iter_idx].2 < exp_p2_idx {
-                    posting2_iter_idx += 1;
-                }
-                if posting2_iter_idx == postings2_len {
-                    break;
-                }
-
-                let p2 = postings2[posting2_iter_idx];
+                let exp_p2_idx = p1.2 + pos;
+                let p2 = match cursor2.seek(exp_p2_idx) {
+                    Some(p) => p,
+                    None => break
+                };
                 if p2.2 == exp_p2_idx {
                     new_postings.push((cmp::min(p1.0, p2.0), cmp::max(p1.1, p2.1),
-                                       p1.2, ngram_len as u32))
+                                       p1.2, ngram_len))
                 }
             }
             if new_postings.len() == 0 {
@@ -348,140 +1235,352 @@ fn encode_postings(postings: &Vec<Posting>) -> Vec<u8> {
     buf
 }
 
+#[pyclass]
+pub struct RsSearchIterator {
+    index: Arc<_RsCaptionIndexImpl>,
+    pool: Arc<ThreadPool>,
+    query: SearchQuery,
+    window: TimeWindow,
+
+    // Documents left to search
+    doc_ids: Vec<DocumentId>,
+    next_idx: usize,
+    batch_size: usize,
+
+    // Number of matching documents left to return
+    remaining: Option<usize>
+}
+
+impl RsSearchIterator {
+
+    // Search the next batch of documents that has any matches
+    fn next_batch(&mut self) -> Option<Vec<(DocumentId, Vec<u8>)>> {
+        while self.next_idx < self.doc_ids.len() && self.remaining != Some(0) {
+            let end_idx = cmp::min(self.next_idx + self.batch_size, self.doc_ids.len());
+            let index = &self.index;
+            let query = &self.query;
+            let window = self.window;
+            let mut batch = index.map_documents(
+                &self.pool, &self.doc_ids[self.next_idx..end_idx],
+                |id, d| match index.search_document(query, d, window) {
+                    None => None,
+                    Some(p) => Some((id, encode_postings(&p)))
+                });
+            self.next_idx = end_idx;
+            if let Some(n) = self.remaining {
+                batch.truncate(n);
+                self.remaining = Some(n - batch.len());
+            }
+            if batch.len() > 0 {
+                return Some(batch);
+            }
+        }
+        None
+    }
+}
+
+#[pyproto]
+impl PyIterProtocol for RsSearchIterator {
+
+    fn __iter__(slf: PyRef<Self>) -> Py<RsSearchIterator> {
+        slf.into()
+    }
+
+    // Returns a list of (document id, encoded postings)
+    fn __next__(mut slf: PyRefMut<Self>) -> PyResult<Option<PyObject>> {
+        let py = slf.py();
+        let it = &mut *slf;
+        match py.allow_threads(|| it.next_batch()) {
+            None => Ok(None),
+            Some(batch) => {
+                let batch: Vec<(DocumentId, PyObject)> = batch.iter().map(
+                    |(id, p)| (*id, PyBytes::new(py, p).to_object(py))
+                ).collect();
+                Ok(Some(batch.into_py(py)))
+            }
+        }
+    }
+}
+
 #[pyclass]
 pub struct RsCaptionIndex {
-    _impl: _RsCaptionIndexImpl,
+    _impl: Arc<_RsCaptionIndexImpl>,
+    pool: Arc<ThreadPool>,
     debug: bool
 }
 
+impl RsCaptionIndex {
+
+    fn search_iter(
+        &self, py: Python, query: SearchQuery, docs: Option<&RsDocumentSet>, batch_size: usize,
+        limit: Option<usize>, after_doc_id: Option<DocumentId>, window: TimeWindow
+    ) -> RsSearchIterator {
+        let doc_ids = py.allow_threads(
+            || self._impl.select_documents(&query.tokens(), docs, after_doc_id));
+        if self.debug {
+            eprintln!("  visiting {} documents", doc_ids.len());
+        }
+        RsSearchIterator {
+            index: self._impl.clone(), pool: self.pool.clone(), query: query, window: window,
+            doc_ids: doc_ids, next_idx: 0, batch_size: cmp::max(batch_size, 1),
+            remaining: limit
+        }
+    }
+
+    fn contains_ids(
+        &self, py: Python, query: SearchQuery, docs: Option<&RsDocumentSet>,
+        limit: Option<usize>, after_doc_id: Option<DocumentId>, window: TimeWindow
+    ) -> RsDocumentSet {
+        py.allow_threads(|| {
+            let doc_ids = self._impl.select_documents(&query.tokens(), docs, after_doc_id);
+            if self.debug {
+                eprintln!("  visiting {} documents", doc_ids.len());
+            }
+            let found = self._impl.find_documents(&self.pool, &doc_ids, limit, |id, d| {
+                if self._impl.contains_document(&query, d, window) {Some(id)} else {None}
+            });
+            RsDocumentSet::from_ids(&found)
+        })
+    }
+
+    fn search_many_ids(
+        &self, py: Python, queries: Vec<SearchQuery>, docs: Option<&RsDocumentSet>,
+        window: TimeWindow
+    ) -> Vec<Vec<(DocumentId, Vec<u8>)>> {
+        py.allow_threads(|| {
+            // Queries to search in each document, so that the documents are
+            // visited once for all of the queries
+            let mut doc_queries: BTreeMap<DocumentId, Vec<usize>> = BTreeMap::new();
+            for (i, query) in queries.iter().enumerate() {
+                for doc_id in self._impl.select_documents(&query.tokens(), docs, None) {
+                    doc_queries.entry(doc_id).or_insert(vec![]).push(i);
+                }
+            }
+            if self.debug {
+                eprintln!("  visiting {} documents", doc_queries.len());
+            }
+            let ids: Vec<DocumentId> = doc_queries.keys().cloned().collect();
+            let found = self._impl.map_documents(&self.pool, &ids, |id, d| {
+                let postings = self._impl.search_document_many(
+                    &queries, &doc_queries[&id], d, window);
+                if postings.len() > 0 {Some((id, postings))} else {None}
+            });
+            let mut results: Vec<Vec<(DocumentId, Vec<u8>)>> = queries.iter().map(|_| vec![]).collect();
+            for (id, postings) in found {
+                for (i, p) in postings {
+                    results[i].push((id, encode_postings(&p)));
+                }
+            }
+            results
+        })
+    }
+
+    fn count_ids(
+        &self, py: Python, query: SearchQuery, docs: Option<&RsDocumentSet>, window: TimeWindow
+    ) -> Vec<(DocumentId, usize)> {
+        py.allow_threads(|| {
+            let doc_ids = self._impl.select_documents(&query.tokens(), docs, None);
+            if self.debug {
+                eprintln!("  visiting {} documents", doc_ids.len());
+            }
+            self._impl.map_documents(&self.pool, &doc_ids, |id, d| {
+                match self._impl.count_document(&query, d, window) {
+                    0 => None,
+                    n => Some((id, n))
+                }
+            })
+        })
+    }
+}
+
+// Number of documents to search, for debug output
+fn describe_documents(docs: &Option<PyRef<RsDocumentSet>>) -> String {
+    match docs {
+        None => "all".to_string(),
+        Some(d) => d.len().to_string()
+    }
+}
+
 #[pymethods]
 impl RsCaptionIndex {
 
+    fn warm(&self, py: Python, lexicons_only: bool, lock: bool) -> PyResult<usize> {
+        match py.allow_threads(|| self._impl.warm(lexicons_only, lock)) {
+            Ok(n) => Ok(n),
+            Err(e) => Err(exceptions::OSError::py_err(format!("Unable to warm index: {}", e)))
+        }
+    }
+
+    fn unlock(&self) -> PyResult<()> {
+        for m in self._impl.data.iter().chain(self._impl.sidecar_mmaps().into_iter()) {
+            if let Err(e) = unlock_mmap(m) {
+                return Err(exceptions::OSError::py_err(format!("Unable to unlock index: {}", e)));
+            }
+        }
+        Ok(())
+    }
+
+    // Set the expected access pattern of the index files
+    fn advise(&self, advice: String) -> PyResult<()> {
+        let advice = match MmapAdvice::parse(&advice) {
+            Ok(advice) => advice,
+            Err(e) => return Err(exceptions::ValueError::py_err(e))
+        };
+        for m in self._impl.data.iter() {
+            if let Err(e) = advise_mmap(m, 0, m.len(), advice) {
+                return Err(exceptions::OSError::py_err(format!("Unable to advise index: {}", e)));
+            }
+        }
+        Ok(())
+    }
+
+    // Returns the bytes of the index in memory and the total bytes mapped
+    fn resident_bytes(&self) -> PyResult<(usize, usize)> {
+        let mut resident = 0;
+        let mut total = 0;
+        for m in self._impl.data.iter().chain(self._impl.sidecar_mmaps().into_iter()) {
+            match resident_mmap_bytes(m) {
+                Ok(n) => resident += n,
+                Err(e) => return Err(exceptions::OSError::py_err(
+                    format!("Unable to check residency: {}", e)))
+            }
+            total += m.len();
+        }
+        Ok((resident, total))
+    }
+
     fn document_exists(&self, doc_id: DocumentId) -> bool {
-        self._impl.docs.get(&doc_id).is_some()
+        self._impl.get_document(doc_id).is_some()
     }
 
-    fn unigram_search<'p>(
-        &self, py: Python<'p>, unigram: Token, mut doc_ids: Vec<DocumentId>
-    ) -> Vec<(DocumentId, &'p PyBytes)> {
+    fn unigram_search(
+        &self, py: Python, unigram: Token, docs: Option<PyRef<RsDocumentSet>>,
+        batch_size: usize, limit: Option<usize>, after_doc_id: Option<DocumentId>,
+        start_time: Seconds, end_time: Seconds
+    ) -> RsSearchIterator {
         if self.debug {
-            let len_str = doc_ids.len().to_string();
             eprintln!("unigram search: [{:?}] in {} documents", unigram,
-                      if doc_ids.len() > 0 {len_str.as_str()} else {"all"});
+                      describe_documents(&docs));
         }
-
-        let lookup_and_read_postings = |id, d| {
-            match self._impl.lookup_posting_offsets_many(d, &unigram) {
-                None => None,
-                Some(pofs) => Some({
-                    let postings = self._impl.read_postings_many(d, &pofs);
-                    (id, PyBytes::new(py, &encode_postings(&postings)))
-                })
-            }
-        };
-        let docs_to_unigrams =
-            if doc_ids.len() > 0 {
-                doc_ids.sort();
-                doc_ids.iter().filter_map(
-                    |id| match self._impl.docs.get(&id) {
-                        None => None,
-                        Some(d) => lookup_and_read_postings(*id, d)
-                    }
-                ).collect()
-            } else {
-                self._impl.docs.iter().filter_map(
-                    |(id, d)| lookup_and_read_postings(*id, d)
-                ).collect()
-            };
-        docs_to_unigrams
+        let docs = docs.as_ref().map(|d| &**d);
+        self.search_iter(py, SearchQuery::Unigram(unigram), docs, batch_size, limit,
+                         after_doc_id, TimeWindow::new(start_time, end_time))
     }
 
     fn unigram_contains(
-        &self, unigram: Token, mut doc_ids: Vec<DocumentId>
-    ) -> HashSet<DocumentId> {
+        &self, py: Python, unigram: Token, docs: Option<PyRef<RsDocumentSet>>,
+        limit: Option<usize>, after_doc_id: Option<DocumentId>, start_time: Seconds,
+        end_time: Seconds
+    ) -> RsDocumentSet {
         if self.debug {
-            let len_str = doc_ids.len().to_string();
             eprintln!("unigram contains: [{:?}] in {} documents", unigram,
-                      if doc_ids.len() > 0 {len_str.as_str()} else {"all"});
-        }
-        let has_unigram = |id, d| if unigram.iter().any(
-            |t| self._impl.lookup_posting_offsets_one(d, *t).is_some()
-        ) {Some(id)} else {None};
-        let docs_w_token =
-            if doc_ids.len() > 0 {
-                doc_ids.sort();
-                doc_ids.iter().filter_map(
-                    |id| match self._impl.docs.get(&id) {
-                        None => None,
-                        Some(d) => has_unigram(*id, d)
-                    }
-                ).collect()
-            } else {
-                self._impl.docs.iter().filter_map(|(id, d)| has_unigram(*id, d)).collect()
-            };
-        docs_w_token
+                      describe_documents(&docs));
+        }
+        let docs = docs.as_ref().map(|d| &**d);
+        self.contains_ids(py, SearchQuery::Unigram(unigram), docs, limit, after_doc_id,
+                          TimeWindow::new(start_time, end_time))
     }
 
-    fn ngram_search<'p>(
-        &self, py: Python<'p>, ngram: Vec<Token>, mut doc_ids: Vec<DocumentId>, query_plan: Vec<usize>
-    ) -> Vec<(DocumentId, &'p PyBytes)> {
-        assert!(ngram.len() > 1, "Unigrams should be searched with unigram_search()");
+    // Returns (document id, occurrence count) for documents that contain the
+    // unigram, in id order
+    fn unigram_count(
+        &self, py: Python, unigram: Token, docs: Option<PyRef<RsDocumentSet>>,
+        start_time: Seconds, end_time: Seconds
+    ) -> Vec<(DocumentId, usize)> {
         if self.debug {
-            let len_str = doc_ids.len().to_string();
-            eprintln!("ngram search: {:?} in {} documents", ngram,
-                      if doc_ids.len() > 0 {len_str.as_str()} else {"all"});
+            eprintln!("unigram count: [{:?}] in {} documents", unigram,
+                      describe_documents(&docs));
         }
-        let search_postings = |id, d| {
-            match self._impl.find_ngram_postings(&ngram, &query_plan, d) {
-                None => None,
-                Some(p) => Some((id, PyBytes::new(py, &encode_postings(&p))))
-            }
-        };
-        let docs_to_ngrams =
-            if doc_ids.len() > 0 {
-                doc_ids.sort();
-                doc_ids.iter().filter_map(
-                    |id| match self._impl.docs.get(&id) {
-                        None => None,
-                        Some(d) => search_postings(*id, d)
-                    }
-                ).collect()
-            } else {
-                self._impl.docs.iter().filter_map(
-                    |(id, d)| search_postings(*id, d)
-                ).collect()
-            };
-        docs_to_ngrams
+        let docs = docs.as_ref().map(|d| &**d);
+        self.count_ids(py, SearchQuery::Unigram(unigram), docs,
+                       TimeWindow::new(start_time, end_time))
+    }
+
+    fn ngram_search(
+        &self, py: Python, ngram: Vec<Token>, offsets: Vec<usize>, ngram_len: usize,
+        docs: Option<PyRef<RsDocumentSet>>, query_plan: Vec<usize>, batch_size: usize,
+        limit: Option<usize>, after_doc_id: Option<DocumentId>, start_time: Seconds,
+        end_time: Seconds
+    ) -> RsSearchIterator {
+        assert!(ngram_len > 1, "Unigrams should be searched with unigram_search()");
+        if self.debug {
+            eprintln!("ngram search: {:?} at {:?} in {} documents", ngram, offsets,
+                      describe_documents(&docs));
+        }
+        let ngram = Ngram { tokens: ngram, offsets: offsets, len: ngram_len, query_plan: query_plan };
+        let docs = docs.as_ref().map(|d| &**d);
+        self.search_iter(py, SearchQuery::Ngram(ngram), docs, batch_size, limit, after_doc_id,
+                         TimeWindow::new(start_time, end_time))
     }
 
     fn ngram_contains(
-        &self, ngram: Vec<Token>, mut doc_ids: Vec<DocumentId>, query_plan: Vec<usize>
-    ) -> HashSet<DocumentId> {
-        assert!(ngram.len() > 1, "Unigrams should be searched with unigram_contains()");
+        &self, py: Python, ngram: Vec<Token>, offsets: Vec<usize>, ngram_len: usize,
+        docs: Option<PyRef<RsDocumentSet>>, query_plan: Vec<usize>, limit: Option<usize>,
+        after_doc_id: Option<DocumentId>, start_time: Seconds, end_time: Seconds
+    ) -> RsDocumentSet {
+        assert!(ngram_len > 1, "Unigrams should be searched with unigram_contains()");
         if self.debug {
-            let len_str = doc_ids.len().to_string();
-            eprintln!("ngram contains: {:?} in {} documents", ngram,
-                      if doc_ids.len() > 0 {len_str.as_str()} else {"all"});
-        }
-        let has_ngram = |id, d| if self._impl.check_contains_ngram(&ngram, &query_plan, d) {
-            Some(id)
-        } else { None };
-        let docs_w_ngram =
-            if doc_ids.len() > 0 {
-                doc_ids.sort();
-                doc_ids.iter().filter_map(|id| match self._impl.docs.get(&id) {
-                     None => None,
-                     Some(d) => has_ngram(*id, d)
-                }).collect()
-            } else {
-                self._impl.docs.iter().filter_map(|(id, d)| has_ngram(*id, d)).collect()
-            };
-        docs_w_ngram
+            eprintln!("ngram contains: {:?} at {:?} in {} documents", ngram, offsets,
+                      describe_documents(&docs));
+        }
+        let ngram = Ngram { tokens: ngram, offsets: offsets, len: ngram_len, query_plan: query_plan };
+        let docs = docs.as_ref().map(|d| &**d);
+        self.contains_ids(py, SearchQuery::Ngram(ngram), docs, limit, after_doc_id,
+                          TimeWindow::new(start_time, end_time))
+    }
+
+    fn ngram_count(
+        &self, py: Python, ngram: Vec<Token>, offsets: Vec<usize>, ngram_len: usize,
+        docs: Option<PyRef<RsDocumentSet>>, query_plan: Vec<usize>, start_time: Seconds,
+        end_time: Seconds
+    ) -> Vec<(DocumentId, usize)> {
+        assert!(ngram_len > 1, "Unigrams should be counted with unigram_count()");
+        if self.debug {
+            eprintln!("ngram count: {:?} at {:?} in {} documents", ngram, offsets,
+                      describe_documents(&docs));
+        }
+        let ngram = Ngram { tokens: ngram, offsets: offsets, len: ngram_len, query_plan: query_plan };
+        let docs = docs.as_ref().map(|d| &**d);
+        self.count_ids(py, SearchQuery::Ngram(ngram), docs,
+                       TimeWindow::new(start_time, end_time))
+    }
+
+    // Each query is (tokens, offsets, length, query plan), as in ngram_search(),
+    // with a length of 1 for unigrams. Returns a list of (document id, encoded
+    // postings) for each query.
+    fn search_many(
+        &self, py: Python, queries: Vec<(Vec<Token>, Vec<usize>, usize, Vec<usize>)>,
+        docs: Option<PyRef<RsDocumentSet>>, start_time: Seconds, end_time: Seconds
+    ) -> PyObject {
+        if self.debug {
+            eprintln!("search many: {} queries in {} documents", queries.len(),
+                      describe_documents(&docs));
+        }
+        let queries: Vec<SearchQuery> = queries.into_iter().map(
+            |(tokens, offsets, ngram_len, query_plan)| {
+                if ngram_len == 1 {
+                    assert!(tokens.len() == 1, "Unigram must have 1 token");
+                    SearchQuery::Unigram(tokens.into_iter().next().unwrap())
+                } else {
+                    SearchQuery::Ngram(Ngram {
+                        tokens: tokens, offsets: offsets, len: ngram_len, query_plan: query_plan
+                    })
+                }
+            }).collect();
+        let docs = docs.as_ref().map(|d| &**d);
+        let results: Vec<Vec<(DocumentId, PyObject)>> =
+            self.search_many_ids(py, queries, docs, TimeWindow::new(start_time, end_time)).iter().map(
+                |result| result.iter().map(
+                    |(id, p)| (*id, PyBytes::new(py, p).to_object(py))
+                ).collect()
+            ).collect();
+        results.into_py(py)
     }
 
     #[new]
     unsafe fn new(index_path: String, datum_size: usize,
-                  start_time_size: usize, end_time_size: usize, debug: bool
+                  start_time_size: usize, end_time_size: usize, num_threads: usize,
+                  debug: bool
     ) -> PyResult<Self> {
         let mut index_files = vec![];
         match metadata(index_path.clone()) {
@@ -490,6 +1589,9 @@ impl RsCaptionIndex {
                     let index_paths = read_dir(index_path.clone()).unwrap();
                     for entry in index_paths {
                         let fname = entry.unwrap().path().file_name().unwrap().to_string_lossy().into_owned();
+                        if INDEX_SIDECAR_EXTS.iter().any(|ext| fname.ends_with(ext)) {
+                            continue;
+                        }
                         let mut fpath = index_path.clone();
                         fpath.push_str("/");
                         fpath.push_str(&fname);
@@ -506,18 +1608,77 @@ impl RsCaptionIndex {
             MmapOptions::new().map(&File::open(&index_path).unwrap()).unwrap()
         }).collect();
 
-        let mut docs = BTreeMap::new();
+        let mut index_formats = vec![];
         for i in 0..index_mmaps.len() {
-            let chunk_docs = parse_index(
-                &index_mmaps[i], i, datum_size, start_time_size, end_time_size, debug);
-            docs.extend(chunk_docs);
+            match read_index_header(&index_mmaps[i]) {
+                Ok(f) => index_formats.push(f),
+                Err(e) => return Err(exceptions::IOError::py_err(
+                    format!("{}: {}", index_files[i], e)))
+            }
+        }
+
+        // Use the document tables when available instead of parsing the index
+        let mut tables = vec![];
+        for i in 0..index_mmaps.len() {
+            let (format, header_size) = index_formats[i];
+            let table_path = format!("{}{}", index_files[i], DOC_TABLE_EXT);
+            let loaded = load_sidecar(
+                &table_path, |m| DocumentTable::load(m, i, format, datum_size));
+            let table = match loaded {
+                Some(table) => table,
+                None => DocumentTable::Parsed(parse_index(
+                    &index_mmaps[i], i, format, header_size, datum_size, start_time_size,
+                    end_time_size, debug))
+            };
+            if table.len() > 0 {
+                tables.push(table);
+            }
+        }
+        tables.sort_by_key(|t| t.first_id());
+        if (1..tables.len()).any(|i| tables[i - 1].last_id() >= tables[i].first_id()) {
+            // Document ids are interleaved across files, so combine the tables
+            let mut docs = BTreeMap::new();
+            for table in tables.iter() {
+                for doc_id in table.ids() {
+                    docs.insert(doc_id, table.get(doc_id).unwrap());
+                }
+            }
+            tables = vec![DocumentTable::Parsed(docs)];
         }
 
+        // Older indexes do not have document frequency indexes
+        let doc_freqs: Vec<Option<DocumentFrequencyIndex>> = index_files.iter().map(|index_path| {
+            load_sidecar(&format!("{}{}", index_path, DOC_FREQ_INDEX_EXT),
+                         DocumentFrequencyIndex::load)
+        }).collect();
+        if debug {
+            eprintln!("Loaded {} of {} document frequency indexes",
+                      doc_freqs.iter().filter(|df| df.is_some()).count(), doc_freqs.len());
+        }
+
+        // Lexicon hash indexes are optional, and lookups fall back to binary search
+        let lexicon_hashes: Vec<Option<LexiconHashIndex>> = index_files.iter().map(|index_path| {
+            load_sidecar(&format!("{}{}", index_path, LEXICON_HASH_EXT),
+                         LexiconHashIndex::load)
+        }).collect();
+        if debug {
+            eprintln!("Loaded {} of {} lexicon hash indexes",
+                      lexicon_hashes.iter().filter(|h| h.is_some()).count(), lexicon_hashes.len());
+        }
+
+        // num_threads == 0 lets rayon choose based on the number of CPUs
+        let pool = match ThreadPoolBuilder::new().num_threads(num_threads).build() {
+            Ok(pool) => pool,
+            Err(_e) => return Err(exceptions::RuntimeError::py_err("Unable to create thread pool"))
+        };
+
         Ok(RsCaptionIndex {
-            _impl: _RsCaptionIndexImpl {
-                docs: docs, data: index_mmaps, datum_size: datum_size,
+            _impl: Arc::new(_RsCaptionIndexImpl {
+                tables: tables, data: index_mmaps, doc_freqs: doc_freqs,
+                lexicon_hashes: lexicon_hashes, datum_size: datum_size,
                 start_time_size: start_time_size, end_time_size: end_time_size
-            },
+            }),
+            pool: Arc::new(pool),
             debug: debug
         })
     }
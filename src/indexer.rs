@@ -1,7 +1,9 @@
 /* Indexer utils in Rust */
 
 use std::collections::{HashMap,BTreeMap};
+use std::fs;
 use std::fs::File;
+use std::io;
 use std::io::prelude::*;
 use std::path::{PathBuf, Path};
 use std::cmp;
@@ -120,6 +122,62 @@ pub fn count_tokens(doc_paths: &Vec<String>, max_token_len: usize, batch_size: u
     all_counts
 }
 
+fn count_bigrams_part(
+    doc_paths: &Vec<String>, words: &HashMap<String, TokenId>, is_aligned: bool
+) -> HashMap<(TokenId, TokenId), usize> {
+    let mut counts = HashMap::new();
+    for doc_path in doc_paths {
+        let path = PathBuf::from(doc_path);
+        match read_file(&path) {
+            Some(file_content) => {
+                let format = get_subtitle_format(path.extension(), file_content.as_bytes()).expect("unknown format");
+                let subtitle_file = parse_str(format, &file_content, 0.).expect("parser error");
+                let subtitle_entries = subtitle_file.get_subtitle_entries().expect("unexpected error");
+                // Bigrams span lines, as ngram searches do
+                let mut prev: Option<TokenId> = None;
+                for token in subtitle_entries.iter().filter_map(|x| x.line.as_ref()).flat_map(
+                    |x| line_to_tokens(&x, is_aligned)
+                ) {
+                    let curr = words.get(&token).cloned();
+                    if let (Some(a), Some(b)) = (prev, curr) {
+                        let count = counts.entry((a, b)).or_insert(0usize);
+                        *count += 1;
+                    }
+                    prev = curr;
+                }
+            },
+            None => {}
+        }
+    }
+    counts
+}
+
+// Count adjacent pairs of the given words
+pub fn count_bigrams(doc_paths: &Vec<String>, words: &HashMap<String, TokenId>, batch_size: usize,
+                     is_aligned: bool) -> HashMap<(TokenId, TokenId), usize> {
+    let mut doc_batches = Vec::new();
+    for i in 0..(doc_paths.len() as f64 / batch_size as f64).ceil() as usize {
+        let base_idx = i * batch_size;
+        doc_batches.push(doc_paths[base_idx..cmp::min(base_idx + batch_size, doc_paths.len())].to_vec());
+    }
+
+    let pbar = ProgressBar::new(doc_paths.len() as u64);
+    pbar.tick();
+
+    let mut all_counts = HashMap::new();
+    for part_counts in doc_batches.par_iter().map(|d| {
+        let result = count_bigrams_part(&d, words, is_aligned);
+        pbar.inc(d.len() as u64);
+        result
+    }).collect::<Vec<HashMap<(TokenId, TokenId), usize>>>().iter() {
+        for (bigram, n) in part_counts {
+            let count = all_counts.entry(*bigram).or_insert(0usize);
+            *count += n;
+        }
+    }
+    all_counts
+}
+
 #[inline]
 fn write_u32(f: &mut File, v: u32) -> () {
     let mut buf = vec![0u8; 4];
@@ -127,6 +185,13 @@ fn write_u32(f: &mut File, v: u32) -> () {
     f.write_all(&buf).unwrap();
 }
 
+#[inline]
+fn write_u64(f: &mut File, v: u64) -> () {
+    let mut buf = vec![0u8; 8];
+    LittleEndian::write_u64(&mut buf, v);
+    f.write_all(&buf).unwrap();
+}
+
 #[inline]
 fn write_data(f: &mut File, mut v: u32, datum_size: usize) -> () {
     let mut buf = vec![0u8; datum_size];
@@ -138,6 +203,15 @@ fn write_data(f: &mut File, mut v: u32, datum_size: usize) -> () {
     f.write_all(&buf).unwrap();
 }
 
+#[inline]
+fn push_varint(buf: &mut Vec<u8>, mut v: u64) -> () {
+    while v >= 0x80 {
+        buf.push((v as u8) | 0x80);
+        v = v >> 7;
+    }
+    buf.push(v as u8);
+}
+
 #[inline]
 fn write_time_interval(
     f: &mut File, start: u32, end: u32, start_time_size: usize, end_time_size: usize
@@ -147,10 +221,66 @@ fn write_time_interval(
     write_data(f, delta, end_time_size);
 }
 
+fn write_compressed_inverted_index(
+    f: &mut File, doc_id: usize, inverted_idx: &BTreeMap<TokenId, Vec<(Position, Millis, Millis)>>,
+    num_postings: usize, datum_size: usize, format: PostingFormat
+) -> usize {
+    let skip_interval = match format {
+        PostingFormat::Varint { skip_interval } => skip_interval,
+        PostingFormat::Fixed => panic!("Not a compressed format")
+    };
+    let mut posting_buf = Vec::new();
+    let mut posting_byte_offsets = Vec::with_capacity(inverted_idx.len());
+    let mut list_buf = Vec::new();
+    for (_, postings) in inverted_idx {
+        posting_byte_offsets.push(posting_buf.len());
+        list_buf.clear();
+        let skip_count = format.skip_count(postings.len());
+        let mut skips = Vec::with_capacity(skip_count);
+        let mut prev_position = 0;
+        let mut prev_start = 0;
+        for (i, (position, start, end)) in postings.iter().enumerate() {
+            if skips.len() < skip_count && i > 0 && i % skip_interval == 0 {
+                skips.push((prev_position, prev_start, list_buf.len() as u32));
+            }
+            push_varint(&mut list_buf, (*position - prev_position) as u64);
+            push_varint(&mut list_buf, zigzag_encode(*start as i64 - prev_start as i64));
+            push_varint(&mut list_buf, (*end - *start) as u64);
+            prev_position = *position;
+            prev_start = *start;
+        }
+        assert!(skips.len() == skip_count);
+        for (position, start, byte_offset) in skips {
+            let mut buf = [0u8; SKIP_ENTRY_SIZE];
+            LittleEndian::write_u32(&mut buf[0..4], position);
+            LittleEndian::write_u32(&mut buf[4..8], start);
+            LittleEndian::write_u32(&mut buf[8..12], byte_offset);
+            posting_buf.extend_from_slice(&buf);
+        }
+        posting_buf.extend_from_slice(&list_buf);
+    }
+
+    write_u32(f, doc_id as u32);
+    write_u32(f, inverted_idx.len() as u32);
+    write_u32(f, num_postings as u32);
+    write_u32(f, posting_buf.len() as u32);
+    let mut i = 0;
+    for ((token_id, postings), byte_offset) in inverted_idx.iter().zip(posting_byte_offsets.iter()) {
+        write_data(f, *token_id, datum_size);
+        write_data(f, i as u32, datum_size);
+        write_u32(f, *byte_offset as u32);
+        i += postings.len();
+    }
+    assert!(i == num_postings);
+    f.write_all(&posting_buf).unwrap();
+    format.lexicon_offset() + inverted_idx.len() * format.lexicon_entry_size(datum_size) +
+        posting_buf.len()
+}
+
 fn write_inverted_index(
     f: &mut File, doc_id: usize, inverted_idx: &BTreeMap<TokenId, Vec<(Position, Millis, Millis)>>,
     num_postings: usize, datum_size: usize, start_time_size: usize, end_time_size: usize
-) -> () {
+) -> usize {
     write_u32(f, doc_id as u32);
     write_u32(f, inverted_idx.len() as u32);
     write_u32(f, num_postings as u32);
@@ -167,6 +297,87 @@ fn write_inverted_index(
             write_data(f, *position as u32, datum_size);
         }
     }
+    3 * 4 + inverted_idx.len() * 2 * datum_size +
+        num_postings * (start_time_size + end_time_size + datum_size)
+}
+
+fn write_doc_table(
+    out_path: &String, doc_table: &mut Vec<(DocumentId, usize, usize, usize)>
+) -> () {
+    doc_table.sort();
+    let mut f = File::create(out_path).expect("error writing file");
+    write_u32(&mut f, DOC_TABLE_MAGIC);
+    write_u32(&mut f, DOC_TABLE_VERSION);
+    write_u32(&mut f, doc_table.len() as u32);
+    for (doc_id, offset, unique_token_count, posting_count) in doc_table.iter() {
+        write_u32(&mut f, *doc_id);
+        write_u64(&mut f, *offset as u64);
+        write_u32(&mut f, *unique_token_count as u32);
+        write_u32(&mut f, *posting_count as u32);
+    }
+}
+
+// Open addressing hash table of the tokens in a document lexicon
+fn build_lexicon_hash(
+    inverted_idx: &BTreeMap<TokenId, Vec<(Position, Millis, Millis)>>
+) -> Vec<(TokenId, u32)> {
+    let slot_count = lexicon_hash_slot_count(inverted_idx.len());
+    let mut slots = vec![(EMPTY_HASH_SLOT, 0u32); slot_count];
+    for (i, token_id) in inverted_idx.keys().enumerate() {
+        let mut j = lexicon_hash_slot(*token_id, slot_count);
+        while slots[j].0 != EMPTY_HASH_SLOT {
+            j = (j + 1) % slot_count;
+        }
+        slots[j] = (*token_id, i as u32);
+    }
+    slots
+}
+
+fn write_lexicon_hash_index(
+    out_path: &String, lexicon_hashes: &mut Vec<(DocumentId, Vec<(TokenId, u32)>)>
+) -> () {
+    lexicon_hashes.sort_by_key(|x| x.0);
+    let mut f = File::create(out_path).expect("error writing file");
+    write_u32(&mut f, LEXICON_HASH_MAGIC);
+    write_u32(&mut f, LEXICON_HASH_VERSION);
+    write_u32(&mut f, lexicon_hashes.len() as u32);
+    let mut offset = LEXICON_HASH_HEADER_SIZE + lexicon_hashes.len() * LEXICON_HASH_ENTRY_SIZE;
+    for (doc_id, slots) in lexicon_hashes.iter() {
+        write_u32(&mut f, *doc_id);
+        write_u64(&mut f, offset as u64);
+        write_u32(&mut f, slots.len() as u32);
+        offset += slots.len() * LEXICON_HASH_SLOT_SIZE;
+    }
+    for (_, slots) in lexicon_hashes.iter() {
+        let mut buf = vec![0u8; slots.len() * LEXICON_HASH_SLOT_SIZE];
+        for (i, (token_id, lexicon_idx)) in slots.iter().enumerate() {
+            let ofs = i * LEXICON_HASH_SLOT_SIZE;
+            LittleEndian::write_u32(&mut buf[ofs..ofs + 4], *token_id);
+            LittleEndian::write_u32(&mut buf[ofs + 4..ofs + 8], *lexicon_idx);
+        }
+        f.write_all(&buf).unwrap();
+    }
+}
+
+fn write_doc_freq_index(
+    out_path: &String, doc_freqs: &mut BTreeMap<TokenId, Vec<DocumentId>>
+) -> () {
+    let mut f = File::create(out_path).expect("error writing file");
+    write_u32(&mut f, DOC_FREQ_MAGIC);
+    write_u32(&mut f, DOC_FREQ_VERSION);
+    write_u32(&mut f, doc_freqs.len() as u32);
+    let mut i = 0;
+    for (token_id, doc_ids) in doc_freqs.iter() {
+        write_u32(&mut f, *token_id);
+        write_u32(&mut f, i as u32);
+        i += doc_ids.len();
+    }
+    for (_, doc_ids) in doc_freqs.iter_mut() {
+        doc_ids.sort();
+        for doc_id in doc_ids.iter() {
+            write_u32(&mut f, *doc_id);
+        }
+    }
 }
 
 fn write_binary_data(
@@ -191,10 +402,51 @@ fn write_binary_data(
     assert!(i == num_tokens);
 }
 
+// Concatenate the binary data of consecutive documents, starting at
+// first_id, into a packed file. Documents without data (e.g., that failed to
+// parse) are packed as empty ranges.
+pub fn pack_documents(
+    doc_paths: &Vec<String>, first_id: DocumentId, out_path: &String, remove: bool
+) -> () {
+    let doc_sizes: Vec<Option<u64>> = doc_paths.iter().map(
+        |path| match fs::metadata(path) {
+            Ok(meta) => Some(meta.len()),
+            Err(e) => {
+                println!("Warning: no data to pack: {} - {}", path, e);
+                None
+            }
+        }
+    ).collect();
+
+    let mut f = File::create(out_path).expect("error writing file");
+    write_u32(&mut f, DOC_PACK_MAGIC);
+    write_u32(&mut f, DOC_PACK_VERSION);
+    write_u32(&mut f, first_id);
+    write_u32(&mut f, doc_paths.len() as u32);
+    let mut offset: u64 = 0;
+    write_u64(&mut f, offset);
+    for size in doc_sizes.iter() {
+        offset += size.unwrap_or(0);
+        write_u64(&mut f, offset);
+    }
+    for (path, size) in doc_paths.iter().zip(doc_sizes.iter()) {
+        if size.is_none() {
+            continue;
+        }
+        let mut doc_file = File::open(path).expect("error reading file");
+        let n = io::copy(&mut doc_file, &mut f).expect("error writing file");
+        assert!(Some(n) == *size, "Document data changed while packing");
+        if remove {
+            fs::remove_file(path).expect("error removing file");
+        }
+    }
+}
+
 pub fn index_documents(
     index_and_doc_paths: &Vec<(String, Vec<(usize, String, String)>)>,
-    lexicon: &HashMap<String, u32>, is_aligned: bool,
-    datum_size: usize, start_time_size: usize, end_time_size: usize
+    lexicon: &HashMap<String, u32>, bigrams: &HashMap<(TokenId, TokenId), TokenId>,
+    is_aligned: bool, datum_size: usize, start_time_size: usize, end_time_size: usize,
+    posting_format: PostingFormat, hash_lexicons: bool
 ) -> () {
     let max_datum_value = 2u32.pow(datum_size as u32 * 8) - 1;
     let max_time_interval = 2u32.pow(end_time_size as u32 * 8) - 1;
@@ -208,6 +460,22 @@ pub fn index_documents(
         let mut neg_interval_count = 0;
         let mut long_interval_count = 0;
 
+        // Documents in this index file that contain each token
+        let mut doc_freqs: BTreeMap<TokenId, Vec<DocumentId>> = BTreeMap::new();
+
+        // Location of each document in this index file
+        let mut doc_table: Vec<(DocumentId, usize, usize, usize)> = Vec::new();
+        let mut index_offset = 0usize;
+
+        // Hash table of each document's lexicon, if requested
+        let mut lexicon_hashes: Vec<(DocumentId, Vec<(TokenId, u32)>)> = Vec::new();
+        if let PostingFormat::Varint { skip_interval } = posting_format {
+            write_u32(&mut f, INDEX_MAGIC);
+            write_u32(&mut f, INDEX_VERSION_COMPRESSED);
+            write_u32(&mut f, skip_interval as u32);
+            index_offset += INDEX_HEADER_SIZE;
+        }
+
         for (doc_id, doc_path, data_path) in docs {
             pbar.inc(1);
             let path = PathBuf::from(doc_path);
@@ -223,6 +491,9 @@ pub fn index_documents(
                     let mut doc_num_postings = 0usize;
                     let mut doc_duration = 0u32;
 
+                    // Previous token, for indexing bigrams across lines
+                    let mut prev_token: Option<(TokenId, Position, Millis, Millis)> = None;
+
                     for subtitle_entry in subtitle_entries.iter().filter(|x| x.line.is_some()) {
                         let start = subtitle_entry.timespan.start.msecs() as Millis;
                         let mut end = subtitle_entry.timespan.end.msecs() as Millis;
@@ -249,18 +520,45 @@ pub fn index_documents(
                         ).collect();
                         let token_count = token_ids.len();
                         for (j, token_id) in token_ids.iter().enumerate() {
+                            let position = (num_tokens + j) as Position;
                             if *token_id != max_datum_value {
                                 let postings = doc_inv_index.entry(*token_id).or_insert(vec![]);
-                                postings.push(((num_tokens + j) as Position, start, end));
+                                postings.push((position, start, end));
                                 doc_num_postings += 1;
                             }
+                            if let Some((prev_id, prev_position, prev_start, prev_end)) = prev_token {
+                                if let Some(bigram_id) = bigrams.get(&(prev_id, *token_id)) {
+                                    let bigram_start = cmp::min(prev_start, start);
+                                    let bigram_end = cmp::min(cmp::max(prev_end, end),
+                                                              bigram_start + max_time_interval);
+                                    let postings = doc_inv_index.entry(*bigram_id).or_insert(vec![]);
+                                    postings.push((prev_position, bigram_start, bigram_end));
+                                    doc_num_postings += 1;
+                                }
+                            }
+                            prev_token = Some((*token_id, position, start, end));
                         }
                         doc_lines.push((num_tokens as Position, start, end, token_ids));
                         num_tokens += token_count;
                         doc_duration = cmp::max(end, doc_duration);
                     }
-                    write_inverted_index(&mut f, *doc_id, &doc_inv_index, doc_num_postings,
-                                         datum_size, start_time_size, end_time_size);
+                    for token_id in doc_inv_index.keys() {
+                        doc_freqs.entry(*token_id).or_insert(vec![]).push(*doc_id as DocumentId);
+                    }
+                    doc_table.push((*doc_id as DocumentId, index_offset, doc_inv_index.len(),
+                                    doc_num_postings));
+                    if hash_lexicons {
+                        lexicon_hashes.push((*doc_id as DocumentId,
+                                             build_lexicon_hash(&doc_inv_index)));
+                    }
+                    index_offset += match posting_format {
+                        PostingFormat::Fixed => write_inverted_index(
+                            &mut f, *doc_id, &doc_inv_index, doc_num_postings,
+                            datum_size, start_time_size, end_time_size),
+                        PostingFormat::Varint { .. } => write_compressed_inverted_index(
+                            &mut f, *doc_id, &doc_inv_index, doc_num_postings, datum_size,
+                            posting_format)
+                    };
                     write_binary_data(data_path, *doc_id, &doc_lines, doc_duration, num_tokens,
                                       datum_size, start_time_size, end_time_size);
                 },
@@ -268,6 +566,13 @@ pub fn index_documents(
             }
         }
 
+        write_doc_freq_index(&format!("{}{}", index_path, DOC_FREQ_INDEX_EXT), &mut doc_freqs);
+        write_doc_table(&format!("{}{}", index_path, DOC_TABLE_EXT), &mut doc_table);
+        if hash_lexicons {
+            write_lexicon_hash_index(&format!("{}{}", index_path, LEXICON_HASH_EXT),
+                                     &mut lexicon_hashes);
+        }
+
         if long_interval_count + neg_interval_count > 0 {
             println!("Warning: supressed error messages for {} negative and {} long intervals",
                      neg_interval_count, long_interval_count);
@@ -4,6 +4,7 @@ extern crate byteorder;
 extern crate indicatif;
 extern crate subparse;
 extern crate rayon;
+extern crate libc;
 
 use pyo3::prelude::*;
 use pyo3::Python;
@@ -14,9 +15,12 @@ mod common;
 mod index;
 mod indexer;
 mod data;
+mod docset;
 
-use index::RsCaptionIndex;
-use data::RsDocumentData;
+use index::{RsCaptionIndex, RsSearchIterator};
+use data::{RsDocumentData, RsDocumentPack};
+use docset::RsDocumentSet;
+use common::{PostingFormat, POSTING_SKIP_INTERVAL};
 
 #[pyfunction]
 fn tokenize(s: String) -> Vec<String> {
@@ -28,13 +32,29 @@ fn count_tokens(doc_paths: Vec<String>, max_token_len: usize, batch_size: usize,
     indexer::count_tokens(&doc_paths, max_token_len, batch_size, is_aligned)
 }
 
+#[pyfunction]
+fn count_bigrams(doc_paths: Vec<String>, words: HashMap<String, u32>, batch_size: usize, is_aligned: bool) -> HashMap<(u32, u32), usize> {
+    indexer::count_bigrams(&doc_paths, &words, batch_size, is_aligned)
+}
+
 #[pyfunction]
 fn index_documents(
     index_and_doc_paths: Vec<(String, Vec<(usize, String, String)>)>, lexicon: HashMap<String, u32>,
-    is_aligned: bool, datum_size: usize, start_time_size: usize, end_time_size: usize
+    bigrams: HashMap<(u32, u32), u32>, is_aligned: bool, datum_size: usize,
+    start_time_size: usize, end_time_size: usize, compressed: bool, hash_lexicons: bool
 ) -> () {
-    indexer::index_documents(&index_and_doc_paths, &lexicon, is_aligned,
-                             datum_size, start_time_size, end_time_size)
+    let format = if compressed {
+        PostingFormat::Varint { skip_interval: POSTING_SKIP_INTERVAL }
+    } else {
+        PostingFormat::Fixed
+    };
+    indexer::index_documents(&index_and_doc_paths, &lexicon, &bigrams, is_aligned,
+                             datum_size, start_time_size, end_time_size, format, hash_lexicons)
+}
+
+#[pyfunction]
+fn pack_documents(doc_paths: Vec<String>, first_id: u32, out_path: String, remove: bool) -> () {
+    indexer::pack_documents(&doc_paths, first_id, &out_path, remove)
 }
 
 #[pyfunction]
@@ -46,14 +66,19 @@ fn set_parallelism(n: usize) -> () {
 fn indexer(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_wrapped(wrap_pyfunction!(set_parallelism))?;
     m.add_wrapped(wrap_pyfunction!(count_tokens))?;
+    m.add_wrapped(wrap_pyfunction!(count_bigrams))?;
     m.add_wrapped(wrap_pyfunction!(index_documents))?;
+    m.add_wrapped(wrap_pyfunction!(pack_documents))?;
     Ok(())
 }
 
 #[pymodule]
 fn rs_captions(_py: Python<'_>, m: &PyModule) -> PyResult<()> {
     m.add_class::<RsCaptionIndex>()?;
+    m.add_class::<RsSearchIterator>()?;
     m.add_class::<RsDocumentData>()?;
+    m.add_class::<RsDocumentPack>()?;
+    m.add_class::<RsDocumentSet>()?;
     m.add_wrapped(wrap_pyfunction!(tokenize))?;
     m.add_wrapped(wrap_pymodule!(indexer))?;
     Ok(())
@@ -1,4 +1,5 @@
 import os
+import struct
 import captions
 
 
@@ -11,3 +12,72 @@ def get_docs_and_lexicon(idx_dir):
     documents.configure(data_path)
     lexicon = captions.Lexicon.load(lex_path)
     return documents, lexicon
+
+
+def doc_postings(result):
+    """The (document id, postings) of each document in a search result"""
+    return [(d.id, list(d.postings)) for d in result]
+
+
+# Compressed index headers: "CIXZ", version (and skip interval in version 3)
+INDEX_MAGIC = b'CIXZ'
+SKIP_ENTRY_SIZE = 12
+
+
+def write_index_without_skips(src_path, dst_path, datum_size=3):
+    """
+    Rewrite a version 3 compressed index file in the version 2 format, which
+    has no skip interval or skip pointers
+    """
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    magic, version, skip_interval = struct.unpack_from('<4sII', data, 0)
+    assert magic == INDEX_MAGIC and version == 3
+    entry_size = 2 * datum_size + 4
+
+    def read_datum(ofs):
+        return int.from_bytes(data[ofs:ofs + datum_size], 'little')
+
+    out = [struct.pack('<4sI', INDEX_MAGIC, 2)]
+    ofs = 12
+    while ofs < len(data):
+        doc_id, num_tokens, num_postings, num_bytes = struct.unpack_from(
+            '<IIII', data, ofs)
+        lexicon_ofs = ofs + 16
+        postings_ofs = lexicon_ofs + num_tokens * entry_size
+        entries = []
+        for i in range(num_tokens):
+            entry_ofs = lexicon_ofs + i * entry_size
+            entries.append((
+                data[entry_ofs:entry_ofs + datum_size],
+                read_datum(entry_ofs + datum_size),
+                struct.unpack_from('<I', data, entry_ofs + 2 * datum_size)[0]))
+
+        lexicon = []
+        postings = []
+        num_new_bytes = 0
+        for i, (token, idx, byte_ofs) in enumerate(entries):
+            if i + 1 < num_tokens:
+                n = entries[i + 1][1] - idx
+                end_ofs = entries[i + 1][2]
+            else:
+                n = num_postings - idx
+                end_ofs = num_bytes
+            skip_count = (n - 1) // skip_interval \
+                if skip_interval > 0 and n > skip_interval else 0
+            start_ofs = postings_ofs + byte_ofs + skip_count * SKIP_ENTRY_SIZE
+            posting_list = data[start_ofs:postings_ofs + end_ofs]
+            lexicon.append(token + idx.to_bytes(datum_size, 'little')
+                           + struct.pack('<I', num_new_bytes))
+            postings.append(posting_list)
+            num_new_bytes += len(posting_list)
+
+        out.append(struct.pack('<IIII', doc_id, num_tokens, num_postings,
+                               num_new_bytes))
+        out.extend(lexicon)
+        out.extend(postings)
+        ofs = postings_ofs + num_bytes
+    assert ofs == len(data)
+
+    with open(dst_path, 'wb') as f:
+        f.write(b''.join(out))
@@ -5,13 +5,16 @@ Build a dummy index and run tests on it.
 import os
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import check_call
 
+import numpy as np
 import pytest
 import captions
 import captions.decode as decode
+from captions.query import Query
 
-from lib.common import get_docs_and_lexicon
+from lib.common import get_docs_and_lexicon, doc_postings
 
 TMP_DIR = None
 TEST_SUBS_SUBDIR = 'subs'
@@ -19,6 +22,12 @@ TEST_INDEX_SUBDIR = 'index'
 TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                               'test-small.tar.gz')
 
+# A larger index, for tests that need many matching documents
+TEST_LARGE_SUBS_SUBDIR = 'subs-large'
+TEST_LARGE_INDEX_SUBDIR = 'index-large'
+TEST_LARGE_DATA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'test.tar.gz')
+
 BUILD_INDEX_SCRIPT = os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
     '..', 'scripts', 'build_index.py')
@@ -30,20 +39,23 @@ def dummy_data():
     TMP_DIR = tempfile.mkdtemp(suffix=None, prefix='caption-index-unittest-',
                                dir=None)
 
-    def build_test_index(tmp_dir):
-        subs_dir = os.path.join(tmp_dir, TEST_SUBS_SUBDIR)
-        idx_dir = os.path.join(tmp_dir, TEST_INDEX_SUBDIR)
+    def build_test_index(tmp_dir, data_path, subs_subdir, index_subdir):
+        subs_dir = os.path.join(tmp_dir, subs_subdir)
+        idx_dir = os.path.join(tmp_dir, index_subdir)
 
         # Unpack the test data
         os.makedirs(subs_dir)
-        check_call(['tar', '-xzf', TEST_DATA_PATH, '-C', subs_dir])
+        check_call(['tar', '-xzf', data_path, '-C', subs_dir])
 
         # Build the index
         check_call([BUILD_INDEX_SCRIPT, '-d', subs_dir, '-o', idx_dir])
         assert os.path.isdir(idx_dir)
 
     try:
-        build_test_index(TMP_DIR)
+        build_test_index(TMP_DIR, TEST_DATA_PATH, TEST_SUBS_SUBDIR,
+                         TEST_INDEX_SUBDIR)
+        build_test_index(TMP_DIR, TEST_LARGE_DATA_PATH,
+                         TEST_LARGE_SUBS_SUBDIR, TEST_LARGE_INDEX_SUBDIR)
         yield
     finally:
         shutil.rmtree(TMP_DIR, True)
@@ -145,3 +157,289 @@ def test_decode():
     doc_handle = documents.open(0)
     print(decode.get_vtt(lexicon, doc_handle))
     print(decode.get_srt(lexicon, doc_handle))
+
+
+def test_threaded_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def search(tokens):
+        return doc_postings(index.search(tokens))
+
+    queries = [['THE'], ['UNITED', 'STATES'], ['THE', 'GREAT', 'WAR'],
+               ['AND']] * 4
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        expected = [search(q) for q in queries]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(search, queries)) == expected
+
+
+def test_num_threads():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def results(index):
+        queries = ['THE', 'UNITED STATES', 'THE GREAT WAR', 'AND']
+        return (
+            [doc_postings(index.search(q)) for q in queries],
+            [doc_postings(result) for result in index.search_many(queries)],
+            [index.contains(q) for q in queries],
+            [index.count(q) for q in queries],
+            [doc_postings(Query(q).execute(lexicon, index))
+             for q in ['UNITED STATES & THE GREAT WAR', 'GOOD | MORNING',
+                       'UNITED STATES \\ DONALD TRUMP']])
+
+    with captions.CaptionIndex(idx_path, lexicon, documents,
+                               num_threads=1) as index:
+        expected = results(index)
+    assert all(len(r) > 0 for r in expected[0])
+    for num_threads in [4, None]:
+        with captions.CaptionIndex(idx_path, lexicon, documents,
+                                   num_threads=num_threads) as index:
+            assert results(index) == expected
+
+
+def test_streaming_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def search(tokens, batch_size):
+        return doc_postings(index.search(tokens, batch_size=batch_size))
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for tokens in [['THE'], ['UNITED', 'STATES']]:
+            expected = search(tokens, len(documents))
+            assert len(expected) > 0
+            assert [d[0] for d in expected] == sorted(d[0] for d in expected)
+            assert search(tokens, 1) == expected
+            assert search(tokens, 3) == expected
+
+            # Results are available before the whole index is searched
+            result = index.search(tokens, batch_size=1)
+            assert next(iter(result)).id == expected[0][0]
+
+        with pytest.raises(ValueError):
+            index.search(['THE'], batch_size=0)
+
+
+def test_search_limit():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def doc_ids(result):
+        return [d.id for d in result]
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for tokens in [['THE'], ['UNITED', 'STATES']]:
+            expected = doc_ids(index.search(tokens))
+            assert len(expected) > 1
+            assert doc_ids(index.search(tokens, limit=0)) == []
+            assert doc_ids(index.search(tokens, limit=1)) == expected[:1]
+            assert index.contains(tokens, limit=1) == set(expected[:1])
+
+            # Page through the results
+            pages = []
+            after_doc_id = None
+            while True:
+                page = doc_ids(index.search(
+                    tokens, limit=1, after_doc_id=after_doc_id))
+                if len(page) == 0:
+                    break
+                pages.extend(page)
+                after_doc_id = page[-1]
+            assert pages == expected
+            assert index.contains(tokens, after_doc_id=expected[0]) == \
+                set(expected[1:])
+
+        for raw_query in ['THE | AND', 'THE & AND', 'THE \\ UNITED STATES']:
+            q = Query(raw_query)
+            expected = doc_ids(q.execute(lexicon, index))
+            assert len(expected) > 1
+            for limit in [0, 1, 2, len(expected)]:
+                assert doc_ids(q.execute(lexicon, index, limit=limit)) == \
+                    expected[:limit]
+            assert doc_ids(q.execute(lexicon, index, limit=1,
+                                     after_doc_id=expected[0])) == \
+                expected[1:2]
+
+
+def test_search_many():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    queries = ['THE', 'UNITED STATES', ['THE', 'GREAT', 'WAR'],
+               [lexicon['UNITED'].id, lexicon['KINGDOM'].id], 'AND']
+    doc_ids = [d.id for d in documents][::2]
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for docs in [None, doc_ids]:
+            results = index.search_many(queries, docs)
+            assert len(results) == len(queries)
+            for q, result in zip(queries, results):
+                assert doc_postings(result) == \
+                    doc_postings(index.search(q, docs))
+        assert index.search_many([]) == []
+
+
+def test_result_cache():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def search(index, tokens, **kwargs):
+        return doc_postings(index.search(tokens, **kwargs))
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index, \
+            captions.CaptionIndex(idx_path, lexicon, documents,
+                                  cache_bytes=2 ** 24) as cached_index:
+        assert index.cache_stats() is None
+        doc_ids = [d.id for d in documents][::2]
+        for _ in range(2):
+            for tokens in [['UNITED', 'STATES'], ['THE', 'GREAT', 'WAR']]:
+                expected = search(index, tokens)
+                assert search(cached_index, tokens) == expected
+                assert search(cached_index, tokens, documents=doc_ids) == \
+                    search(index, tokens, documents=doc_ids)
+                assert search(cached_index, tokens, limit=1,
+                              after_doc_id=expected[0][0]) == expected[1:2]
+                assert cached_index.contains(tokens) == index.contains(tokens)
+                assert cached_index.count(tokens) == index.count(tokens)
+        stats = cached_index.cache_stats()
+        assert stats.entries == 2
+        assert stats.hits > stats.misses
+
+        # Repeated sub-phrases of queries are served from the cache
+        q = Query('UNITED STATES & THE GREAT WAR')
+        assert [d.id for d in q.execute(lexicon, cached_index)] == \
+            [d.id for d in q.execute(lexicon, index)]
+        assert cached_index.cache_stats().hits > stats.hits
+
+        cached_index.clear_cache()
+        assert cached_index.cache_stats().entries == 0
+        assert search(cached_index, 'UNITED STATES') == \
+            search(index, 'UNITED STATES')
+
+        # Searches are streamed, and cached once they are fully consumed
+        entries = cached_index.cache_stats().entries
+        results = cached_index.search('OF THE')
+        next(results)
+        assert cached_index.cache_stats().entries == entries
+        rest = list(results)
+        assert cached_index.cache_stats().entries == entries + 1
+        assert len(rest) + 1 == len(search(index, 'OF THE'))
+
+        # contains() and count() cache their own results
+        for text in ['THE GREAT', 'IN THE']:
+            for _ in range(2):
+                assert cached_index.contains(text) == index.contains(text)
+                assert cached_index.contains(text, doc_ids) == \
+                    index.contains(text, doc_ids)
+                assert cached_index.contains(text, limit=2) == \
+                    index.contains(text, limit=2)
+        stats = cached_index.cache_stats()
+        for text in ['THE GREAT', 'IN THE']:
+            assert cached_index.contains(text) == index.contains(text)
+        assert cached_index.cache_stats().hits == stats.hits + 2
+        for _ in range(2):
+            assert cached_index.count('AND THE') == index.count('AND THE')
+            assert cached_index.count('AND THE', doc_ids) == \
+                index.count('AND THE', doc_ids)
+        assert cached_index.cache_stats().hits == stats.hits + 5
+
+        # Changing a returned count does not change later cached counts
+        expected = index.count('OF THE')
+        for _ in range(2):
+            result = cached_index.count('OF THE')
+            assert result == expected
+            result.documents.clear()
+        result = cached_index.count('OF THE', doc_ids)
+        assert result == index.count('OF THE', doc_ids)
+        result.documents.clear()
+        assert cached_index.count('OF THE', doc_ids) == \
+            index.count('OF THE', doc_ids)
+
+
+def test_time_window_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def in_window(postings, start_time, end_time):
+        return [p for p in postings
+                if p.start >= start_time and p.end <= end_time]
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for text in ['THE', 'UNITED STATES', 'THE GREAT WAR']:
+            full = list(index.search(text))
+            for start_time, end_time in [(0, 60), (30, 300), (100, 1e9)]:
+                expected = [(d.id, in_window(d.postings, start_time, end_time))
+                            for d in full]
+                expected = [(i, ps) for i, ps in expected if len(ps) > 0]
+                assert doc_postings(index.search(
+                    text, start_time=start_time, end_time=end_time)) == \
+                    expected
+                assert index.contains(
+                    text, start_time=start_time, end_time=end_time
+                ) == {i for i, _ in expected}
+                assert index.count(
+                    text, start_time=start_time, end_time=end_time
+                ).documents == {i: len(ps) for i, ps in expected}
+
+        q = Query('UNITED STATES & THE GREAT WAR')
+        for d in q.execute(lexicon, index, start_time=60, end_time=600):
+            assert all(p.start >= 60 and p.end <= 600 for p in d.postings)
+
+        with pytest.raises(ValueError):
+            index.search('THE', start_time=10, end_time=5)
+
+
+def test_document_set():
+    idx_dir = os.path.join(TMP_DIR, TEST_LARGE_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    a, b = {0, 3, 64, 200}, {3, 4, 200, 1000}
+    doc_a, doc_b = captions.DocumentSet(a), captions.DocumentSet(b)
+    assert doc_a == a and len(doc_a) == len(a) and list(doc_a) == sorted(a)
+    assert 64 in doc_a and 65 not in doc_a and -1 not in doc_a
+    assert np.int64(64) in doc_a and np.uint32(65) not in doc_a
+    assert 'a' not in doc_a and 2 ** 40 not in doc_a
+    assert doc_a | doc_b == a | b
+    assert doc_a & doc_b == a & b
+    assert doc_a - doc_b == a - b
+    assert doc_a ^ doc_b == a ^ b
+    assert doc_a | {5} == a | {5}
+    assert hash(doc_a) == hash(captions.DocumentSet(sorted(a, reverse=True)))
+    assert hash(doc_a) == hash(frozenset(a))
+    assert {frozenset(a): 1}[doc_a] == 1 and {doc_a: 1}[frozenset(a)] == 1
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        ids = [d.id for d in documents][::2]
+        doc_set = captions.DocumentSet(ids)
+        for text in ['THE', 'UNITED STATES']:
+            expected = doc_postings(index.search(text, ids))
+            assert doc_postings(index.search(text, doc_set)) == expected
+            found = index.contains(text, doc_set)
+            assert isinstance(found, captions.DocumentSet)
+            assert found == {i for i, _ in expected}
+            assert index.count(text, doc_set) == index.count(text, ids)
+
+            # Without a DocumentSet, contains() returns a (mutable) set
+            found_ids = index.contains(text, ids)
+            assert type(found_ids) is set and found_ids == found
+            found_ids.add(-1)
+            assert index.contains(text, ids) == found
+            assert len(list(index.search(text, captions.DocumentSet()))) == 0
+
+            # Ids past the last document match nothing
+            stray = captions.Documents.Document(id=2 ** 32 - 1, name='stray')
+            assert doc_postings(index.search(text, [*ids, stray])) == expected
+            assert len(list(index.search(text, [stray]))) == 0
+
+        q = Query('UNITED STATES | THE GREAT WAR')
+        assert [d.id for d in q.execute(lexicon, index, doc_set)] == \
+            [d.id for d in q.execute(lexicon, index, ids)]
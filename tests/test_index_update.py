@@ -75,7 +75,11 @@ def test_update_index():
     documents, lexicon = get_docs_and_lexicon(idx_dir)
     idx_path = os.path.join(idx_dir, 'index.bin')
     assert os.path.isdir(idx_path)
-    assert len(os.listdir(idx_path)) == 2, os.listdir(idx_path)
+    index_files = [f for f in os.listdir(idx_path) if f.endswith('.bin')]
+    assert len(index_files) == 2, os.listdir(idx_path)
+    for f in index_files:
+        assert os.path.isfile(os.path.join(idx_path, f + '.df'))
+        assert os.path.isfile(os.path.join(idx_path, f + '.docs'))
 
     test_document = documents['copy::cnn.srt']
     with captions.CaptionIndex(idx_path, lexicon, documents) as index:
@@ -87,3 +91,68 @@ def test_update_index():
         assert count_and_test(index, test_document, ['CLOCK', 'STRIKES']) == 2
         assert count_and_test(index, test_document, ['>>']) == 149
         assert count_and_test(index, test_document, ['SEE', '?']) == 1
+
+
+def build_and_update_index(tmp_dir, update_args):
+    """
+    Build an index, then add copies of the documents (named copy::*) with
+    update_args passed to the update script
+    """
+    subs_dir = os.path.join(tmp_dir, 'subs')
+    idx_dir = os.path.join(tmp_dir, 'index')
+    os.makedirs(subs_dir)
+    check_call(['tar', '-xzf', TEST_DATA_PATH, '-C', subs_dir])
+    check_call([BUILD_INDEX_SCRIPT, '-d', subs_dir, '-o', idx_dir])
+    for fname in os.listdir(subs_dir):
+        shutil.move(os.path.join(subs_dir, fname),
+                    os.path.join(subs_dir, 'copy::' + fname))
+    check_call([UPDATE_INDEX_SCRIPT, *update_args, '-d', subs_dir, idx_dir])
+    return idx_dir
+
+
+def check_copies_match(idx_dir):
+    """Copies of documents have the same results as the originals"""
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+
+    def search(index, tokens, document):
+        return [list(d.postings) for d in index.search(tokens, [document])]
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for d in documents:
+            if d.name.startswith('copy::'):
+                continue
+            copy = documents['copy::' + d.name]
+            for tokens in [['THEY'], ['TO', 'THE'], ['>>'], ['SEE', '?']]:
+                assert search(index, tokens, copy) == \
+                    search(index, tokens, d)
+                assert index.count(tokens, [copy]).total == \
+                    index.count(tokens, [d]).total
+
+
+def test_update_index_compressed():
+    tmp_dir = tempfile.mkdtemp(suffix=None, prefix='caption-index-unittest-',
+                               dir=None)
+    try:
+        # The index mixes uncompressed and compressed postings
+        idx_dir = build_and_update_index(tmp_dir, ['--compress'])
+        check_copies_match(idx_dir)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+
+def test_update_index_hashed_lexicons():
+    tmp_dir = tempfile.mkdtemp(suffix=None, prefix='caption-index-unittest-',
+                               dir=None)
+    try:
+        # Only the new index file has a lexicon hash table
+        idx_dir = build_and_update_index(tmp_dir, ['--hash-lexicons'])
+        idx_path = os.path.join(idx_dir, 'index.bin')
+        index_files = [f for f in os.listdir(idx_path) if f.endswith('.bin')]
+        assert len(index_files) == 2, os.listdir(idx_path)
+        hash_files = [f for f in os.listdir(idx_path) if f.endswith('.hash')]
+        assert len(hash_files) == 1, os.listdir(idx_path)
+        assert hash_files[0][:-len('.hash')] in index_files
+        check_copies_match(idx_dir)
+    finally:
+        shutil.rmtree(tmp_dir, True)
@@ -26,10 +26,29 @@ def test_query_parser():
         '(the & (red | blue) & (cat \\ sat on :: 24) :: 12) | a [green mat]',
         '(the & (red | blue) & (cat \\ sat on // 24) // 12) | a [green mat]',
         'U.S | U.K',
-        'red-black tree'
+        'red-black tree',
+        'immigr* | wom?n',
+        'the [immigr* laws]',
+        'imigrant~ | imigrant~2 law'
     ]
 
     for raw_query in queries:
         print('Raw query:', raw_query)
         q = query.Query(raw_query)
         print(yaml.dump(q._tree._pprint_data, indent=4))
+
+
+def test_query_wildcard_punctuation():
+    def tokens(raw_query):
+        return [(t.text, t.wildcard)
+                for t in query.Query(raw_query)._tree.tokens]
+
+    # A trailing ? is punctuation, as it was before wildcards
+    assert tokens('are you sure?') == [
+        ('are', False), ('you', False), ('sure', False), ('?', False)]
+    assert tokens('sure?') == [('sure', False), ('?', False)]
+    assert tokens('?') == [('?', False)]
+    assert tokens('*') == [('*', False)]
+
+    assert tokens('wom?n') == [('wom?n', True)]
+    assert tokens('immigr*') == [('immigr*', True)]
@@ -12,8 +12,11 @@ from subprocess import check_call
 import pytest
 import captions
 import captions.util as util
+from captions.query import Query
+from captions.rs_captions import indexer
 
-from lib.common import get_docs_and_lexicon
+from lib.common import get_docs_and_lexicon, doc_postings, \
+    write_index_without_skips
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../tools')
 import scan
@@ -23,6 +26,10 @@ import search
 TMP_DIR = None
 TEST_SUBS_SUBDIR = 'subs'
 TEST_INDEX_SUBDIR = 'index'
+# Built with compressed postings, bigram postings and packed document data
+TEST_VARIANT_INDEX_SUBDIR = 'index-variant'
+# Built with hash tables of the document lexicons
+TEST_HASHED_INDEX_SUBDIR = 'index-hashed'
 TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                               'test.tar.gz')
 
@@ -49,6 +56,14 @@ def dummy_data():
         check_call([BUILD_INDEX_SCRIPT, '-d', subs_dir, '-o', idx_dir])
         assert os.path.isdir(idx_dir)
 
+        # Build the other formats once, to compare with the index
+        check_call([BUILD_INDEX_SCRIPT, '-d', subs_dir, '-o',
+                    os.path.join(tmp_dir, TEST_VARIANT_INDEX_SUBDIR),
+                    '--compress', '--bigrams', '100', '--pack'])
+        check_call([BUILD_INDEX_SCRIPT, '-d', subs_dir, '-o',
+                    os.path.join(tmp_dir, TEST_HASHED_INDEX_SUBDIR),
+                    '--hash-lexicons'])
+
     try:
         build_test_index(TMP_DIR)
         yield
@@ -77,6 +92,13 @@ def test_lemmatize():
     _, lexicon = get_docs_and_lexicon(idx_dir)
     assert lexicon['DUCK'].id in lexicon.similar('DUCKS')
 
+    # Lemmas precomputed by the indexer
+    lemma_lexicon = captions.Lexicon.load(
+        os.path.join(idx_dir, 'lexicon.txt'),
+        lemmas_path=os.path.join(idx_dir, 'lemmas.bin'))
+    for token in ['DUCK', 'DUCKS', 'ducks', 'TREES', 'NOT A WORD']:
+        assert lemma_lexicon.similar(token) == lexicon.similar(token)
+
 
 def test_inverted_index():
     idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
@@ -86,14 +108,20 @@ def test_inverted_index():
     def test_search_and_contains(tokens, doc_ids=None):
         ids = index.contains(tokens, doc_ids)
         search_ids = set()
+        search_counts = {}
         for d in index.search(tokens, doc_ids):
             assert len(d.postings) > 0
             for l in d.postings:
                 assert l.len == len(tokens)
                 assert abs(l.end - l.start) <= 10.0, 'ngram time too large'
             search_ids.add(d.id)
+            search_counts[d.id] = len(d.postings)
         assert ids == search_ids
 
+        count = index.count(tokens, doc_ids)
+        assert count.documents == search_counts
+        assert count.total == sum(search_counts.values())
+
     all_doc_ids = [d.id for d in documents]
     with captions.CaptionIndex(idx_path, lexicon, documents) as index:
         # Unigram search
@@ -121,6 +149,356 @@ def test_inverted_index():
         test_search_and_contains(['THE', 'GREAT', 'WAR'], all_doc_ids)
 
 
+def test_document_names():
+    documents = captions.Documents([
+        captions.Documents.Document(id=i, name=name) for i, name in
+        enumerate(['b.srt', 'a/x.srt', 'a/y.srt', 'c.srt', 'a/w.srt'])])
+    assert documents['a/y.srt'].id == 2
+    assert 'c.srt' in documents and 'd.srt' not in documents
+    with pytest.raises(captions.Documents.DocumentDoesNotExist):
+        documents['a']
+    assert [d.id for d in documents.prefix('a/')] == [1, 2, 4]
+    assert documents.prefix('z') == []
+    assert [d.name for d in documents.name_range('a/x.srt', 'c.srt')] == \
+        ['a/x.srt', 'a/y.srt', 'b.srt']
+    assert [d.id for d in documents.name_range('b')] == [0, 3]
+
+
+def test_binary_lexicon():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    _, lexicon = get_docs_and_lexicon(idx_dir)
+    bin_lexicon = captions.Lexicon.load_binary(
+        os.path.join(idx_dir, 'lexicon.bin'))
+    assert len(bin_lexicon) == len(lexicon)
+    assert bin_lexicon.word_count == lexicon.word_count
+    assert list(bin_lexicon) == list(lexicon)
+    for w in lexicon:
+        assert bin_lexicon[w.token] == w
+        assert w.token in bin_lexicon
+    assert 'NOT A WORD' not in bin_lexicon
+    assert bin_lexicon.decode(len(lexicon)) == captions.Lexicon.UNKNOWN_TOKEN
+
+
+def test_wildcard_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+    bin_lexicon = captions.Lexicon.load_binary(
+        os.path.join(idx_dir, 'lexicon.bin'))
+
+    expected = sorted(w.id for w in lexicon if w.token.startswith('UNIT'))
+    assert len(expected) > 0
+    for lex in [lexicon, bin_lexicon]:
+        assert sorted(lex.prefix('UNIT')) == expected
+        assert sorted(lex.wildcard('UNIT*')) == expected
+        assert len(lex.prefix('UNIT', limit=1)) == 1
+        assert lex.wildcard('UNI?ED') == [lexicon['UNITED'].id]
+        assert lex.wildcard('NOT A WORD*') == []
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        assert [d.id for d in Query('UNIT* STATES').execute(lexicon, index)] \
+            == [d.id for d in index.ngram_search(
+                [lexicon[i] for i in expected], 'STATES')]
+        with pytest.raises(ValueError):
+            list(Query('U*', max_expansions=1).execute(lexicon, index))
+
+
+def test_fuzzy_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def edit_distance(a, b):
+        prev = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            curr = [i]
+            for j, cb in enumerate(b, 1):
+                curr.append(min(prev[j] + 1, curr[j - 1] + 1,
+                                prev[j - 1] + (ca != cb)))
+            prev = curr
+        return prev[-1]
+
+    for key in ['UNTIED', 'STATS']:
+        for max_dist in [1, 2]:
+            result = lexicon.fuzzy(key, max_dist)
+            assert sorted(result) == sorted(
+                w.id for w in lexicon
+                if edit_distance(key, w.token) <= max_dist)
+            dists = [edit_distance(key, lexicon[i].token) for i in result]
+            assert dists == sorted(dists)
+    assert lexicon.fuzzy('UNITED', 0) == [lexicon['UNITED'].id]
+
+    # The trigrams written by the indexer give the same results
+    trigram_lexicon = captions.Lexicon.load_binary(
+        os.path.join(idx_dir, 'lexicon.bin'),
+        trigrams_path=os.path.join(idx_dir, 'trigrams.bin'))
+    for key in ['UNTIED', 'STATS', 'A', 'NOTAWORDATALL']:
+        for max_dist in [0, 1, 2, 3]:
+            assert trigram_lexicon.fuzzy(key, max_dist) == \
+                lexicon.fuzzy(key, max_dist)
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        assert [d.id for d in Query('UNTIED~2 STATES').execute(
+                lexicon, index)] == \
+            [d.id for d in index.ngram_search(
+                [lexicon[i] for i in lexicon.fuzzy('UNTIED', 2)], 'STATES')]
+
+
+def test_case_insensitive_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+    fold_lexicon = captions.Lexicon.load(
+        os.path.join(idx_dir, 'lexicon.txt'),
+        case_folds_path=os.path.join(idx_dir, 'casefolds.bin'))
+
+    for token in ['THE', 'the', 'United', 'NOT A WORD']:
+        expected = {w.id for w in lexicon
+                    if w.token.casefold() == token.casefold()}
+        assert lexicon.case_folds(token) == expected
+        assert fold_lexicon.case_folds(token) == expected
+
+    with captions.CaptionIndex(idx_path, fold_lexicon, documents) as index:
+        def ids(result):
+            return [d.id for d in result]
+
+        assert ids(index.search('united states', ignore_case=True)) == \
+            ids(index.search('UNITED STATES'))
+        assert index.contains('United States', ignore_case=True) == \
+            index.contains('UNITED STATES')
+        assert index.count('the', ignore_case=True) == index.count('THE')
+        q = Query('united states')
+        assert ids(q.execute(fold_lexicon, index, ignore_case=True)) == \
+            ids(Query('UNITED STATES').execute(fold_lexicon, index))
+        assert ids(q.execute(fold_lexicon, index)) == []
+
+
+def test_warm_index():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        expected = doc_postings(index.search('UNITED STATES'))
+        index.advise('random')
+        with pytest.raises(ValueError):
+            index.advise('never')
+        _, total = index.resident_bytes()
+        assert 0 < index.warm(lexicons_only=True) <= total
+        assert index.warm() >= os.path.getsize(idx_path)
+        resident, total = index.resident_bytes()
+        assert 0 < resident <= total
+        assert doc_postings(index.search('UNITED STATES')) == expected
+
+    dh = documents.open(0)
+    assert dh.warm() == dh.resident_bytes()[1]
+    dh.advise('sequential')
+    assert documents.warm([0, 1]) > 0
+
+
+def test_posting_arrays():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        for d in index.search('UNITED STATES'):
+            arr = util.PostingUtil.to_array(d.postings)
+            assert arr.dtype == captions.CaptionIndex.POSTING_DTYPE
+            assert len(arr) == len(d.postings)
+            assert list(arr['idx']) == [p.idx for p in d.postings]
+            assert list(arr['len']) == [p.len for p in d.postings]
+            assert list(arr['start']) == [p.start for p in d.postings]
+
+            copied = util.PostingUtil.to_array(list(d.postings))
+            assert (copied == arr).all()
+
+
+def test_bigram_search():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    # The variant index has postings for frequent bigrams
+    bigram_idx_dir = os.path.join(TMP_DIR, TEST_VARIANT_INDEX_SUBDIR)
+    bigram_idx_path = os.path.join(bigram_idx_dir, 'index.bin')
+    bigrams = captions.Bigrams.load(
+        os.path.join(bigram_idx_dir, 'bigrams.txt'))
+    assert len(bigrams) == 100
+    assert bigrams.get(lexicon['OF'].id, lexicon['THE'].id) is not None
+
+    def search(index, tokens):
+        return doc_postings(index.search(tokens))
+
+    queries = ['OF THE', 'IN THE UNITED STATES', 'THE UNITED STATES OF AMERICA',
+               'ONE OF THE', 'GOOD MORNING']
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index, \
+            captions.CaptionIndex(bigram_idx_path, lexicon, documents,
+                                  bigrams=bigrams) as bigram_index:
+        for q in queries:
+            expected = search(index, q)
+            assert len(expected) > 0
+            assert search(bigram_index, q) == expected
+            assert bigram_index.contains(q) == index.contains(q)
+            assert bigram_index.count(q) == index.count(q)
+
+
+def test_compressed_index():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    # The variant index has compressed postings. Write a copy of its index
+    # file in the version 2 format (without skip pointers or sidecars).
+    compressed_idx_dir = os.path.join(TMP_DIR, TEST_VARIANT_INDEX_SUBDIR)
+    compressed_idx_path = os.path.join(compressed_idx_dir, 'index.bin')
+    no_skips_idx_path = os.path.join(TMP_DIR, 'index-v2.bin')
+    write_index_without_skips(compressed_idx_path, no_skips_idx_path)
+
+    def search(index, text, **kwargs):
+        return doc_postings(index.search(text, **kwargs))
+
+    odd_doc_ids = [d.id for d in documents if d.id % 2 == 1]
+    queries = ['THE', 'OF THE', 'IN THE', 'AND THE', 'THE UNITED STATES',
+               'ONE OF THE', 'GOOD MORNING']
+    windows = [(0, float('inf')), (0, 60), (30, 300), (100, 1e9)]
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index, \
+            captions.CaptionIndex(compressed_idx_path, lexicon,
+                                  documents) as compressed_index, \
+            captions.CaptionIndex(no_skips_idx_path, lexicon,
+                                  documents) as no_skips_index:
+        # The posting lists must be long enough to have skip pointers
+        assert max(index.count('THE').documents.values()) > 64
+        assert max(index.count('OF').documents.values()) > 64
+
+        for text in queries:
+            for doc_ids in [None, odd_doc_ids]:
+                for start_time, end_time in windows:
+                    kwargs = {'start_time': start_time, 'end_time': end_time}
+                    expected = search(index, text, documents=doc_ids, **kwargs)
+                    expected_ids = index.contains(text, doc_ids, **kwargs)
+                    expected_count = index.count(text, doc_ids, **kwargs)
+                    for other in [compressed_index, no_skips_index]:
+                        assert search(other, text, documents=doc_ids,
+                                      **kwargs) == expected
+                        assert other.contains(
+                            text, doc_ids, **kwargs) == expected_ids
+                        assert other.count(
+                            text, doc_ids, **kwargs) == expected_count
+
+        for text in ['OF THE', 'THE UNITED STATES']:
+            expected = search(index, text)
+            assert len(expected) > 0
+            assert search(compressed_index, text, limit=3) == expected[:3]
+            assert search(compressed_index, text,
+                          after_doc_id=expected[0][0]) == expected[1:]
+
+
+def test_index_sidecars():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    def results(index):
+        return [(doc_postings(index.search(text)),
+                 index.contains(text), index.count(text))
+                for text in ['THE', 'UNITED STATES', 'THE GREAT WAR']]
+
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index:
+        expected = results(index)
+
+    copy_dir = os.path.join(TMP_DIR, 'index-sidecars')
+    os.makedirs(copy_dir)
+    copy_path = os.path.join(copy_dir, 'index.bin')
+    shutil.copy(idx_path, copy_path)
+
+    def check(sidecars):
+        for ext in ['.df', '.docs', '.hash']:
+            if os.path.isfile(copy_path + ext):
+                os.remove(copy_path + ext)
+        for ext, data in sidecars.items():
+            with open(copy_path + ext, 'wb') as f:
+                f.write(data)
+        with captions.CaptionIndex(copy_path, lexicon, documents) as index:
+            assert results(index) == expected
+
+    with open(idx_path + '.df', 'rb') as f:
+        doc_freqs = f.read()
+    with open(idx_path + '.docs', 'rb') as f:
+        doc_table = f.read()
+    assert doc_freqs[:4] == b'CIDF'
+
+    # Older indexes, without sidecars or with .df files without a header
+    check({})
+    check({'.df': doc_freqs[8:], '.docs': doc_table})
+
+    # Unusable sidecars are ignored
+    check({'.df': doc_freqs[:16]})
+    check({'.df': doc_freqs[:12] + b'\xff' * (len(doc_freqs) - 12)})
+    check({'.df': b'CIDF\x09\x00\x00\x00' + doc_freqs[8:]})
+    check({'.df': b''})
+    check({'.docs': doc_table[:len(doc_table) - 3]})
+    check({'.hash': b'CIXH\x01\x00\x00\x00\x05\x00\x00\x00'})
+
+
+def test_hashed_lexicons():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    idx_path = os.path.join(idx_dir, 'index.bin')
+    documents, lexicon = get_docs_and_lexicon(idx_dir)
+
+    hashed_idx_dir = os.path.join(TMP_DIR, TEST_HASHED_INDEX_SUBDIR)
+    hashed_idx_path = os.path.join(hashed_idx_dir, 'index.bin')
+    assert os.path.isfile(hashed_idx_path + '.hash')
+
+    # First slot probed for a token (as in the indexer)
+    def first_slot(token_id, slot_count):
+        return (((token_id * 0x9E3779B9) % 2 ** 32) * slot_count) >> 32
+
+    # Find a document with tokens that collide in its hash table, and a
+    # token that is not in the document but probes an occupied slot
+    doc = colliding = absent = None
+    for d in documents:
+        doc_tokens = set(documents.open(d).tokens())
+        slot_count = len(doc_tokens) + len(doc_tokens) // 2 + 1
+        by_slot = {}
+        for t in doc_tokens:
+            by_slot.setdefault(first_slot(t, slot_count), []).append(t)
+        collisions = [ts for ts in by_slot.values() if len(ts) > 1]
+        absent_tokens = [
+            w.id for w in lexicon if w.id not in doc_tokens
+            and first_slot(w.id, slot_count) in by_slot]
+        if collisions and absent_tokens:
+            doc, colliding, absent = d, collisions[0], absent_tokens[0]
+            break
+    assert doc is not None
+
+    def search(index, text, doc_ids):
+        return doc_postings(index.search(text, doc_ids))
+
+    all_doc_ids = [d.id for d in documents]
+    queries = [
+        [lexicon[colliding[0]]], [lexicon[colliding[-1]]], [lexicon[absent]],
+        [[lexicon[i] for i in colliding]],
+        [[lexicon[i] for i in colliding], lexicon[absent]],
+        'THE', 'UNITED STATES', 'THE GREAT WAR'
+    ]
+    with captions.CaptionIndex(idx_path, lexicon, documents) as index, \
+            captions.CaptionIndex(hashed_idx_path, lexicon,
+                                  documents) as hashed_index:
+        for text in queries:
+            for doc_ids in [None, all_doc_ids, [doc.id]]:
+                expected = search(index, text, doc_ids)
+                assert search(hashed_index, text, doc_ids) == expected
+                assert hashed_index.contains(text, doc_ids) == \
+                    index.contains(text, doc_ids)
+                assert hashed_index.count(text, doc_ids) == \
+                    index.count(text, doc_ids)
+
+        assert len(search(hashed_index, [lexicon[absent]], [doc.id])) == 0
+        assert len(search(hashed_index, [lexicon[colliding[-1]]],
+                          [doc.id])) == 1
+
+
 def test_token_data():
     idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
     documents, lexicon = get_docs_and_lexicon(idx_dir)
@@ -153,6 +531,81 @@ def test_intervals_data():
             '{} has an inconsistent number of tokens'.format(documents[i].name)
 
 
+def test_document_pool():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    documents, _ = get_docs_and_lexicon(idx_dir)
+    assert documents.pool_stats() is None
+
+    documents.configure(os.path.join(idx_dir, 'data'), max_open=2)
+    dh = documents.open(0)
+    assert documents.open(0) is dh
+    documents.open(1)
+    documents.open(2)
+    stats = documents.pool_stats()
+    assert stats.hits == 1 and stats.misses == 3 and stats.evictions == 1
+    assert stats.entries == 2 and stats.bytes > 0
+    assert documents.open(0) is not dh
+    assert documents.open(0).tokens() == dh.tokens()
+
+    documents.close()
+    assert documents.pool_stats().entries == 0
+
+    documents.configure(os.path.join(idx_dir, 'data'), max_open=10,
+                        max_open_bytes=documents.open(0).size)
+    documents.open(0)
+    documents.open(1)
+    stats = documents.pool_stats()
+    assert stats.entries <= 1 and stats.evictions + stats.entries >= 1
+
+
+def test_packed_document_data():
+    idx_dir = os.path.join(TMP_DIR, TEST_INDEX_SUBDIR)
+    # The variant index has packed document data
+    packed_idx_dir = os.path.join(TMP_DIR, TEST_VARIANT_INDEX_SUBDIR)
+    packed_data_dir = os.path.join(packed_idx_dir, 'data')
+    assert not any(f.endswith('.bin') for f in os.listdir(packed_data_dir))
+
+    documents, _ = get_docs_and_lexicon(idx_dir)
+    packed_documents, _ = get_docs_and_lexicon(packed_idx_dir)
+    for d in documents:
+        dh = documents.open(d)
+        packed_dh = packed_documents.open(d.id)
+        assert packed_dh.id == d.id
+        assert packed_dh.size == dh.size
+        assert packed_dh.tokens() == dh.tokens()
+        assert list(packed_dh.lines()) == list(dh.lines())
+    assert packed_documents.warm() > 0
+    packed_documents.close()
+
+    # Documents outside of the packs are read from their own files
+    packed_documents.configure(os.path.join(idx_dir, 'data'))
+    assert packed_documents.open(0).tokens() == documents.open(0).tokens()
+
+    # Configuring does not read the data directory
+    packed_documents.configure(os.path.join(TMP_DIR, 'no-such-dir'))
+    with pytest.raises(FileNotFoundError):
+        packed_documents.open(0)
+
+    # Documents without data are packed as empty ranges
+    partial_data_dir = os.path.join(TMP_DIR, 'data-partial')
+    os.makedirs(partial_data_dir)
+    for i in [0, 2]:
+        shutil.copy(os.path.join(idx_dir, 'data', '{}.bin'.format(i)),
+                    partial_data_dir)
+    indexer.pack_documents(
+        [os.path.join(partial_data_dir, '{}.bin'.format(i)) for i in range(3)],
+        0, os.path.join(partial_data_dir, '0000000-0000003.pack'), False)
+    with open(os.path.join(partial_data_dir,
+                           captions.Documents.PACK_MANIFEST), 'w') as fp:
+        fp.write('0000000-0000003.pack\n')
+    packed_documents.configure(partial_data_dir)
+    os.remove(os.path.join(partial_data_dir, '0.bin'))
+    assert packed_documents.open(0).tokens() == documents.open(0).tokens()
+    assert packed_documents.open(2).tokens() == documents.open(2).tokens()
+    with pytest.raises(OSError):
+        packed_documents.open(1)
+
+
 def test_util_window():
     values = [0, 1, 2, 3]
     assert list(util.window(values, 2)) == [(0, 1), (1, 2), (2, 3)]
@@ -179,3 +632,6 @@ def test_script_search():
     search.main(idx_dir, ['UNITED STATES', '\\', 'DONALD TRUMP'], False, 3)
     search.main(idx_dir, ['[STATES]'], False, 3)
     search.main(idx_dir, ['[FIGHT]', '&', '[STATES]'], False, 3)
+    search.main(idx_dir, ['UNITED STATES'], False, 3, num_threads=1)
+    search.main(idx_dir, ['UNITED STATES'], False, 3, num_threads=4)
+    search.main(idx_dir, ['UNITED STATES'], False, 3, max_open=0)
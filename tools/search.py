@@ -10,12 +10,13 @@ import time
 import traceback
 from termcolor import colored, cprint
 
-from captions import Lexicon, Documents, CaptionIndex
+from captions import Lexicon, Documents, Bigrams, CaptionIndex
 from captions.query import Query
 from captions.util import PostingUtil
 
 
 DEFAULT_CONTEXT = 3
+DEFAULT_MAX_OPEN = 1000
 
 
 def get_args():
@@ -27,6 +28,12 @@ def get_args():
     parser.add_argument('-c', dest='context_size', type=int,
                         default=DEFAULT_CONTEXT,
                         help='Context window width (default: {})'.format(DEFAULT_CONTEXT))
+    parser.add_argument('-j', dest='num_threads', type=int,
+                        help='Number of search threads (default: one per CPU)')
+    parser.add_argument('--max-open', dest='max_open', type=int,
+                        default=DEFAULT_MAX_OPEN,
+                        help='Number of document handles to keep open, 0 to '
+                             'disable (default: {})'.format(DEFAULT_MAX_OPEN))
     parser.add_argument('query', nargs='*')
     return parser.parse_args()
 
@@ -99,17 +106,38 @@ def run_search(query_str, documents, lexicon, index, context_size, silent):
         'white', 'on_green', attrs=BOLD_ATTRS)
 
 
-def main(index_dir, query, silent, context_size):
+def main(index_dir, query, silent, context_size, num_threads=None,
+         max_open=DEFAULT_MAX_OPEN):
     idx_path = os.path.join(index_dir, 'index.bin')
     doc_path = os.path.join(index_dir, 'documents.txt')
     data_path = os.path.join(index_dir, 'data')
     lex_path = os.path.join(index_dir, 'lexicon.txt')
+    lex_bin_path = os.path.join(index_dir, 'lexicon.bin')
+    lemmas_path = os.path.join(index_dir, 'lemmas.bin')
+    case_folds_path = os.path.join(index_dir, 'casefolds.bin')
+    trigrams_path = os.path.join(index_dir, 'trigrams.bin')
+    bigrams_path = os.path.join(index_dir, 'bigrams.txt')
 
     documents = Documents.load(doc_path)
-    documents.configure(data_path)
-    lexicon = Lexicon.load(lex_path)
-
-    with CaptionIndex(idx_path, lexicon, documents) as index:
+    # Results often come from the same documents from query to query
+    documents.configure(data_path, max_open=max_open)
+    if not os.path.isfile(lemmas_path):
+        lemmas_path = None
+    if not os.path.isfile(case_folds_path):
+        case_folds_path = None
+    if not os.path.isfile(trigrams_path):
+        trigrams_path = None
+    lexicon = Lexicon.load_binary(
+        lex_bin_path, lemmas_path=lemmas_path,
+        case_folds_path=case_folds_path, trigrams_path=trigrams_path
+    ) if os.path.isfile(lex_bin_path) else Lexicon.load(
+        lex_path, lemmas_path=lemmas_path, case_folds_path=case_folds_path,
+        trigrams_path=trigrams_path)
+    bigrams = Bigrams.load(bigrams_path) \
+        if os.path.isfile(bigrams_path) else None
+
+    with CaptionIndex(idx_path, lexicon, documents,
+                      num_threads=num_threads, bigrams=bigrams) as index:
         if len(query) > 0:
             print('Query: ', query)
             run_search(' '.join(query), documents, lexicon, index,